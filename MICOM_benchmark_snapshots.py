@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script to compare the size, write and load times of community models saved as plain pickles
+(as micom's Community.to_pickle) and as compressed snapshots (see MICOM_snapshot.py)
+
+Each community of the folder (or the first -n) is saved in each format to a temporary folder,
+and loaded -r times (the best time is kept).
+Note that files are read from the temporary folder (usually a local disk, and often already in memory),
+so load times on shared scratch will differ more between formats, as they depend more on the file size.
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, glob, pickle, time, tempfile
+from argparse import ArgumentParser
+import pandas as pd
+from MICOM_snapshot import save_snapshot, read_snapshot, sample_name
+
+parser = ArgumentParser()
+parser.add_argument('-p', '--pickles_path', help="""path to the folder containing the community files. Default = 1_communities""", required=False, default="1_communities")
+parser.add_argument('-n', '--n_communities', help="""number of communities to test. Default = 5""", required=False, default=5)
+parser.add_argument('-c', '--codecs', help="""snapshot codecs to test, separated by commas. Default = zstd,lz4,zlib""", required=False, default="zstd,lz4,zlib")
+parser.add_argument('-r', '--repeats', help="""number of times each file is loaded. Default = 3""", required=False, default=3)
+parser.add_argument('-o', '--output', help="""output file. Default = snapshot_benchmark.csv""", required=False, default="snapshot_benchmark.csv")
+
+args = parser.parse_args()
+pickles_path = args.pickles_path
+n_communities = int(args.n_communities)
+codecs = args.codecs.split(",")
+repeats = int(args.repeats)
+out_fp = args.output
+
+
+def save_pickle(com, filename, codec=None):
+    with open(filename, mode="wb") as out:
+        pickle.dump(com, out, protocol=4) # as micom's Community.to_pickle
+
+
+def load_pickle(filename):
+    with open(filename, mode="rb") as infile:
+        return pickle.load(infile)
+
+
+def benchmark(com, name, fmt, save_func, load_func, codec, tmp_dir):
+    fp = os.path.join(tmp_dir, name + "." + fmt)
+    start = time.perf_counter()
+    save_func(com, fp, codec)
+    write_s = time.perf_counter() - start
+
+    load_times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        load_func(fp)
+        load_times.append(time.perf_counter() - start)
+
+    size_mb = os.path.getsize(fp) / 1e6
+    os.remove(fp)
+    return {"community": name, "format": fmt, "size_mb": round(size_mb, 2),
+            "write_s": round(write_s, 3), "load_s": round(min(load_times), 3)}
+
+
+community_fps = sorted(glob.glob(os.path.join(pickles_path, "*.snap")) + glob.glob(os.path.join(pickles_path, "*.pickle")))[:n_communities]
+print ("\nBenchmarking %i communities from %s\n" %(len(community_fps), pickles_path))
+
+results = []
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for fp in community_fps:
+        name = sample_name(fp)
+        com = read_snapshot(fp) # community files may be pickles or snapshots
+        results.append(benchmark(com, name, "pickle", save_pickle, load_pickle, None, tmp_dir))
+        for codec in codecs:
+            results.append(benchmark(com, name, "snapshot_" + codec, save_snapshot, read_snapshot, codec, tmp_dir))
+        print ("%s done" %(name))
+
+results = pd.DataFrame(results)
+results.to_csv(out_fp, index=False)
+
+## summary - mean per format, and relative to the plain pickles:
+summary = results.groupby("format", sort=False)[["size_mb", "write_s", "load_s"]].mean()
+summary["size_vs_pickle"] = (summary["size_mb"] / summary.at["pickle", "size_mb"]).round(2)
+summary["load_vs_pickle"] = (summary["load_s"] / summary.at["pickle", "load_s"]).round(2)
+print ("\n" + summary.round(3).to_string())
+
+print ("\nDONE! Results saved to %s\n" %(out_fp))
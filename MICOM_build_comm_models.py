@@ -5,6 +5,18 @@ Script to run MICOM and build community models.
 Also adds a media to the community and saves it as a pickle file.
 Using here the Western Diet csv file, formated to work with carveme, from the MICOM website,
 
+GEMs are read from a cache of parsed models (see MICOM_gem_cache.py), so each SBML file
+is parsed only once across samples. Use -gc none to read the SBML files directly.
+
+Several samples can be built in one run (-s S1,S2,S3 or -sf samples.txt), by -th worker processes.
+The medium is matched against an index of the medium reactions built once. When reading the SBML files
+directly (-gc none), each worker keeps the models it has parsed (pickled, in a pool shared by all the
+communities it builds), so each SBML file is parsed once per worker. Cached GEMs are already pickles,
+so they are read by micom as usual (each community unpickles its own copy of the taxon models either way).
+
+Communities are saved as compressed snapshots (<sample>.snap, see MICOM_snapshot.py, read by MICOM_grow_wf.py
+and MICOM_coop_tradeoff.py), or as plain pickles readable by micom's load_pickle (<sample>.pickle) with -fmt pickle.
+
 Compatible with MICOM v.0.25.1
 
 Created on 06/05/21
@@ -12,20 +24,36 @@ Updated 21/09/21
 @author: V.R.Marcelino
 """
 import os
+import pickle
+from contextlib import contextmanager
+from multiprocessing import Pool
+import numpy as np
+import micom.community
 from micom import Community
+from micom.util import load_model
 import pandas as pd
 from micom.qiime_formats import load_qiime_medium
 from argparse import ArgumentParser
+from MICOM_gem_cache import cache_models
+from MICOM_snapshot import save_community, community_file
 
 
 parser = ArgumentParser()
 parser.add_argument('-s', '--sample', help="""sample, or community type, to be analysed. Must be present in the 
-folder containing MAGs (or community) tables""", required=True)
+folder containing MAGs (or community) tables. Several samples can be given, separated by commas""", required=False, default=None)
+parser.add_argument('-sf', '--samples_file', help="""text file with one sample per line, all built in the same run (optional, instead of -s)""", required=False, default=None)
 
-parser.add_argument('-f', '--tables_fp', help="""Path to folder containing MAGs (or community) tables""", required=False, default="0_MAGs_tables")
+parser.add_argument('-f', '--tables_fp', help="""Path to folder containing MAGs (or community) tables,
+or to a single table with all samples (csv or parquet, see MetModels_produce_micom_tables.py -l).
+The whole csv table is read in each run, while only the rows of the samples to build are read from parquet""", required=False, default="0_MAGs_tables")
 parser.add_argument('-p', '--pickles', help="""Path to folders to store the community models""", required=False, default="1_communities")
 
 parser.add_argument('-m', '--media', help="path to the media file", required=False, default="0_diet/carveme_skeleton.csv")
+parser.add_argument('-gc', '--gem_cache', help="""folder with the cache of parsed GEMs (created if needed), or none to read the SBML files directly.
+                    Default = 0_GEMs_cache""", required=False, default="0_GEMs_cache")
+parser.add_argument('-fmt', '--format', help="""format of the community files: snapshot (compressed, see MICOM_snapshot.py)
+                    saved as <sample>.snap, or pickle (<sample>.pickle, readable by micom's load_pickle). Default = snapshot""", required=False, default="snapshot", choices=["snapshot", "pickle"])
+parser.add_argument('-th', '--threads', help="""number of communities built in parallel (worker processes). Default = 1""", required=False, default=1)
 
 
 args = parser.parse_args()
@@ -34,54 +62,128 @@ args = parser.parse_args()
 # community type and file_paths:
 in_folder = args.tables_fp
 comm_folder = args.pickles
-sample = args.sample
 w_media = args.media
+gem_cache_fp = args.gem_cache
+th = int(args.threads)
+comm_format = args.format
+
+if args.samples_file is not None:
+    with open(args.samples_file) as f:
+        samples = [s for s in f.read().splitlines() if s != ""]
+elif args.sample is not None:
+    samples = args.sample.split(",")
+else:
+    parser.error("a sample (-s) or a file with samples (-sf) is required")
 
 
 #in_folder = '0_MAGs_tables'
 #comm_folder = '1_communities'
-#sample = 'SRR6784563'
+#samples = ['SRR6784563']
 #w_media = '0_diet/carveme_skeleton.csv'
 
 if not os.path.exists(comm_folder):
     os.mkdir(comm_folder)
 
-### import MAGs table containing genome-scale model paths
+### import MAGs tables containing genome-scale model paths
 ## in the tutorial, they call this table 'taxonomy'
-fp = in_folder + "/" + sample + ".csv"
-mag_tb = pd.read_csv(fp)
+if os.path.isfile(in_folder):
+    # single table with all samples, read once and split by sample
+    # (sample ids read as strings, so numeric-looking ids such as 0012 are kept as they are)
+    if in_folder.endswith(".parquet"):
+        all_tb = pd.read_parquet(in_folder, filters=[("sample_id", "in", samples)]) # only the rows of these samples
+        all_tb["sample_id"] = all_tb["sample_id"].astype(str)
+    else:
+        all_tb = pd.read_csv(in_folder, dtype={"sample_id": str})
+    sample_tbs = {sample: tb.reset_index(drop=True) for sample, tb in all_tb.groupby("sample_id", sort=False)}
+    missing = [sample for sample in samples if sample not in sample_tbs]
+    if len(missing) > 0:
+        parser.error("samples not found in %s: %s" %(in_folder, ",".join(missing)))
+    mag_tbs = {sample: sample_tbs[sample] for sample in samples}
+else:
+    mag_tbs = {sample: pd.read_csv(in_folder + "/" + sample + ".csv") for sample in samples}
+
+## read GEMs from the cache (parsing and caching the ones that are not there yet, in parallel)
+if gem_cache_fp.lower() != "none":
+    cached_fps = cache_models(pd.concat([mag_tb["file"] for mag_tb in mag_tbs.values()]), gem_cache_fp, th)
+    for mag_tb in mag_tbs.values():
+        mag_tb["file"] = mag_tb["file"].map(cached_fps)
 
 ### import and parse media - western diet
 medium = pd.read_csv(w_media)
 medium.index = medium.reaction
 
-##############################
-# BUILD COMMUNITY MODELS
-
-# In order to convert the specification in a community model we will use the Community class from micom
-# which derives from the cobrapy Model class.
-# this took 15min for a sample
-print ("\nBuilding community, be patient...\n")
-com = Community(mag_tb)
-print("Done. Built a community with a total of {} reactions.\n".format(len(com.reactions)))
-
-
-##### Add media to the file
-print ("Adding media and saving to pickle\n")
-# check if the names match & add to the community object:
-ex_ids = [r.id for r in com.exchanges]
+# index of the medium reactions (positions of each reaction in the medium table), built once for all communities
+medium_positions = medium.groupby(level=0, sort=False).indices
 
-medium['reaction'].isin(ex_ids).sum() # must be a large number of reactions (>100)
-med = medium[medium.index.isin(ex_ids)] # exclude medium items not used by the microbiome
 
-# the x 100 compensates for the fact CARVEME covers very little carbon sources, especially complex carbohydrates.
-# So this is require to get the community growing.
-# divide fluxes by 100 later
-com.medium = med.flux * 100
+##############################
+# POOL OF TAXON MODELS
+
+# each worker keeps the (pickled) taxon models it has parsed, and gives a fresh copy to each community,
+# as micom modifies the taxon models when adding them to a community
+model_pool = {}
+
+def pooled_model(filepath):
+    """ Loads a taxon model from the pool of the worker, parsing it only the first time.
+    Pickled models (e.g. from the GEMs cache) are loaded by micom directly, as parsing them is unpickling them"""
+    if filepath.endswith(".pickle"):
+        return load_model(filepath)
+    if filepath not in model_pool:
+        model_pool[filepath] = pickle.dumps(load_model(filepath), protocol=pickle.HIGHEST_PROTOCOL)
+    return pickle.loads(model_pool[filepath])
+
+
+@contextmanager
+def pooled_models():
+    """ Makes micom load the taxon models with pooled_model while building a community,
+    restoring micom's own loader afterwards"""
+    micom_load_model = micom.community.load_model
+    micom.community.load_model = pooled_model
+    try:
+        yield
+    finally:
+        micom.community.load_model = micom_load_model
 
-# save this community to file
-comm_fp = comm_folder + "/" + sample + ".pickle"
-com.to_pickle(comm_fp)
 
-print ("\nDone building community model for %s!\n"%(sample))
+##############################
+# BUILD COMMUNITY MODELS
 
+def build_community(sample):
+    # In order to convert the specification in a community model we will use the Community class from micom
+    # which derives from the cobrapy Model class.
+    # this took 15min for a sample (mostly parsing SBML files, now cached)
+    with pooled_models():
+        com = Community(mag_tbs[sample], progress=False)
+    print("Built a community for %s with a total of %i reactions." %(sample, len(com.reactions)))
+
+    ##### Add media to the file
+    # check if the names match & add to the community object
+    # (medium items not used by the microbiome are excluded, keeping the order of the medium table):
+    ex_ids = [r.id for r in com.exchanges]
+    wanted_rows = [medium_positions[ex_id] for ex_id in ex_ids if ex_id in medium_positions]
+    med = medium.iloc[np.sort(np.concatenate(wanted_rows))] if len(wanted_rows) > 0 else medium.iloc[[]]
+    if len(med) < 100:
+        print ("WARNING: only %i medium reactions found in the community of %s" %(len(med), sample))
+
+    # the x 100 compensates for the fact CARVEME covers very little carbon sources, especially complex carbohydrates.
+    # So this is require to get the community growing.
+    # divide fluxes by 100 later
+    com.medium = med.flux * 100
+
+    # save this community to file
+    comm_fp = comm_folder + "/" + community_file(sample, comm_format)
+    save_community(com, comm_fp, comm_format)
+    return sample
+
+
+print ("\nBuilding %i communities, be patient...\n" %(len(samples)))
+if th > 1 and len(samples) > 1:
+    with Pool(min(th, len(samples))) as pool:
+        for sample in pool.imap_unordered(build_community, samples):
+            print ("Done building community model for %s!" %(sample))
+else:
+    for sample in samples:
+        build_community(sample)
+        print ("Done building community model for %s!" %(sample))
+
+print ("\nDone!\n")
@@ -3,6 +3,19 @@
 """
 Script to extract minimal growth media and optimize the cooperative tradeoff
 Run this after MICOM_build_comm_models.py
+
+The results of each sample are written to a checkpoint (in <out_folder>/checkpoints, or -ck) as soon as
+the sample is done. Samples that fail (including errors reading the community) are logged and skipped, and samples
+with a checkpoint are not run again, so an interrupted run can be resumed. Checkpoints are named after the size and
+modification time of the community file, so samples are run again when their community is rebuilt. The output tables are concatenated from the checkpoints.
+
+Workers keep only the exchange fluxes (between taxa and the medium), which is all the output needs.
+Use -ff to also keep all fluxes and save them to minimal_fluxes_all_<timestamp>.csv.
+
+With -rc, results are also kept in a cache shared between runs (see MICOM_result_cache.py), so communities
+already solved with the same medium, tradeoff and MICOM version are not solved again (e.g. for other samples
+with the same community, or in a new output folder).
+
 Created on 30/3/21
 edited: 16/08/21
 
@@ -15,20 +28,25 @@ import sys
 import os
 from argparse import ArgumentParser
 import pandas as pd
-from micom import load_pickle
+from multiprocessing import Pool
 from micom.media import minimal_medium
-from micom.workflows import workflow
 from micom.logger import logger
 import time
+from MICOM_snapshot import load_snapshot, save_snapshot, read_snapshot, sample_name
+from MICOM_result_cache import community_hash, result_key, get_result, put_result
 
 
 parser = ArgumentParser()
-parser.add_argument('-sl', '--sample_list', help="""path to a txt file containing sample.pickle names""", required=False)
-parser.add_argument('-sn', '--sample_name', help="""sample name (e.g. SRR413605.pickle). Required when doing analyses with one sample at time (e.g. with snakemake)""", required=False)
-parser.add_argument('-p', '--pickles_path', help="""path to the folder containing the pickle files. Default = 1_communities""", required=False, default="1_communities")
+parser.add_argument('-sl', '--sample_list', help="""path to a txt file containing community file names (sample.snap or sample.pickle)""", required=False)
+parser.add_argument('-sn', '--sample_name', help="""community file name (e.g. SRR413605.snap or SRR413605.pickle). Required when doing analyses with one sample at time (e.g. with snakemake)""", required=False)
+parser.add_argument('-p', '--pickles_path', help="""path to the folder containing the community files. Default = 1_communities""", required=False, default="1_communities")
 parser.add_argument('-trad', '--trade_off', help="""trade_off (fraction) to use in the cooperative tradeoff""", required=False, default=0.5)
 parser.add_argument('-t', '--threads', help="""number of threads. Default = 2""", required=False, default=2)
 parser.add_argument('-o', '--out_folder', help="""output_folder. Default = 2_TradeOffs""", required=False, default="2_TradeOffs")
+parser.add_argument('-ff', '--full_fluxes', help="""keep the fluxes of all reactions, and save them to minimal_fluxes_all_<timestamp>.csv""", required=False, action="store_true")
+parser.add_argument('-ck', '--checkpoints', help="""folder to keep the results of each sample. Default = <out_folder>/checkpoints""", required=False, default=None)
+parser.add_argument('-rc', '--result_cache', help="""folder with the cache of results (created if needed). Optional""", required=False, default=None)
+parser.add_argument('-rcs', '--result_cache_size', help="""maximum size of the result cache, in MB (least recently used results are removed). Default = 5000""", required=False, default=5000)
 
 
 args = parser.parse_args()
@@ -36,9 +54,15 @@ args = parser.parse_args()
 samples_list_fp = args.sample_list
 samples_name_fp = args.sample_name
 pickles_path = args.pickles_path
-trade_off = args.trade_off # fraction
+trade_off = float(args.trade_off) # fraction
 max_procs = int(args.threads)
 out_dir=args.out_folder
+full_fluxes = args.full_fluxes
+checkpoints_fp = args.checkpoints
+if checkpoints_fp is None:
+    checkpoints_fp = out_dir + "/checkpoints"
+result_cache_fp = args.result_cache
+result_cache_size = float(args.result_cache_size)
 
 
 #samples_fp='1_communities/individual_ERR_samples_test.txt'
@@ -67,6 +91,15 @@ else:
 ## make out dir
 if not os.path.exists(out_dir):
     os.mkdir(out_dir)
+if not os.path.exists(checkpoints_fp):
+    os.makedirs(checkpoints_fp)
+
+
+### exchange reactions are reactions that move metabolites across in silico compartments.
+def exchange_fluxes(fluxes):
+    ex_flux = fluxes.filter(regex='^EX_') # get only exchanges (starts with 'EX_')
+    ex_flux = ex_flux.filter(regex='e$') # remove media (media ends with 'e_m', so I want the ones that end with 'e' only)
+    return ex_flux
 
 
 ## function that optimizes the cooperative tradeoff, first using the western media for upper boundaries,
@@ -74,65 +107,141 @@ if not os.path.exists(out_dir):
 ## Note - parsimonious FBA has been recently recommended - see note at the end of the script
 def media_and_gcs(sam):
 
-    com = load_pickle(pickles_path +"/"+ sam)
+    com = load_snapshot(pickles_path +"/"+ sam)
+
+    # results of this community and medium may be in the cache already (possibly from another sample),
+    # cached without sample names
+    key = None
+    if result_cache_fp is not None:
+        try:
+            key = result_key(community_hash(com), com.medium, "minimal_medium_FBA", trade_off, full_fluxes=full_fluxes)
+        except FileNotFoundError as e:
+            logger.warning("%s is simulated without the result cache: %s" %(sam, e))
+    if key is not None:
+        result = get_result(result_cache_fp, key)
+        if result is not None:
+            return sample_result(result, sam)
 
     # Get growth rates
     try:
         sol = com.cooperative_tradeoff(fraction=trade_off)
         rates = sol.members["growth_rate"].copy()
         rates["community"] = sol.growth_rate
-        rates.name = sam
     except Exception:
         logger.warning("Could not solve cooperative tradeoff for %s." % sam)
         return None
 
     # Get the minimal medium
     med = minimal_medium(com, 0.95 * sol.growth_rate, exports=True)
-    med.name = sam
+    if med is None:
+        logger.warning("Could not get a minimal medium for %s." % sam)
+        return None
 
     # Apply medium and reoptimize
     com.medium = med[med > 0]
-    sol = com.cooperative_tradeoff(fraction=0.5, fluxes=True, pfba=False) # uses the 'classic' FBA instead of the parsimonious FBA
+    try:
+        sol = com.cooperative_tradeoff(fraction=0.5, fluxes=True, pfba=False) # uses the 'classic' FBA instead of the parsimonious FBA
+    except Exception:
+        logger.warning("Could not solve cooperative tradeoff with the minimal medium for %s." % sam)
+        return None
     fluxes = sol.fluxes
-    fluxes["sample"] = sam
-    return {"medium": med, "gcs": rates, "fluxes": fluxes}
+    if not full_fluxes:
+        # keep only the exchange fluxes, so checkpoints (and the merged table) stay small
+        fluxes = exchange_fluxes(fluxes).copy()
+    result = {"medium": med, "gcs": rates, "fluxes": fluxes}
+    if key is not None:
+        put_result(result_cache_fp, key, result, result_cache_size)
+    return sample_result(result, sam)
 
 
-gcs = pd.DataFrame()
-media = pd.DataFrame()
-fluxes = pd.DataFrame()
+def sample_result(result, sam):
+    """ Adds the sample name to the results of a community"""
+    gcs = result["gcs"].rename(sam)
+    medium = result["medium"].rename(sam)
+    fluxes = result["fluxes"].assign(sample=sam)
+    return {"medium": medium, "gcs": gcs, "fluxes": fluxes}
+
+
+def community_stamp(sam):
+    """ Size and modification time of the community file, so checkpoints of a rebuilt community are not reused"""
+    try:
+        stat = os.stat(pickles_path +"/"+ sam)
+    except OSError:
+        return "missing"
+    return "%x-%x" %(stat.st_size, stat.st_mtime_ns)
 
-#run multiple samples in parallel with micom.workflow
-print ("\n simulating cooperative trade-off\n")
-results = workflow(media_and_gcs, samples, max_procs)
 
-for r in results:
-    gcs = gcs.append(r["gcs"])
-    media = media.append(r["medium"])
-    fluxes = fluxes.append(r["fluxes"])
+def checkpoint_path(sam):
+    fluxes_stamp = ".full" if full_fluxes else ""
+    return (checkpoints_fp + "/" + sample_name(sam) + ".tradeoff_" + str(trade_off) + fluxes_stamp
+            + ".community_" + community_stamp(sam) + ".checkpoint")
+
+
+def run_sample(sam):
+    """ Runs one sample and writes its results to a checkpoint (in the worker, so results are not sent back).
+    Errors are logged, and the sample is reported as failed instead of stopping the run."""
+    try:
+        result = media_and_gcs(sam)
+        if result is None:
+            return sam, False
+        save_snapshot(result, checkpoint_path(sam))
+    except Exception as e:
+        logger.error("%s failed: %s: %s" %(sam, type(e).__name__, e))
+        return sam, False
+    return sam, True
+
+
+# samples with a checkpoint were already done (e.g. in a run that was interrupted)
+done = {sam for sam in samples if os.path.exists(checkpoint_path(sam))}
+to_run = [sam for sam in samples if sam not in done]
+print ("\n%i samples already done, %i to run" %(len(done), len(to_run)))
+
+#run multiple samples in parallel, one sample per worker process (as micom's workflow, avoids the optlang memory leak)
+print ("\n simulating cooperative trade-off\n")
+failed = []
+if len(to_run) > 0:
+    with Pool(processes=min(max_procs, len(to_run)), maxtasksperchild=1) as pool:
+        for sam, success in pool.imap_unordered(run_sample, to_run):
+            if success:
+                print ("%s done" %(sam))
+            else:
+                failed.append(sam)
+                print ("WARNING: %s failed, skipping" %(sam))
+
+if len(failed) > 0:
+    print ("\n%i samples failed (rerun to try them again): %s\n" %(len(failed), ", ".join(failed)))
+
+## merge the checkpoints (in the order of the samples)
+results = [read_snapshot(checkpoint_path(sam)) for sam in samples if sam not in failed]
+if len(results) == 0:
+    print ("Error: no sample could be simulated.")
+    sys.exit(1)
+
+gcs = pd.concat([r["gcs"].to_frame().T for r in results])
+media = pd.concat([r["medium"].to_frame().T for r in results])
+fluxes = pd.concat([r["fluxes"] for r in results])
 
 # get timestamp or use sample name (when running one sample at a time)
 if samples_list_fp != None:
     ts = str(round(time.time()))
 else:
-    ts = "".join(samples).split(".pickle")[0]
+    ts = sample_name(samples[0])
 print ("timestamp or sample_stamp: %s"%(ts))
 
 
 
 gcs_fp = out_dir + "/growth_rates_" + ts + ".csv"
 media_fp = out_dir + "/minimal_imports_" + ts + ".csv"
-fluxes_fp = out_dir + "/minimal_fluxes_all_" + ts + ".csv"
 
 gcs.to_csv(gcs_fp)
 media.to_csv(media_fp)
-fluxes.to_csv(fluxes_fp)
+if full_fluxes:
+    fluxes_fp = out_dir + "/minimal_fluxes_all_" + ts + ".csv"
+    fluxes.to_csv(fluxes_fp)
 
 ### Get only the flux of the exchange_reactions:
-# exchange reactions are reactions that move metabolites across in silico compartments.
 ex_fluxes_fp = out_dir + "/minimal_fluxes_exchange_" + ts + ".csv"
-ex_flux = fluxes.filter(regex='^EX_') # get only exchanges (starts with 'EX_')
-ex_flux = ex_flux.filter(regex='e$') # remove media (media ends with 'e_m', so I want the ones that end with 'e' only)
+ex_flux = exchange_fluxes(fluxes)
 ex_flux = ex_flux.fillna(0) #fill NANs with zeros
 
 ex_flux = ex_flux.loc[:, (ex_flux != 0).any(axis=0)] #remove columns with all zeros
@@ -146,7 +255,7 @@ print ("\nDONE! Exchange fluxes saved to %s\n"%(ex_fluxes_fp))
 ##### Note - to run the parsimonious FBA, there is no need to get the minimal media. the function should look like:
 #def media_and_gcs(sam):
 #
-#    com = load_pickle(pickles_path +"/"+ sam)
+#    com = load_snapshot(pickles_path +"/"+ sam)
 #
 #    com.medium = med[med > 0]
 #    sol = com.cooperative_tradeoff(fraction=0.5, fluxes=True, pfba=True) # uses the parsimonious FBA
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of parsed genome-scale metabolic models (GEMs), so community building does not parse
+the same CarveMe SBML files again for every sample.
+
+Each model is read once and saved as a pickle named after the GEM and a hash of its content
+(and of the cobra version), e.g. 0_GEMs_cache/S975C400.batch2_1f3a....pickle.
+Changed GEMs get a new hash, and are converted again.
+
+MICOM reads .pickle models directly, so the cache only rewrites the 'file' column of the
+MAGs tables (cache_models and cached_table). Used by MICOM_build_comm_models.py (-gc option),
+and can be used to fill the cache for a whole folder of GEMs beforehand:
+
+python3 MICOM_gem_cache.py -GEMs 1_GEMs -gc 0_GEMs_cache -th 8
+
+Works with MICOM v 0.25.1
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, glob, hashlib, pickle
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import cobra
+
+HASH_CHUNK = 1 << 20
+
+
+def gem_hash(gem_fp):
+    """ Hash of the content of a GEM file (and of the cobra version used to parse it)"""
+    h = hashlib.sha256(cobra.__version__.encode())
+    with open(gem_fp, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def cache_path(gem_fp, cache_fp):
+    """ Path of the cached (pickled) version of a GEM"""
+    name = os.path.basename(gem_fp)
+    for ext in (".gz", ".xml"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(cache_fp, name + "_" + gem_hash(gem_fp) + ".pickle")
+
+
+def cache_model(gem_fp, cache_fp):
+    """ Returns the path to the cached GEM, parsing the SBML file only if it is not cached yet"""
+    cached_fp = cache_path(gem_fp, cache_fp)
+    if not os.path.exists(cached_fp):
+        model = cobra.io.read_sbml_model(gem_fp)
+
+        # write to a temporary file first, so other jobs never read a half-written model
+        tmp_fp = "%s.%i.tmp" %(cached_fp, os.getpid())
+        with open(tmp_fp, "wb") as out:
+            pickle.dump(model, out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fp, cached_fp)
+    return cached_fp
+
+
+def cache_models(gem_fps, cache_fp, threads=1):
+    """ Returns a dict with the cached path of each GEM, converting the missing ones in parallel"""
+    os.makedirs(cache_fp, exist_ok=True)
+    gem_fps = sorted(set(gem_fps))
+    tasks = [(gem_fp, cache_fp) for gem_fp in gem_fps]
+    if threads > 1 and len(tasks) > 1:
+        with Pool(min(threads, len(tasks))) as pool:
+            cached_fps = pool.starmap(cache_model, tasks)
+    else:
+        cached_fps = [cache_model(*task) for task in tasks]
+    return dict(zip(gem_fps, cached_fps))
+
+
+def cached_table(mag_tb, cache_fp, threads=1):
+    """ Copy of a MAGs table (MICOM taxonomy) with the 'file' column pointing to the cached GEMs"""
+    mag_tb = mag_tb.copy()
+    mag_tb["file"] = mag_tb["file"].map(cache_models(mag_tb["file"], cache_fp, threads))
+    return mag_tb
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-GEMs', '--GEMs', help="""Path to the folder containing the Genome scale metabolic models (.xml)""", required=True)
+    parser.add_argument('-gc', '--gem_cache', help="""Folder to keep the cached GEMs. Default = 0_GEMs_cache""", required=False, default="0_GEMs_cache")
+    parser.add_argument('-th', '--threads', help="""number of GEMs converted in parallel. Default = 1""", required=False, default=1)
+
+    args = parser.parse_args()
+    gem_fps = glob.glob(os.path.join(args.GEMs, "*.xml")) + glob.glob(os.path.join(args.GEMs, "*.xml.gz"))
+    cached_fps = cache_models(gem_fps, args.gem_cache, int(args.threads))
+    print ("%i GEMs cached in %s" %(len(cached_fps), args.gem_cache))
+    print ("\nDone!")
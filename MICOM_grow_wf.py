@@ -3,86 +3,278 @@
 """
 Script to run MICOM's grow workflow for one community type (a.k.a. sample or biome)
 
+Several samples can be processed in one run (-s S1,S2,S3 or -sf samples.txt): communities are grown
+in a single pool of workers (-th), and the exchanges and growth rates of each sample are saved as soon
+as the sample is done, to the same per-sample files as when running one sample at a time.
+Samples that cannot be simulated are skipped, and the script exits with an error after the other samples are saved.
+
+Several tradeoff values can be given (e.g. -t 0.1,0.3,0.5,0.7,0.9): each community is loaded once and
+solved for all values (from the highest to the lowest, reusing the same solver problem), and the results
+are saved with a tradeoff column to exchanges_tradeoffs_<sample>.csv and growth_rates_tradeoffs_<sample>.csv
+(not added to the exchange store).
+
+Several media can also be tested on the same community (diet sensitivity), without rebuilding it:
+-ms scales the medium (e.g. -ms 1,3,6,12; default 6, as used so far), and -mf gives medium files
+(formatted as 0_diet/carveme_skeleton.csv) that replace the medium of the community. Media from files are
+multiplied by the scaling used when building the communities (-bs, 100 in MICOM_build_comm_models.py)
+and by each -ms factor. Only the bounds of the medium change between media, so the community is loaded once,
+and the fluxes are divided back by the total scaling of each medium (600 by default).
+Results of several media are saved with medium and tradeoff columns to exchanges_media_<sample>.csv and
+growth_rates_media_<sample>.csv (not added to the exchange store).
+
+With -rc, results are kept in a cache (see MICOM_result_cache.py), so communities already solved with the same
+medium, tradeoff(s) and MICOM version are not solved again when rerunning the workflow.
+
 Works with MICOM v 0.25.1
 
 Created on 30/3/21
-Last updated on 25/8/21
+Last updated on 18/10/26
 
 @author: V.R.Marcelino
 """
 
+import os
 import pandas as pd
-from micom import load_pickle
-from micom.workflows import grow
+from multiprocessing import Pool
+from cobra.util.solver import interface_to_str
+from micom.annotation import annotate_metabolites_from_exchanges
+from micom.logger import logger
+from micom.workflows.grow import DIRECTION
 from argparse import ArgumentParser
+from MetModels_exchange_store import write_exchanges
+from MICOM_snapshot import load_snapshot, community_path
+from MICOM_result_cache import community_hash, result_key, get_result, put_result
 
 
 parser = ArgumentParser()
-parser.add_argument('-c', '--comm_fp', help="""Path to folder containing community pickles""", required=False, default="1_communities/")
-parser.add_argument('-s', '--sample', help="""sample, or community type, to be analysed""", required=True)
-parser.add_argument('-t', '--trade_off', help="""trade_off to use in the grow workflow. Default here is 0.5, but the original default is 1""", required=False, default=0.5)
+parser.add_argument('-c', '--comm_fp', help="""Path to folder containing the communities (snapshots or pickles)""", required=False, default="1_communities/")
+parser.add_argument('-s', '--sample', help="""sample, or community type, to be analysed. Several samples can be given, separated by commas""", required=False, default=None)
+parser.add_argument('-sf', '--samples_file', help="""text file with one sample per line, all analysed in the same run (optional, instead of -s)""", required=False, default=None)
+parser.add_argument('-t', '--trade_off', help="""trade_off to use in the grow workflow. Default here is 0.5, but the original default is 1.
+                    Several values can be given, separated by commas (tradeoff sweep)""", required=False, default="0.5")
+parser.add_argument('-ms', '--medium_scaling', help="""factor(s) the medium is multiplied by before solving, separated by commas. Default = 6""", required=False, default="6")
+parser.add_argument('-mf', '--medium_files', help="""medium file(s) replacing the medium of the communities, separated by commas. Optional""", required=False, default=None)
+parser.add_argument('-bs', '--build_scaling', help="""factor the medium was multiplied by when building the communities. Default = 100""", required=False, default=100)
 parser.add_argument('-th', '--threads', help="""threads to use""", required=False, default=1)
 parser.add_argument('-o', '--out_folder', help="""output_folder. Default = 2_Exchanges""", required=False, default="2_TradeOffs")
+parser.add_argument('-st', '--store', help="""Path to an exchange store (see MetModels_exchange_store.py) where the exchanges
+                    will also be appended. Optional""", required=False, default=None)
+parser.add_argument('-rc', '--result_cache', help="""folder with the cache of results (created if needed). Optional""", required=False, default=None)
+parser.add_argument('-rcs', '--result_cache_size', help="""maximum size of the result cache, in MB (least recently used results are removed). Default = 5000""", required=False, default=5000)
 
 
 args = parser.parse_args()
 
 # community type and file_paths:
 pickles_path = args.comm_fp
-sample = args.sample
-trade_off = args.trade_off
+trade_offs = [float(t) for t in str(args.trade_off).split(",")]
+tradeoff_sweep = len(trade_offs) > 1
+scalings = [float(f) for f in str(args.medium_scaling).split(",")]
+build_scaling = float(args.build_scaling)
+medium_fps = args.medium_files.split(",") if args.medium_files is not None else []
 th = int(args.threads)
 out_dir=args.out_folder
+store_fp = args.store
+result_cache_fp = args.result_cache
+result_cache_size = float(args.result_cache_size)
+
+if args.samples_file is not None:
+    with open(args.samples_file) as f:
+        samples = [s for s in f.read().splitlines() if s != ""]
+elif args.sample is not None:
+    samples = args.sample.split(",")
+else:
+    parser.error("a sample (-s) or a file with samples (-sf) is required")
 
 #pickles_path = '1_communities'
-#sample = 'SRR6784563'
-#trade_off = 0.5
+#samples = ['SRR6784563']
+#trade_offs = [0.5]
+#scalings = [6]
+#medium_fps = []
 #th = 2
 
-# Load community:
-comm_fp = pickles_path +"/"+ sample + '.pickle'
-com = load_pickle(comm_fp)
+# workers are replaced after this number of samples (as in micom, to work around the optlang memory leak)
+SAMPLES_PER_WORKER = 10
+
+
+def medium_name(medium_fp, factor):
+    """ Label of a medium in the outputs, e.g. x6 (medium of the community) or carveme_skeleton_x6"""
+    name = "x%g" %(factor)
+    if medium_fp is not None:
+        name = os.path.basename(medium_fp).replace(".csv", "") + "_" + name
+    return name
+
+
+# media to test: the medium of each community (if no medium file is given) or the medium files, at each scaling
+media = {}
+for medium_fp in medium_fps:
+    medium = pd.read_csv(medium_fp).drop_duplicates(subset="reaction")
+    media[medium_fp] = medium.set_index("reaction").flux * build_scaling
+if len(media) == 0:
+    media[None] = None
+conditions = [(medium_name(medium_fp, factor), medium_fp, factor) for medium_fp in media for factor in scalings]
+medium_sweep = len(conditions) > 1
+sweep = tradeoff_sweep or medium_sweep
 
 
 #############################
 #### SIMULATE GROWTH
-print ("\n simulating growth...\n")
 
-#generate a manifest:
-comm_filename = sample + '.pickle'
-manifest = pd.DataFrame({"sample_id": sample, "file": comm_filename}, index=[0])
+def grow_sample(sample):
+    """ Runs one sample in a worker. Errors (e.g. a corrupt community file) are logged,
+    and the sample is reported as failed instead of stopping the batch."""
+    try:
+        return simulate_sample(sample)
+    except Exception as e:
+        logger.error("%s failed: %s: %s" %(sample, type(e).__name__, e))
+        return sample, None
+
+
+def simulate_sample(sample):
+    """ Cooperative tradeoff with parsimonious FBA for one community
+    (same steps as micom's grow workflow with strategy="pFBA")"""
+    com = load_snapshot(community_path(pickles_path, sample))
+    com.id = sample
+    if "glpk" in interface_to_str(com.solver.interface):
+        logger.error("Community models were not built with a QP-capable solver (CPLEX or Gurobi).")
+        return sample, None
+
+    community_medium = pd.Series(com.medium)
+    ex_ids = [r.id for r in com.exchanges]
+    atol = rtol = com.solver.configuration.tolerances.feasibility
+    exs = list({r.global_id for r in com.internal_exchanges + com.exchanges})
+    annotations = annotate_metabolites_from_exchanges(com)
+    community = None
+    if result_cache_fp is not None:
+        try:
+            community = community_hash(com)
+        except FileNotFoundError as e:
+            logger.warning("%s is simulated without the result cache: %s" %(sample, e))
+
+    results = []
+    for name, medium_fp, factor in conditions:
+        # Medium (western diet, after diluting nutrients absorbed in the small intestine)
+        # test increasing flux (x 6 by default); only the medium bounds change between media
+        if medium_fp is None:
+            medium = community_medium
+        else:
+            medium = media[medium_fp][media[medium_fp].index.isin(ex_ids)] # medium items not used by the microbiome are excluded
+        com.medium = medium * factor
+
+        # results of this community and medium may be in the cache already (without sample names)
+        key = None
+        solutions = None
+        if community is not None:
+            key = result_key(community, com.medium, "pFBA", trade_offs, atol=atol)
+            solutions = get_result(result_cache_fp, key)
+
+        if solutions is None:
+            try:
+                if tradeoff_sweep:
+                    # all tradeoff values in one call: micom keeps the same problem, each solve starts from the previous one
+                    sols = com.cooperative_tradeoff(fraction=trade_offs, fluxes=True, pfba=True, atol=atol, rtol=rtol)
+                    sols = list(zip(sols["tradeoff"], sols["solution"]))
+                else:
+                    sols = [(trade_offs[0], com.cooperative_tradeoff(fraction=trade_offs[0], fluxes=True, pfba=True, atol=atol, rtol=rtol))]
+            except Exception:
+                logger.error("Could not solve cooperative tradeoff for %s (medium %s)." %(sample, name))
+                continue
+            solutions = [(trade_off, sol.members, sol.fluxes.loc[:, exs]) for trade_off, sol in sols]
+            if key is not None:
+                put_result(result_cache_fp, key, solutions, result_cache_size)
+
+        for trade_off, members, exchange_fluxes in solutions:
+            rates = members.copy()
+            rates["taxon"] = rates.index
+            rates["tradeoff"] = trade_off
+            rates["sample_id"] = sample
+
+            fluxes = exchange_fluxes.copy()
+            fluxes["sample_id"] = sample
+            fluxes["tolerance"] = atol
+            results.append({"tradeoff": trade_off, "medium": name, "scaling": build_scaling * factor,
+                            "growth": rates, "exchanges": fluxes, "annotations": annotations})
+
+    if len(results) == 0:
+        return sample, None
+    return sample, results
+
 
-# Medium (western diet, after diluting nutrients absorbed in the small intestine)
-med = pd.DataFrame(com.medium.items(), columns=['reaction', 'flux'])
+def growth_tables(result):
+    """ Growth rates and exchanges of one sample, formatted as in micom's grow workflow"""
+    growth = result["growth"]
+    growth = growth[growth.taxon != "medium"]
 
-# test increasing flux
-med['flux'] = med['flux'] * 6
+    exchanges = result["exchanges"]
+    exchanges["taxon"] = exchanges.index
+    exchanges = exchanges.melt(id_vars=["taxon", "sample_id", "tolerance"], var_name="reaction", value_name="flux").dropna(subset=["flux"])
+    exchanges = pd.merge(exchanges, growth[["taxon", "sample_id", "abundance"]], on=["taxon", "sample_id"], how="outer")
 
-# grow!! using parsimonious FBA
-res = grow(manifest, pickles_path, medium=med, tradeoff=trade_off, threads=th, strategy="pFBA")
-res.exchanges
+    anns = result["annotations"].drop_duplicates()
+    anns.index = anns.reaction
+    exchanges["metabolite"] = anns.loc[exchanges.reaction, "metabolite"].values
+    exchanges["direction"] = DIRECTION[(exchanges.flux > 0.0).astype(int)].values
+    exchanges = exchanges[exchanges.flux.abs() > exchanges.tolerance]
+    return growth, exchanges
 
-# divide fluxes by the 600 (100 added in the build_comm_models, multiplied by 6 here)
-res.exchanges['flux'] = res.exchanges['flux'] / 600
 
-## add sample name:
-res.exchanges['sample_id'] = sample
-res.growth_rates['sample_id'] = sample
+def save_sample(sample, results):
+    all_growth, all_exchanges = [], []
+    for result in results:
+        growth_rates, exchanges = growth_tables(result)
 
-## save to file:
-out_fp_exc = out_dir +"/"+ "exchanges_grow_" + sample + ".csv"
-outfile=open(out_fp_exc,"w")
-res.exchanges.to_csv(out_fp_exc)
-outfile.close()
+        # divide fluxes by the total scaling of the medium (by default 600: 100 added in the build_comm_models, multiplied by 6 here)
+        exchanges['flux'] = exchanges['flux'] / result["scaling"]
+        if sweep:
+            exchanges["tradeoff"] = result["tradeoff"]
+        if medium_sweep:
+            growth_rates = growth_rates.assign(medium=result["medium"])
+            exchanges["medium"] = result["medium"]
+        all_growth.append(growth_rates)
+        all_exchanges.append(exchanges)
+    growth_rates, exchanges = pd.concat(all_growth), pd.concat(all_exchanges)
 
-out_fp_grow = out_dir +"/"+ "growth_rates_" + sample + ".csv"
-outfile=open(out_fp_grow,"w")
-res.growth_rates.to_csv(out_fp_grow)
-outfile.close()
+    ## save to file:
+    if medium_sweep:
+        out_fp_exc = out_dir +"/"+ "exchanges_media_" + sample + ".csv"
+        out_fp_grow = out_dir +"/"+ "growth_rates_media_" + sample + ".csv"
+    elif tradeoff_sweep:
+        out_fp_exc = out_dir +"/"+ "exchanges_tradeoffs_" + sample + ".csv"
+        out_fp_grow = out_dir +"/"+ "growth_rates_tradeoffs_" + sample + ".csv"
+    else:
+        out_fp_exc = out_dir +"/"+ "exchanges_grow_" + sample + ".csv"
+        out_fp_grow = out_dir +"/"+ "growth_rates_" + sample + ".csv"
+    exchanges.to_csv(out_fp_exc)
+    growth_rates.to_csv(out_fp_grow)
 
+    ## append to the columnar exchange store (one tradeoff and medium per sample only):
+    if store_fp is not None and not sweep:
+        write_exchanges(exchanges, store_fp)
 
 
+if __name__ == "__main__":
+    print ("\n simulating growth of %i sample(s), tradeoff(s): %s, medium(s): %s...\n" %(len(samples), ", ".join(str(t) for t in trade_offs), ", ".join(c[0] for c in conditions)))
+    if sweep and store_fp is not None:
+        print ("WARNING: exchanges of a tradeoff or medium sweep are not added to the exchange store")
 
+    failed = []
+    with Pool(processes=min(th, len(samples)), maxtasksperchild=SAMPLES_PER_WORKER) as pool:
+        for sample, results in pool.imap_unordered(grow_sample, samples):
+            if results is None:
+                failed.append(sample)
+                continue
+            try:
+                save_sample(sample, results)
+            except Exception as e:
+                logger.error("Could not save the results of %s: %s: %s" %(sample, type(e).__name__, e))
+                failed.append(sample)
+                continue
+            print ("%s done" %(sample))
 
-print ("\nDONE!!\n")
+    # exit with an error if any sample failed, so workflow managers (e.g. the batches of the Snakefile) run them again
+    if len(failed) == len(samples):
+        raise SystemExit("All samples failed (see the errors above). If all numerical optimizations failed, check that you have CPLEX or Gurobi installed.")
+    if len(failed) > 0:
+        raise SystemExit("\nERROR: growth could not be simulated for %i sample(s): %s\n" %(len(failed), ", ".join(failed)))
 
+    print ("\nDONE!!\n")
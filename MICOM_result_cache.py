@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of MICOM simulation results, so samples are not solved again when rerunning the workflows
+(e.g. after changing the config) with the same community, medium and parameters.
+
+Results are saved as snapshots (see MICOM_snapshot.py) named after a hash of what determines them:
+the community composition (hash of each taxon model file, and abundances), the effective medium,
+the tradeoff fraction(s), the strategy (e.g. pFBA or FBA), the solver tolerance and the MICOM version.
+Two samples with the same community and medium share the same results, so results are cached without
+sample names, which are added back by the workflows.
+
+The cache is size-bounded: the total size of the results is recorded in the cache folder (size.txt) and updated
+by each result added, and when it grows over the maximum size, the least recently used results are removed
+(until the cache is at 80% of its maximum size, so the folder is only scanned now and then). Jobs adding results
+at the same time may miss each other's updates, so the recorded size is approximate, and it is recomputed at each eviction.
+
+Communities whose model files are not available anymore can't be hashed (model_hash raises FileNotFoundError),
+and are simulated without the cache.
+
+Used by MICOM_grow_wf.py and MICOM_coop_tradeoff.py (-rc and -rcs options).
+
+Works with MICOM v 0.25.1
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, glob, hashlib, json
+import micom
+from MICOM_gem_cache import gem_hash
+from MICOM_snapshot import save_snapshot, read_snapshot
+
+RESULT_EXT = ".result"
+SIZE_FILE = "size.txt"
+EVICT_TO = 0.8 # evictions remove results until the cache is at this fraction of its maximum size
+
+
+# hashes of the model files already read by this process (communities mostly share the same models),
+# by path, size and modification time, so a file that changes is hashed again
+model_hashes = {}
+
+
+def model_hash(model_fp):
+    """ Hash of a taxon model file. Raises FileNotFoundError if the file is not available anymore,
+    as the community can't be told apart from one built from another version of the file"""
+    if isinstance(model_fp, list): # taxa built from several models
+        return [model_hash(fp) for fp in model_fp]
+    try:
+        st = os.stat(model_fp)
+    except FileNotFoundError:
+        raise FileNotFoundError("Model file %s not found, can't hash the community" %(model_fp)) from None
+    stamp = (model_fp, st.st_size, st.st_mtime_ns)
+    if stamp not in model_hashes:
+        model_hashes[stamp] = gem_hash(model_fp)
+    return model_hashes[stamp]
+
+
+def community_hash(com):
+    """ Hash of the community composition (taxa, hash of their model files, and abundances)"""
+    taxonomy = com.taxonomy.sort_index()
+    taxa = [[str(taxon), model_hash(fp), repr(float(ab))] for taxon, fp, ab in zip(taxonomy.index, taxonomy.file, taxonomy.abundance)]
+    return hashlib.sha256(json.dumps(taxa).encode()).hexdigest()
+
+
+def result_key(community, medium, strategy, tradeoff, **params):
+    """ Key of a result: hash of the community (see community_hash), effective medium, strategy,
+    tradeoff(s), other params and MICOM version"""
+    key = {"micom": micom.__version__,
+           "community": community,
+           "medium": sorted([r, repr(float(flux))] for r, flux in dict(medium).items()),
+           "strategy": strategy,
+           "tradeoff": tradeoff,
+           "params": params}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def result_path(cache_fp, key):
+    return os.path.join(cache_fp, key + RESULT_EXT)
+
+
+def get_result(cache_fp, key):
+    """ Cached result, or None if it is not in the cache"""
+    fp = result_path(cache_fp, key)
+    try:
+        result = read_snapshot(fp)
+        os.utime(fp) # mark as recently used
+    except (OSError, EOFError):
+        return None # not cached, or removed by another job
+    return result
+
+
+def read_size(cache_fp):
+    """ Total size of the results (in bytes) recorded in the cache, or None if it was not recorded yet"""
+    try:
+        with open(os.path.join(cache_fp, SIZE_FILE)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_size(cache_fp, size):
+    fp = os.path.join(cache_fp, SIZE_FILE)
+    tmp_fp = "%s.%i.tmp" %(fp, os.getpid())
+    with open(tmp_fp, "w") as f:
+        f.write(str(int(size)))
+    os.replace(tmp_fp, fp)
+
+
+def evict(cache_fp, max_size_mb):
+    """ Removes the least recently used results until the cache is smaller than max_size_mb.
+    Returns the size of the remaining results (in bytes)"""
+    entries = []
+    for fp in glob.glob(os.path.join(cache_fp, "*" + RESULT_EXT)):
+        try:
+            st = os.stat(fp)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, fp))
+    total = sum(e[1] for e in entries)
+    for mtime, size, fp in sorted(entries):
+        if total <= max_size_mb * 1e6:
+            break
+        try:
+            os.remove(fp)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def put_result(cache_fp, key, result, max_size_mb=None):
+    """ Adds a result to the cache, removing old results if the cache gets larger than max_size_mb"""
+    os.makedirs(cache_fp, exist_ok=True)
+    fp = result_path(cache_fp, key)
+    save_snapshot(result, fp)
+    if max_size_mb is None:
+        return
+    size = read_size(cache_fp)
+    if size is None:
+        size = evict(cache_fp, max_size_mb) # first result, or size not recorded: scan the cache once
+    else:
+        size += os.path.getsize(fp)
+        if size > max_size_mb * 1e6:
+            size = evict(cache_fp, max_size_mb * EVICT_TO)
+    write_size(cache_fp, size)
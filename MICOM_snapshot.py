@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compressed snapshots of community models, smaller and faster to read than the plain pickles
+written by micom's Community.to_pickle.
+
+A snapshot is a pickle (protocol 5, with large buffers kept out-of-band) where the pickle
+and each buffer are compressed separately:
+
+MMSNAP01 | header size | header (json: codec, compressed and raw size of each frame) | frames
+
+Compression uses pyarrow's codecs (zstd by default, or lz4), or zlib when pyarrow is not installed.
+Snapshots are not readable by micom's load_pickle, so community snapshots are saved with their own extension
+(e.g. 1_communities/SRR6784563.snap), and plain pickles keep the .pickle extension.
+load_snapshot is a drop-in replacement for micom's load_pickle that reads both, and community_path finds
+the community file of a sample whatever its format.
+
+Used by MICOM_build_comm_models.py (-fmt option), MICOM_grow_wf.py and MICOM_coop_tradeoff.py.
+See MICOM_benchmark_snapshots.py to compare sizes and load times.
+
+Works with MICOM v 0.25.1
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, json, pickle, struct, zlib
+
+MAGIC = b"MMSNAP01"
+SNAPSHOT_EXT = ".snap"
+PICKLE_EXT = ".pickle"
+HEADER_SIZE = struct.Struct("<I")
+CODECS = ["zstd", "lz4", "zlib", "none"]
+
+
+def pyarrow_codec(codec, level=None):
+    """ pyarrow codec, or None if pyarrow (or the codec) is not available"""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+    if not pa.Codec.is_available(codec):
+        return None
+    return pa.Codec(codec, compression_level=level)
+
+
+def default_codec():
+    """ zstd if available (through pyarrow), zlib otherwise"""
+    return "zstd" if pyarrow_codec("zstd") is not None else "zlib"
+
+
+def compress(frame, codec, level=None):
+    if codec == "none":
+        return bytes(frame)
+    if codec == "zlib":
+        return zlib.compress(frame, 6 if level is None else level)
+    pa_codec = pyarrow_codec(codec, level)
+    if pa_codec is None:
+        raise ValueError("Codec %s needs pyarrow (with %s support)" %(codec, codec))
+    return pa_codec.compress(frame, asbytes=True)
+
+
+def decompress(frame, raw_size, codec):
+    # bytearrays, so arrays read from the frames are writable whatever the codec (as with the pyarrow buffers)
+    if codec == "none":
+        return bytearray(frame)
+    if codec == "zlib":
+        return bytearray(zlib.decompress(frame))
+    pa_codec = pyarrow_codec(codec)
+    if pa_codec is None:
+        raise ValueError("Codec %s needs pyarrow (with %s support)" %(codec, codec))
+    return pa_codec.decompress(frame, decompressed_size=raw_size)
+
+
+def save_snapshot(obj, filename, codec=None, level=None):
+    """ Saves an object (e.g. a community) as a compressed snapshot"""
+    if codec is None:
+        codec = default_codec()
+    buffers = []
+    frames = [pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)]
+    frames += [buffer.raw() for buffer in buffers]
+    compressed = [compress(frame, codec, level) for frame in frames]
+
+    header = json.dumps({"codec": codec, "frames": [[len(c), memoryview(f).nbytes] for c, f in zip(compressed, frames)]}).encode()
+
+    # write to a temporary file first, so readers never see a half-written snapshot
+    tmp_fp = "%s.%i.tmp" %(filename, os.getpid())
+    with open(tmp_fp, "wb") as out:
+        out.write(MAGIC)
+        out.write(HEADER_SIZE.pack(len(header)))
+        out.write(header)
+        for frame in compressed:
+            out.write(frame)
+    os.replace(tmp_fp, filename)
+
+
+def is_snapshot(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_snapshot(filename):
+    """ Reads an object saved with save_snapshot, or a plain pickle"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        return pickle.loads(data)
+
+    data = memoryview(data)
+    pos = len(MAGIC)
+    header_size, = HEADER_SIZE.unpack_from(data, pos)
+    pos += HEADER_SIZE.size
+    header = json.loads(bytes(data[pos:pos + header_size]))
+    pos += header_size
+
+    frames = []
+    for compressed_size, raw_size in header["frames"]:
+        frames.append(decompress(data[pos:pos + compressed_size], raw_size, header["codec"]))
+        pos += compressed_size
+    return pickle.loads(frames[0], buffers=frames[1:])
+
+
+def load_snapshot(filename):
+    """ Drop-in replacement for micom's load_pickle (reads snapshots and plain pickles)"""
+    from micom.util import adjust_solver_config
+    com = read_snapshot(filename)
+    adjust_solver_config(com.solver)
+    return com
+
+
+def community_file(sample, fmt="snapshot"):
+    """ File name of the community of a sample (sample.snap for snapshots, sample.pickle for plain pickles)"""
+    return sample + (PICKLE_EXT if fmt == "pickle" else SNAPSHOT_EXT)
+
+
+def community_path(folder, sample):
+    """ Path to the community of a sample, saved as a snapshot or a plain pickle
+    (the most recent one if there are both)"""
+    fps = [os.path.join(folder, community_file(sample, fmt)) for fmt in ("snapshot", "pickle")]
+    fps = [fp for fp in fps if os.path.exists(fp)]
+    if len(fps) == 0:
+        raise FileNotFoundError("No community (%s or %s) found for %s in %s" %(SNAPSHOT_EXT, PICKLE_EXT, sample, folder))
+    return max(fps, key=os.path.getmtime)
+
+
+def sample_name(community_fp):
+    """ Sample of a community file (file name without the .snap or .pickle extension)"""
+    name = os.path.basename(community_fp)
+    for ext in (SNAPSHOT_EXT, PICKLE_EXT):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def save_community(com, filename, fmt="snapshot", codec=None):
+    """ Saves a community as a snapshot, or as a plain pickle (fmt="pickle", readable by micom's load_pickle).
+    See community_file for the file names."""
+    if fmt == "pickle":
+        com.to_pickle(filename)
+    else:
+        save_snapshot(com, filename, codec)
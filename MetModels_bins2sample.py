@@ -2,16 +2,26 @@
 # -*- coding: utf-8 -*-
 """
 Script to copy GEMs - one per species! - to one folder per sample,
-retaining only the TOP 30 most abundant bins in each sample.
+retaining only the TOP 30 (or -n) most abundant bins in each sample.
 also creates a table indicating to which community type each bin belongs,
+
+The top bins of all samples are found at once, ranking the whole KMA table.
+GEMs are copied to the sample folders by default (in parallel, with -t). They can also be staged as
+hardlinks (-st hardlink, falling back to copies, e.g. across file systems) or symlinks, which are faster
+and take no space, but share the file with the GEMs folder (editing a staged GEM changes the original),
+or only listed in a manifest (-st manifest, <output_folder>/GEMs_manifest.csv) without creating any file
+in the sample folders.
+
 Created on 23/3/21
 @author: V.R.Marcelino
 """
 
+import numpy as np
 import pandas as pd
 import shutil
 import os
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 
 parser = ArgumentParser()
 parser.add_argument('-kma', '--kma', help="""Path to the merged kam results at species level, produced with  0_PCAs_MAGs_species_level.R.""", required=True)
@@ -23,6 +33,12 @@ parser.add_argument('-ot', '--output_table', default = 'bins2biomes.csv',
                     help='Path to the output table indicating to which community type each bin belongs. Default = bins2biomes.csv', required=False)
 parser.add_argument('-of', '--output_folder', default = '2_DMM_GEMs',
                     help='Path to the output folder where GEMs will be stored. Default = 3_DMM_GEMs', required=False)
+parser.add_argument('-n', '--top_n', default = 30,
+                    help='Number of most abundant bins retained in each sample. Default = 30', required=False)
+parser.add_argument('-st', '--staging', default = 'copy', choices = ['copy', 'hardlink', 'symlink', 'manifest'],
+                    help='How GEMs are staged in the sample folders: copy, hardlink, symlink (links share the file with the GEMs folder), or manifest (no files, only GEMs_manifest.csv). Default = copy', required=False)
+parser.add_argument('-t', '--threads', default = 8,
+                    help='Number of parallel copies (-st copy, or hardlinks falling back to copies). Default = 8', required=False)
 
 args = parser.parse_args()
 #input
@@ -33,6 +49,9 @@ sp2bin_fp=args.sp2bin
 #output
 out_matrix = args.output_table
 community_types_fp = args.output_folder
+top_n = int(args.top_n)
+staging = args.staging
+threads = int(args.threads)
 
 #kma_res_fp = "2_ccm_otus_clean_aggregated.csv"
 #commtypes_fp = "1_sample_assignments_DMM_species.csv"
@@ -66,52 +85,76 @@ with open(sp2bin_fp) as sp:
         sp2bin[tax] = binID
 
 
-###### read and parse KMA results, keeping only the 30 most abundant bins!
+###### read and parse KMA results, keeping only the top_n most abundant bins!
 df = pd.read_csv(kma_res_fp, index_col = 0, encoding='latin1')
 df['binID'] = df.index.map(sp2bin)
 
-#identify the 30 most abundat bins in each sample, store as a dict:
 columns = df.columns.tolist()[:-1] # sample names
-top30 = {}
-for c in columns:
-    top30_df = df.nlargest(30, c)
-    selected_bins = top30_df['binID'].tolist()
-    top30[c] = selected_bins
-
-
-# flag the bins that made the top 30
-for index, row in df.iterrows():
-    for c in columns:
-        if df.at[index,c] > 0:
-            if df.at[index,'binID'] in top30[c]:
-                df.at[index,c] = comm_types[c]
-            else:
-                df.at[index, c] = 0 # remove bin from sample by giving it a zero abundance
-
+abundances = df[columns]
+
+# rank bins within each sample (ties in order of appearance, as nlargest), all samples at once
+top_n_mask = (abundances.rank(method="first", ascending=False) <= top_n).to_numpy()
+
+# a bin is kept if it made the top N of the sample (through any of its rows)
+bin_codes, binIDs = pd.factorize(df['binID'])
+top_bins = np.zeros((len(binIDs), len(columns)), dtype=bool)
+has_bin = bin_codes >= 0
+np.logical_or.at(top_bins, bin_codes[has_bin], top_n_mask[has_bin])
+in_top = np.zeros(top_n_mask.shape, dtype=bool)
+in_top[has_bin] = top_bins[bin_codes[has_bin]]
+
+# flag the bins that made the top N with the community type of the sample,
+# and remove the others from the sample by giving them a zero abundance
+present = (abundances > 0).to_numpy()
+kept = present & in_top
+sample_types = np.array([comm_types[c] if kept[:, i].any() else None for i, c in enumerate(columns)], dtype=object)
+
+flagged = abundances.to_numpy(dtype=object)
+flagged[present & ~in_top] = 0
+kept_rows, kept_cols = np.nonzero(kept)
+flagged[kept_rows, kept_cols] = sample_types[kept_cols]
+
+df = pd.DataFrame(flagged, index=df.index, columns=columns).assign(binID=df['binID'])
 pd.DataFrame.to_csv(df, out_matrix, index=True)
 
 ###### copy models to new folder
 
-# create folders:
-for sample in comm_types.keys():
-    new_dir = community_types_fp + "/" + comm_types[sample] + "/" + sample
-    if not os.path.exists(new_dir):
-        os.makedirs(new_dir)
-
-# copy models:
-for index, row in df.iterrows():
-    for c in columns:
-        assigned_bin = int(df.at[index, c])
-        if assigned_bin == 0:
-            pass
-        else:
-            bin_ID = df.at[index, 'binID']
-            sample_fp = community_types_fp + "/" + str(assigned_bin) + "/" + c + "/" + bin_ID + ".xml"
-
-            GEM_fp = GEMs_fp + "/" + bin_ID + ".xml"
-            print (sample_fp)
-            print (GEM_fp)
-            shutil.copyfile(GEM_fp, sample_fp)
+# GEMs of each sample (in the order of the table):
+staged = pd.DataFrame({"community_type": sample_types[kept_cols],
+                       "sample": np.asarray(columns, dtype=object)[kept_cols],
+                       "binID": df['binID'].to_numpy()[kept_rows]})
+staged['GEM'] = GEMs_fp + "/" + staged['binID'].astype(str) + ".xml"
+staged['sample_fp'] = community_types_fp + "/" + staged['community_type'].astype(str) + "/" + staged['sample'].astype(str) + "/" + staged['binID'].astype(str) + ".xml"
+
+if staging == "manifest":
+    manifest_fp = community_types_fp + "/GEMs_manifest.csv"
+    staged[["community_type", "sample", "binID", "GEM"]].to_csv(manifest_fp, index=False)
+    print ("%i GEMs listed in %s" %(len(staged), manifest_fp))
+
+else:
+    # create folders:
+    for sample in comm_types.keys():
+        new_dir = community_types_fp + "/" + comm_types[sample] + "/" + sample
+        if not os.path.exists(new_dir):
+            os.makedirs(new_dir)
+
+    def stage_GEM(GEM_fp, sample_fp):
+        if os.path.lexists(sample_fp) and staging != "copy":
+            os.remove(sample_fp)
+        if staging == "symlink":
+            os.symlink(os.path.abspath(GEM_fp), sample_fp)
+            return
+        if staging == "hardlink":
+            try:
+                os.link(GEM_fp, sample_fp)
+                return
+            except OSError: # e.g. GEMs in another file system
+                pass
+        shutil.copyfile(GEM_fp, sample_fp)
+
+    # stage models (copies are I/O bound, so they run in parallel threads):
+    with ThreadPool(threads) as pool:
+        pool.starmap(stage_GEM, zip(staged['GEM'], staged['sample_fp']))
+    print ("%i GEMs staged in %s (%s)" %(len(staged), community_types_fp, staging))
 
 print ("Done!")
-
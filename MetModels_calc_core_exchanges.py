@@ -6,6 +6,16 @@ Script to identify the core and accessory metabolic exchanges across samples
 
 outputs a summary of core vs. accessory metabolic exchanges across phenotypes
 
+Exchanges are read once, and several grouping headers can be given (e.g. -g HD,Diagnosis):
+the summary of each header is then saved to its own file (e.g. summary_met_exchanges_core_HD.csv).
+
+With -pc, prevalence counters are kept in the given folder and only new or changed samples are read
+(see MetModels_prevalence_counters.py).
+
+With -sw, the number and proportion of core metabolites at several thresholds (e.g. -sw 50:100:5) are derived
+from the same prevalences and saved as a tidy table (grouping x group x direction x threshold),
+e.g. summary_met_exchanges_core_sweep.csv.
+
 Created on 13 / Sep / 2021
 Modified 22 / Sep / 2021
 
@@ -14,119 +24,90 @@ Modified 22 / Sep / 2021
 
 import pandas as pd
 from argparse import ArgumentParser
-import os, glob, re
+from MetModels_exchange_store import load_exchanges
+from MetModels_exchange_analyses import (split_directions, metabolite_table, core_exchanges_summaries, core_exchanges_sweep,
+                                         core_exchanges_from_counters)
+from MetModels_prevalence_counters import update_counters, counters_sweep
+from MetModels_core_prevalence import parse_thresholds
 
 parser = ArgumentParser()
 
-parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM""", required=True)
+parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
 parser.add_argument('-c', '--core', help="""Definition of core - min percentage of samples where the edge should be present to be considered core.
                     Default = 95""", required=False, default=95)
 parser.add_argument('-m', '--metadata', help="""Path to the metadata file""",required=True )
-parser.add_argument('-g', '--grouping_header', help="""category to analyse core exchanges, must be a header in the metadata file (Diagnosis or HD)""",required=True)
+parser.add_argument('-g', '--grouping_header', help="""category to analyse core exchanges, must be a header in the metadata file (Diagnosis or HD).
+                    Several headers can be given, separated by commas""",required=True)
 parser.add_argument('-o', '--output_core', help="""file to store the summary of core met exchanges. Default = summary_met_exchanges_core.csv""", required=False, default="summary_met_exchanges_core.csv")
+parser.add_argument('-t', '--threads', help="""number of processes (one per grouping header). Default = 1""", required=False, default=1)
+parser.add_argument('-pc', '--prevalence_counters', help="""folder to keep prevalence counters, updated with new or changed samples only (optional)""", required=False, default=None)
+parser.add_argument('-sw', '--sweep', help="""core thresholds to sweep, as start:stop:step (e.g. 50:100:5) or a comma-separated list (optional)""", required=False, default=None)
 
 args = parser.parse_args()
 in_path = args.folder_w_exchange_files
 core_def = int(args.core)
 metad_fp = args.metadata
-grouping_header = args.grouping_header
+grouping_headers = args.grouping_header.split(",")
 out_file_core = args.output_core
+counters_fp = args.prevalence_counters
+threads = int(args.threads)
+thresholds = None
+if args.sweep is not None:
+    try:
+        thresholds = parse_thresholds(args.sweep)
+    except ValueError as e:
+        parser.error(str(e))
 
 #in_path = "2_exchanges"
 #core_def = 95
 #out_file_core = "summary_met_exchanges_core.csv"
 #metad_fp = "metadata_rewiring_microbiome.csv"
-#grouping_header = "HD"
-
-
-
-def core_stats(in_df, core_def):
-    """ Returns a list with:
-    Total_[production|consumption], Core_[production|consumption], Proportion_core_[production|consumption]"""
-    n_samples = len(in_df)
-    # number of individuals that must have the bin_met interaction for it to be considered core:
-    threshold = core_def * n_samples / 100
-
-    total_n_rxn = len(in_df.columns)
-    print("Total number of exchanged metabolites: %i" % (total_n_rxn))
+#grouping_headers = ["HD"]
 
-    # count non-zeros for each column
-    count_non_zeros = in_df.astype(bool).sum(axis=0)
-    wanted_edges = count_non_zeros > threshold
 
-    core_X = in_df[wanted_edges.index[wanted_edges]]
-    number_core_rxn = len(core_X.columns)
-    print("Number of metabolites being exchanged in %i%% of individuals: %i" % (core_def, number_core_rxn))
-
-    # proportion:
-    prop_core = round(number_core_rxn * 100 / total_n_rxn, 2)
-    results = [total_n_rxn, number_core_rxn, prop_core]
-
-    return (results)
-
-
-## read metadata and identify groups
-all_files = glob.glob(os.path.join(in_path, "exchanges_grow_*.csv"))
-
-replace_string = in_path + "/|exchanges_grow_|_cat|.csv"
-names_2_path_dict = {}
-for i in (all_files):
-    sample_id = re.sub(replace_string, '', i)
-    names_2_path_dict[sample_id] = i
 
+## read metadata
 metad_all_samples = pd.read_csv(metad_fp)
-metad_all_samples['file_path'] = metad_all_samples['Sample'].map(names_2_path_dict)
-metad = metad_all_samples[metad_all_samples['file_path'].notna()] # keep only metadata samples for which we have samples
-
-wanted_categories = list(set((metad[grouping_header])))
-
-#process data in batches corresponding to phenotype (or healthy/disease)
-summary_results = pd.DataFrame(["n_samples","Total_production","Core_production","Proportion_core_prod",
-"Total_consumption","Core_consumption","Proportion_core_cons"], columns=['description'])
 
-
-for cat in wanted_categories:
-    print ("\n\nProcessing %s" %(cat))
-    wanted_metad_df = metad[metad[grouping_header] == cat]
-    wanted_files = list(wanted_metad_df['file_path'])
-
-    ## merge files for each phenotype
-    df_from_each_file = (pd.read_csv(f, sep=',') for f in wanted_files)
-    df_merged = pd.concat(df_from_each_file, ignore_index=True)
-
-    ## remove media:
-    exch_df = df_merged.loc[df_merged['taxon'] != "medium"]
+if counters_fp is not None:
+    ## core exchanges from the prevalence counters (reading only new or changed samples)
+    all_summaries = {}
+    all_sweeps = []
+    for grouping_header in grouping_headers:
+        counters, totals = update_counters(in_path, counters_fp, metad_all_samples, grouping_header)
+        all_summaries[grouping_header] = core_exchanges_from_counters(counters, totals, core_def)
+        if thresholds is not None:
+            sweep = counters_sweep(counters, totals, "metabolite", thresholds)
+            sweep.insert(0, "grouping", grouping_header)
+            all_sweeps.append(sweep)
+    if thresholds is not None:
+        sweep = pd.concat(all_sweeps, ignore_index=True)
+
+else:
+    ## read exchanges (once for all grouping headers)
+    exch_df = load_exchanges(in_path, medium=False)
 
     ## separate imports and exports in different tables
-    exports_df = exch_df.loc[exch_df['direction'] == "export"]
-    imports_df = exch_df.loc[exch_df['direction'] == "import"]
-
-    ## aggregate all fluxes for each sample
-    exports_df_agg = exports_df.groupby(["sample_id","metabolite"]).agg({"flux": "sum"}).reset_index()
-    imports_df_agg = imports_df.groupby(["sample_id","metabolite"]).agg({"flux": "sum"}).reset_index()
-
-
-    ## reshape table to have sample as rows and metabolites as columns:
-    exports_df_samples_as_rows = exports_df_agg.pivot(index = "sample_id", columns="metabolite", values="flux")
-    exports_df_samples_as_rows = exports_df_samples_as_rows.fillna(0) # replace NaNs with zeros
-
-    imports_df_samples_as_rows = imports_df_agg.pivot(index = "sample_id", columns="metabolite", values="flux")
-    imports_df_samples_as_rows = imports_df_samples_as_rows.fillna(0) # replace NaNs with zeros
-
-
-    ##################################
-    ### stats on core interactions ###
-
-    print ("\nproduction:")
-    results_production = core_stats(exports_df_samples_as_rows,core_def)
-    print ("\nconsumption:")
-    results_consumption = core_stats(imports_df_samples_as_rows, core_def)
-
-    wanted_info = [len(imports_df_samples_as_rows)] + results_production + results_consumption
-    summary_results[cat] = wanted_info
-
-# save it to file:
-summary_results.to_csv(out_file_core, index=False)
-print ("\n\nSummary saved to %s" %(out_file_core))
+    exports_df, imports_df = split_directions(exch_df)
+
+    ## samples x metabolites tables (calculated once for all grouping headers)
+    exports_table, imports_table = metabolite_table(exports_df), metabolite_table(imports_df)
+
+    ## process all categories (phenotype, or healthy/disease) of each grouping header
+    all_summaries = core_exchanges_summaries(exports_table, imports_table, metad_all_samples, grouping_headers, core_def, threads)
+    if thresholds is not None:
+        sweep = core_exchanges_sweep(exports_table, imports_table, metad_all_samples, grouping_headers, thresholds)
+
+# save it to file(s):
+for grouping_header, summary_results in all_summaries.items():
+    out_fp = out_file_core
+    if len(grouping_headers) > 1:
+        out_fp = out_file_core.replace(".csv", "") + "_" + grouping_header + ".csv"
+    summary_results.to_csv(out_fp, index=False)
+    print ("\n\nSummary saved to %s" %(out_fp))
+
+if thresholds is not None:
+    out_fp = out_file_core.replace(".csv", "") + "_sweep.csv"
+    sweep.to_csv(out_fp, index=False)
+    print ("\nCore threshold sweep saved to %s" %(out_fp))
 print ("\nDone!\n")
-
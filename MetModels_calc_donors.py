@@ -18,6 +18,7 @@ Created on 5/8/21
 """
 
 from argparse import ArgumentParser
+import numpy as np
 import pandas as pd
 
 parser = ArgumentParser()
@@ -37,51 +38,43 @@ out_file = args.output
 ################################################
 ################  Functions     ################
 
-def calc_met_centrality(sampleX_df):
-# function takes as input a pd.dataframe with the exchanges within a single sample, and
-# calculates the centrality OF EACH METABOLITE
+def calc_met_centrality(df_fluxes, met_cols):
+# function takes as input a pd.dataframe with the exchanges of all samples, and
+# calculates the centrality OF EACH METABOLITE in each sample (rows = samples, columns = metabolites)
 # by counting the occurrence of negative fluxes (i.e. how many organisms uptake the metabolite).
-    centrality_dict ={}
-    for metab in sampleX_df.columns:
-        if metab.startswith("EX_"): # check if this is a metabolite:
-            number_uptakes = (sampleX_df[metab] < 0).sum()
-            if number_uptakes > 0: # if it is uptaken by any microbe, store in dict
-                centrality_dict[metab] = number_uptakes
-    return (centrality_dict)
+    return (df_fluxes[met_cols] < 0).groupby(df_fluxes['sample'], sort=False).sum()
 
 
-def calc_donor_links (sampleX_df, sample_name, health_status):
-# function takes as input a pd.dataframe with the exchanges within a single sample,
+def calc_donor_links (df_fluxes, meta_dic):
+# function takes as input a pd.dataframe with the exchanges of all samples and a dict with the health status of each sample,
 # calculates n. of donor links and the sum of centrality scores of all metabolites produced by each bin (== BIN Centrality)
+# for all bins of all samples at once (bins x metabolites matrices)
 # returns a dataframe with the info required for statistical analyses
-    df = pd.DataFrame()
-    metab_centrality = calc_met_centrality(sampleX_df)
-    count_bins = 0
-
-    for index, row in sampleX_df.iterrows():
-        binID = row['compartment']
-        count_donor_links = 0
-        calc_bin_centrality = [] # sum of links
-        calc_weighted_bin_centrality = [] # sum of links multiplied by flux
-        #count donor links:
-        for met in row.index:
-            if met in metab_centrality.keys(): # check if metabolite is consumed by other species
-                flux = row[met]
-                if flux > 0: #check if metabolite is exported (positive flux) by this bin
-                    count_donor_links += 1
-                    calc_bin_centrality.append(metab_centrality[met])
-
-                    weighted_centrality = metab_centrality[met] * flux
-                    calc_weighted_bin_centrality.append(weighted_centrality)
-
-        # calculate bin centrality and number of bins:
-        bin_centrality = sum(calc_bin_centrality)
-        weighted_bin_centrality = sum(calc_weighted_bin_centrality)
-        count_bins += 1
-        new_row = [[sample_name, binID,count_donor_links,bin_centrality, weighted_bin_centrality, health_status]]
-
-        df = df.append(new_row)
-    df['n_bins'] = count_bins
+    met_cols = [col for col in df_fluxes.columns if col.startswith("EX_")] # metabolites
+
+    # keep samples in the metadata, in the order of the metadata
+    sample_order = {sample: i for i, sample in enumerate(meta_dic)}
+    df_fluxes = df_fluxes[df_fluxes['sample'].isin(sample_order)]
+    df_fluxes = df_fluxes.iloc[np.argsort(df_fluxes['sample'].map(sample_order).values, kind="stable")]
+
+    # centrality of the metabolites of the sample of each bin:
+    metab_centrality = calc_met_centrality(df_fluxes, met_cols)
+    bin_met_centrality = metab_centrality.loc[df_fluxes['sample']].values
+    fluxes = df_fluxes[met_cols].values
+
+    # donor links: metabolites exported (positive flux) by the bin and consumed by other species
+    donor_links = (fluxes > 0) & (bin_met_centrality > 0)
+
+    df = pd.DataFrame({"sample": df_fluxes['sample'].values,
+                       "binID": df_fluxes['compartment'].values,
+                       "n_donor_links": donor_links.sum(axis=1),
+                       "bin_centrality": np.where(donor_links, bin_met_centrality, 0).sum(axis=1),
+                       "weighted_bin_centrality": np.where(donor_links, bin_met_centrality * fluxes, 0).sum(axis=1)})
+    # counts are saved as floats, as in previous versions of this script
+    df[["n_donor_links", "bin_centrality"]] = df[["n_donor_links", "bin_centrality"]].astype(float)
+
+    df['HD'] = df['sample'].map(meta_dic)
+    df['n_bins'] = df.groupby('sample')['binID'].transform('size')
     return (df)
 
 
@@ -97,21 +90,8 @@ metadata = pd.read_csv(metadata_fp, sep=',')
 # add metadata to dict:
 meta_dic = pd.Series(metadata.HD.values,index=metadata.Sample).to_dict()
 
-result_df = pd.DataFrame()
-
-## loop trough fluxes dataframe (via dict), subseting one sample for processing at a time:
-# slow - took 30sec for 42 samples
-for sample,value in meta_dic.items():
-
-    wanted_rows = df_fluxes_all.loc[df_fluxes_all['sample'] == sample]
-    health_status = value
-
-    sampleX_links = calc_donor_links(wanted_rows,sample,health_status)
-
-    result_df = result_df.append(sampleX_links)
-
-# rename columns
-result_df.columns = ["sample", "binID", "n_donor_links","bin_centrality","weighted_bin_centrality","HD","n_bins"]
+## donor links of all samples at once:
+result_df = calc_donor_links(df_fluxes_all, meta_dic)
 
 # calculate 'donor score' (n donor links X bin centrality)
 result_df['donor_score'] = result_df['n_donor_links'] * result_df['bin_centrality']
@@ -120,4 +100,3 @@ result_df['weighted_donor_score'] = result_df['n_donor_links'] * result_df['weig
 result_df.to_csv(out_file, index=False)
 
 print ("Done!")
-
@@ -10,11 +10,12 @@ Created on 27/09/21
 
 import pandas as pd
 from argparse import ArgumentParser
-import os, glob
+from MetModels_exchange_store import load_exchanges, list_samples, match_sample_prefixes
+from MetModels_network_nodes import read_lineages, network_nodes
 
 parser = ArgumentParser()
 
-parser.add_argument('-if', '--in_folder', help="""Path to the micom exchange results (e.g. 2_exchanges)""", required=True)
+parser.add_argument('-if', '--in_folder', help="""Path to the micom exchange results (e.g. 2_exchanges, or an exchange store)""", required=True)
 parser.add_argument('-s', '--samples', help="""text file indicating the prefixes of the samples to be analysed """, required=True)
 parser.add_argument('-m', '--metabolite', help="""generate nodes/edges for this specific metabolite (e.g. h2s_e). Default = all""", required=False, default="all")
 parser.add_argument('-sp', '--spp_classifications', help="""Path to tab-sep file containing binID in one column and spp classification in teh other(e.g. wanted_spp_classification.tsv)""", required=True)
@@ -43,15 +44,7 @@ sp_class = args.spp_classifications
 ### store bins2spp file into dict ###
 ####################################
 
-bins2spp_dict = {}
-with open(sp_class) as f:
-  for line in f:
-    (binID, lineage)=line.split('\t')
-    binID = binID.replace('.',"_")
-    binID_produc = binID + "_p"
-    binID_consum = binID + "_c"
-    bins2spp_dict[binID_produc]=lineage
-    bins2spp_dict[binID_consum] = lineage
+bins2lineage = read_lineages(sp_class)
 
 
 ####################################
@@ -62,27 +55,17 @@ with open(sp_class) as f:
 with open(in_samples) as f:
     samples_prefix = f.read().splitlines()
 
-wanted_samples_fp = []
-for s in samples_prefix:
-    sample_wildcard = "exchanges_grow_" + s + "*csv"
-    fp_card = os.path.join(in_folder, sample_wildcard)
-    fp = glob.glob(fp_card)
-    #check if sample was found:
-    if len(fp) > 0:
-        wanted_samples_fp.append(fp[0])
-    else:
-        print ("\n WARNING: sample %s not found. Skipping... \n" %(s))
-
-## merge exchange files
-df_from_each_file = (pd.read_csv(f, sep=',') for f in wanted_samples_fp)
-df_merged = pd.concat(df_from_each_file, ignore_index=True)
-
-## keep only wanted metabolite - if given:
+wanted_samples, not_found = match_sample_prefixes(list_samples(in_folder), samples_prefix)
+for s in not_found:
+    print ("\n WARNING: sample %s not found. Skipping... \n" %(s))
+
+## merge exchange files - reading only the wanted samples and metabolite (if given), without medium
+wanted_metabolites = None
 if metabolite != "all":
-    df_merged = df_merged[df_merged.metabolite == metabolite]
+    wanted_metabolites = [metabolite]
+exchanges_all = load_exchanges(in_folder, samples=wanted_samples, metabolites=wanted_metabolites, medium=False)
 
 ### Clean exchange table
-exchanges_all = df_merged[df_merged.taxon != 'medium'] # remove medium
 exchanges_all = exchanges_all.drop(columns=['tolerance'])
 
 
@@ -97,7 +80,7 @@ exchanges_all['flux_weighted'] = abs(exchanges_all['flux']) *  exchanges_all['ab
 
 ### group dataframe by taxon, metabolite and direction, calculating average/sum...
 # note that abundance may vary for producers and consumers (depends on their mean abundance within producers/consumers)
-exchanges = exchanges_all.groupby(["taxon","metabolite","direction"]).agg({'abundance':['mean'],'flux':['mean', 'count'], 'flux_weighted':['sum']})
+exchanges = exchanges_all.groupby(["taxon","metabolite","direction"], observed=True).agg({'abundance':['mean'],'flux':['mean', 'count'], 'flux_weighted':['sum']}).sort_index()
 exchanges.columns = ['_'.join(col) for col in exchanges.columns.values]
 exchanges.reset_index(level=('taxon','metabolite','direction'), inplace=True) # convert direction/taxon and metabolite into columns
 exchanges = exchanges.rename(columns={"flux_count": "occurrences"})
@@ -110,11 +93,11 @@ exchanges = exchanges.rename(columns={"abundance_mean": "rel_abundance_mean"})
 pd.options.mode.chained_assignment = None  # default='warn'
 
 producers = exchanges[exchanges.direction == 'export']
-producers['taxon'] = producers['taxon'] + "_p"
+producers['taxon'] = producers['taxon'].astype(str) + "_p"
 producers = producers.rename(columns={"taxon": "source", "metabolite": "target"})
 
 consumers = exchanges[exchanges.direction == 'import']
-consumers['taxon'] = consumers['taxon'] + "_c"
+consumers['taxon'] = consumers['taxon'].astype(str) + "_c"
 consumers = consumers.rename(columns={"taxon": "target", "metabolite": "source"})
 
 edges = pd.concat([producers, consumers])
@@ -124,62 +107,9 @@ edges = pd.concat([producers, consumers])
 ## format nodes ##
 ##################
 
-# get unique MAGs and Metabolites
-column_values = edges[["source", "target"]].values.ravel()
-unique_values = pd.unique(column_values)
-
-###### make dictionaries with mean abundances and etc (to determine node sizes / labels)
-producers_abund = pd.Series(producers.rel_abundance_mean.values,index=producers.source).to_dict()
-consumers_abund = pd.Series(consumers.rel_abundance_mean.values,index=consumers.target).to_dict()
-
-producers_flux_mean = pd.Series(producers.flux_mean.values,index=producers.source).to_dict()
-consumers_flux_mean = pd.Series(consumers.flux_mean.values,index=consumers.target).to_dict()
-
-producers_occurrences = pd.Series(producers.occurrences.values,index=producers.source).to_dict()
-consumers_occurrences = pd.Series(consumers.occurrences.values,index=consumers.target).to_dict()
-
-producers_flux_weighted_sum = pd.Series(producers.flux_weighted_sum.values,index=producers.source).to_dict()
-consumers_flux_weighted_sum = pd.Series(consumers.flux_weighted_sum.values,index=consumers.target).to_dict()
-
-
-
-
-# identify mags and metabolites, producers and consumers
-nodes = pd.DataFrame(unique_values, columns=["node"])
-for index, row in nodes.iterrows():
-    if "_e" in row['node']:
-        nodes.at[index,'type'] = "metab"
-        nodes.at[index,'type_numb'] = 1
-        nodes.at[index, 'lineage'] = 'metab'
-        nodes.at[index, 'species'] = 'metab'
-        nodes.at[index, 'prod_cons'] = 'metab'
-        nodes.at[index, 'rel_abundance_mean'] = 10 # random number!! - make it the largest ball!
-        nodes.at[index, 'flux_mean'] = 10 # random number!! - make it the largest ball!
-        nodes.at[index, 'occurrences'] = 10 # random number!! - make it the largest ball!
-        nodes.at[index, 'flux_weighted_sum'] = 10 # random number!! - make it the largest ball!
-
-
-    else:
-        nodes.at[index,'type'] = "mag"
-        nodes.at[index,'type_numb'] = 0
-
-        bin_id = nodes.at[index, 'node']
-        nodes.at[index, 'lineage'] = bins2spp_dict[bin_id].strip()
-        nodes.at[index, 'species'] = bins2spp_dict[bin_id].split(';s__')[1].strip()
-        if "_p" in row['node']:
-            nodes.at[index, 'prod_cons'] = 'p'
-            nodes.at[index,'rel_abundance_mean'] = producers_abund[bin_id]
-            nodes.at[index, 'flux_mean'] = producers_flux_mean[bin_id]
-            nodes.at[index, 'occurrences'] = producers_occurrences[bin_id]
-            nodes.at[index, 'flux_weighted_sum'] = producers_flux_weighted_sum[bin_id]
-        elif "_c" in row['node']:
-            nodes.at[index, 'prod_cons'] = 'c'
-            nodes.at[index, 'rel_abundance_mean'] = consumers_abund[bin_id]
-            nodes.at[index, 'flux_mean'] = consumers_flux_mean[bin_id]
-            nodes.at[index, 'occurrences'] = consumers_occurrences[bin_id]
-            nodes.at[index, 'flux_weighted_sum'] = consumers_flux_weighted_sum[bin_id]
-        else:
-            print ("\n\nCan't tell if this is a consumer or producer, check!\n\n")
+# identify mags and metabolites, producers and consumers,
+# with mean abundances and etc (to determine node sizes / labels)
+nodes = network_nodes(edges, producers, consumers, bins2lineage)
 
 ## consider adding an extra column to flag species that are both producers and consumers
 
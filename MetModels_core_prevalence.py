@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sparse sample x edge (or sample x metabolite) matrices, used to identify core and accessory
+metabolic exchanges without building dense tables.
+
+Each sample only has a small fraction of all bin x metabolite edges, so the matrices are stored in
+compressed sparse column (CSC) format. Prevalence (number of samples where the edge is present),
+core and strict core (100% of samples) edges are calculated directly from the sparse structure.
+
+Sparse matrices are saved in Matrix Market format (readable in R with Matrix::readMM),
+with the row (sample) and column (edge) names in two text files:
+    <basename>.mtx, <basename>_samples.txt, <basename>_columns.txt
+
+Core columns at many thresholds (e.g. 50 to 100%) are derived from a single prevalence pass,
+with the sorted prevalences (threshold_sweep and sweep_table).
+
+Used by MetModels_calc_core_edges.py and MetModels_calc_core_exchanges.py
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, io
+
+from MetModels_exchange_store import edge_codes, decode_edges
+
+
+def sample_matrix(exch_df, keys, key_names, values="flux"):
+    """ Returns a samples x keys sparse matrix (CSC) with the values of exch_df, plus the names of its rows and columns.
+    keys: integer code of the column of each row of exch_df (e.g. edge_codes)
+    key_names: function returning the names of an array of keys
+    Columns are sorted by name (as in a pivoted table)."""
+    unique_keys, col_idx = np.unique(np.asarray(keys), return_inverse=True)
+    col_names = pd.Index(key_names(unique_keys))
+
+    # order columns by name:
+    order = np.argsort(col_names.values, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    col_idx = rank[col_idx]
+    col_names = col_names[order]
+
+    samples = exch_df['sample_id'].cat.categories
+    row_idx = exch_df['sample_id'].cat.codes.values
+    matrix = sparse.csc_matrix((exch_df[values].values, (row_idx, col_idx)), shape=(len(samples), len(col_names)))
+    matrix.eliminate_zeros()
+
+    # keep only samples with at least one value
+    present = np.diff(matrix.tocsr().indptr) > 0
+    return matrix[present, :], pd.Index(samples[present], name="sample_id"), col_names
+
+
+def edge_matrix(exch_df, vocabulary):
+    """ samples x bin_met matrix of the fluxes (sparse version of the pivoted exchange table)"""
+    return sample_matrix(exch_df, edge_codes(exch_df), lambda k: decode_edges(k, vocabulary))
+
+
+def prevalence(matrix):
+    """ Number of samples (rows) where each column is non-zero"""
+    matrix = sparse.csc_matrix(matrix)
+    matrix.eliminate_zeros()
+    return np.diff(matrix.indptr)
+
+
+def core_columns(counts, n_samples, core_def):
+    """ Boolean mask of the columns present in more than core_def % of the samples"""
+    threshold = core_def * n_samples / 100
+    return counts > threshold
+
+
+def strict_core_columns(counts, n_samples):
+    """ Boolean mask of the columns present in all samples"""
+    return counts == n_samples
+
+
+def parse_thresholds(thresholds):
+    """ Core thresholds (% of samples) from a string: a range 'start:stop:step' (including stop), or a comma-separated list.
+    Raises ValueError with a message for the command line if the string is not valid"""
+    usage = "core thresholds must be start:stop:step (e.g. 50:100:5) or a comma-separated list (e.g. 50,90,95), got '%s'" %(thresholds)
+    try:
+        if ":" in thresholds:
+            start, stop, step = [float(t) for t in thresholds.split(":")]
+            if step <= 0 or stop < start:
+                raise ValueError
+            values = list(np.arange(start, stop + step / 2, step))
+        else:
+            values = [float(t) for t in thresholds.split(",")]
+    except ValueError:
+        raise ValueError(usage) from None
+    if any(t < 0 or t > 100 for t in values):
+        raise ValueError("core thresholds are %% of samples, between 0 and 100, got '%s'" %(thresholds))
+    return values
+
+
+def threshold_sweep(counts, n_samples, thresholds):
+    """ Number of columns present in more than threshold % of the samples, for each threshold,
+    from the sorted prevalences (same definition of core as core_columns)"""
+    sorted_counts = np.sort(np.asarray(counts))
+    limits = np.asarray(thresholds, dtype=float) * n_samples / 100
+    return len(sorted_counts) - np.searchsorted(sorted_counts, limits, side="right")
+
+
+def sweep_table(counts, n_samples, total, thresholds, **labels):
+    """ Tidy table with the number and proportion of core columns at each threshold.
+    labels (e.g. group, direction) are added as columns"""
+    n_core = threshold_sweep(counts, n_samples, thresholds)
+    sweep = pd.DataFrame({"threshold": thresholds, "n_samples": n_samples, "total": total, "n_core": n_core})
+    sweep["proportion_core"] = (sweep["n_core"] * 100 / total).round(2) if total > 0 else 0.0
+    for col, value in reversed(list(labels.items())):
+        sweep.insert(0, col, value)
+    return sweep
+
+
+def to_dataframe(matrix, samples, columns):
+    return pd.DataFrame(matrix.toarray(), index=samples, columns=columns)
+
+
+def write_dense_csv(matrix, samples, columns, out_fp, chunk_rows=500):
+    """ Writes the sparse matrix as a dense csv (same as a pivoted table), a few rows at a time"""
+    matrix = sparse.csr_matrix(matrix)
+    for start in range(0, max(matrix.shape[0], 1), chunk_rows):
+        chunk = to_dataframe(matrix[start:start + chunk_rows, :], samples[start:start + chunk_rows], columns)
+        chunk.to_csv(out_fp, mode="w" if start == 0 else "a", header=(start == 0), index=True)
+
+
+def save_sparse(matrix, samples, columns, basename):
+    """ Saves the sparse matrix in Matrix Market format, with sample and column names in text files"""
+    io.mmwrite(basename + ".mtx", sparse.coo_matrix(matrix))
+    pd.Series(samples).to_csv(basename + "_samples.txt", index=False, header=False)
+    pd.Series(columns).to_csv(basename + "_columns.txt", index=False, header=False)
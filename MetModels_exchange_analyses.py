@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Analyses of the metabolic exchanges produced by MICOM_grow_wf.py, as functions that work on
+already loaded (and already split) exchange tables.
+
+They are used by the individual scripts (MetModels_calc_core_edges.py, MetModels_calc_core_exchanges.py,
+MetModels_summarize_net_produc.py, MetModels_producers_consumers_per_rxn.py and
+MetModels_summarize_total_produc_consump.py) and by MetModels_run_exchange_analyses.py,
+which loads the exchanges once and runs several analyses from the same tables.
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+from MetModels_exchange_store import load_exchanges, list_samples, resolve_store, trim_categories, exchange_vocabulary, normalise_sample_ids
+from MetModels_core_prevalence import edge_matrix, prevalence, core_columns, strict_core_columns, to_dataframe, write_dense_csv, save_sparse, sweep_table
+from MetModels_prevalence_counters import core_counts, core_items, counters_sweep
+
+
+def split_medium(exch_df):
+    """ Returns the exchanges between taxa (non-medium rows) and the medium rows"""
+    is_medium = exch_df['taxon'] == "medium"
+    return trim_categories(exch_df.loc[~is_medium]), trim_categories(exch_df.loc[is_medium])
+
+
+def split_directions(exch_df):
+    """ Returns the export and import rows"""
+    exports_df = trim_categories(exch_df.loc[exch_df['direction'] == "export"])
+    imports_df = trim_categories(exch_df.loc[exch_df['direction'] == "import"])
+    return exports_df, imports_df
+
+
+def sample_metabolite_table(exch_df, values):
+    """ reshape table to have sample as rows and metabolites as columns"""
+    table = exch_df.pivot(index = "sample_id", columns="metabolite", values=values)
+    return table.fillna(0) # replace NaNs with zeros
+
+
+def metabolite_flux_sums(exch_df):
+    """ aggregate all fluxes of each metabolite for each sample"""
+    return exch_df.groupby(["sample_id","metabolite"], observed=True).agg({"flux": "sum"}).reset_index()
+
+
+##################################
+######## core edges (MetModels_calc_core_edges.py)
+
+def core_edge_stats(in_matrix, samples, edges, core_def, out_file_core):
+    n_samples = in_matrix.shape[0]
+
+    total_n_rxn = in_matrix.shape[1]
+    print("Total number of species x metabolite exchanges (edges of the interactome): %i" %(total_n_rxn))
+
+    # count non-zeros for each column, keeping edges found in more than core_def % of individuals
+    count_non_zeros = prevalence(in_matrix)
+    wanted_edges = core_columns(count_non_zeros, n_samples, core_def)
+
+    core_X = to_dataframe(in_matrix[:, wanted_edges], samples, edges[wanted_edges])
+    print ("Number of edges found in %i%% of individuals: %i" %(core_def, len(core_X.columns)))
+    core_X.to_csv(out_file_core)
+
+    ### strict core  (100% of individuals)
+    core_100 = strict_core_columns(count_non_zeros, n_samples)
+    print ("Number of edges found in 100%% of individuals: %i" %(core_100.sum()))
+    return count_non_zeros
+
+
+def core_edges(exports_df, imports_df, core_def, out_file_all_exports, out_file_all_imports, out_file_core, thresholds=None):
+    """ Saves the sample x edge tables of exports and imports (dense csv and sparse .mtx), and the core edges.
+    If thresholds are given, the number of core edges at each threshold is saved to <out_file_core>_sweep.csv"""
+    ## sparse matrices with samples as rows and source_target (bin_met) as columns.
+    # edges are integer codes, decoded to binID_metabolite names only when saving
+    exports_matrix, exports_samples, exports_edges = edge_matrix(exports_df, exchange_vocabulary(exports_df))
+    imports_matrix, imports_samples, imports_edges = edge_matrix(imports_df, exchange_vocabulary(imports_df))
+
+    ## save entire table to file (dense csv, and sparse matrix files)
+    write_dense_csv(exports_matrix, exports_samples, exports_edges, out_file_all_exports)
+    write_dense_csv(imports_matrix, imports_samples, imports_edges, out_file_all_imports)
+
+    save_sparse(exports_matrix, exports_samples, exports_edges, out_file_all_exports.replace(".csv", ""))
+    save_sparse(imports_matrix, imports_samples, imports_edges, out_file_all_imports.replace(".csv", ""))
+
+    # run core stats for exports and imports
+    print ("\nStats for export reactions:")
+    exports_counts = core_edge_stats(exports_matrix, exports_samples, exports_edges, core_def, out_file_core + "_exports.csv")
+
+    print ("\nStats for import reactions:")
+    imports_counts = core_edge_stats(imports_matrix, imports_samples, imports_edges, core_def, out_file_core + "_imports.csv")
+
+    if thresholds is not None:
+        # core edges at each threshold, from the same prevalences
+        sweep = pd.concat([sweep_table(exports_counts, exports_matrix.shape[0], exports_matrix.shape[1], thresholds, group="all", direction="export"),
+                           sweep_table(imports_counts, imports_matrix.shape[0], imports_matrix.shape[1], thresholds, group="all", direction="import")],
+                          ignore_index=True)
+        write_sweep(sweep, out_file_core + "_sweep.csv")
+
+
+def write_sweep(sweep, out_fp):
+    sweep.to_csv(out_fp, index=False)
+    print ("\nCore threshold sweep saved to %s" %(out_fp))
+
+
+def core_edges_from_counters(counters, totals, core_def, out_file_core, thresholds=None):
+    """ Prints the core edge stats from the prevalence counters (see MetModels_prevalence_counters.py),
+    and saves the core edges of each direction with their prevalence (and the threshold sweep, as in core_edges)"""
+    counts = core_counts(counters, totals, "edge", core_def).set_index("direction")
+    all_core = core_items(counters, totals, "edge", core_def)
+    for direction, suffix in (("export", "_exports.csv"), ("import", "_imports.csv")):
+        print ("\nStats for %s reactions:" %(direction))
+        if direction not in counts.index:
+            print ("No %s reactions found" %(direction))
+            continue
+        print("Total number of species x metabolite exchanges (edges of the interactome): %i" %(counts.at[direction, "total"]))
+        print ("Number of edges found in %i%% of individuals: %i" %(core_def, counts.at[direction, "core"]))
+        print ("Number of edges found in 100%% of individuals: %i" %(counts.at[direction, "strict_core"]))
+
+        core = all_core.loc[all_core["direction"] == direction, ["item", "n_nonzero", "n_samples", "prevalence"]]
+        core.rename(columns={"item": "edge"}).to_csv(out_file_core + suffix, index=False)
+
+    if thresholds is not None:
+        write_sweep(counters_sweep(counters, totals, "edge", thresholds), out_file_core + "_sweep.csv")
+
+
+##################################
+######## core exchanges at the metabolite level (MetModels_calc_core_exchanges.py)
+
+SUMMARY_ROWS = ["n_samples","Total_production","Core_production","Proportion_core_prod",
+                "Total_consumption","Core_consumption","Proportion_core_cons"]
+
+
+def metabolite_table(exch_df):
+    """ samples x metabolites table of the fluxes summed per sample (without the "_cat" in sample names),
+    with NaN where the metabolite is not exchanged in the sample"""
+    table = metabolite_flux_sums(normalise_sample_ids(exch_df)).pivot(index="sample_id", columns="metabolite", values="flux")
+    table.index = table.index.astype(str)
+    return table
+
+
+def sample_groups(metad_all_samples, grouping_header):
+    """ category of each sample (indexed by sample, for joins with the sample x metabolite tables)"""
+    return metad_all_samples.drop_duplicates('Sample').set_index('Sample')[grouping_header]
+
+
+def group_prevalence(table, groups):
+    """ Returns the number of samples of each group where each metabolite is exchanged (listed),
+    and exchanged with a non-zero flux, from a samples x metabolites table (all groups at once)"""
+    groups = groups.reindex(table.index) # indexed join of the metadata
+    table, groups = table[groups.notna()], groups[groups.notna()]
+
+    listed = table.notna().groupby(groups).sum() # metabolites exchanged in each sample of the group
+    nonzero = (table.fillna(0) != 0).groupby(groups).sum()
+    n_samples = groups.value_counts().reindex(listed.index)
+    return listed, nonzero, n_samples
+
+
+def group_core_counts(table, groups, core_def):
+    """ Returns the number of samples, and the total and core number of exchanged metabolites of each group"""
+    listed, nonzero, n_samples = group_prevalence(table, groups)
+
+    # number of individuals that must have the metabolite exchanged for it to be considered core:
+    threshold = core_def * n_samples / 100
+    return pd.DataFrame({"n_samples": n_samples,
+                         "total": (listed > 0).sum(axis=1),
+                         "core": nonzero.gt(threshold, axis=0).sum(axis=1)})
+
+
+def summary_table(production, consumption):
+    """ Summary (SUMMARY_ROWS) of each category, from the number of samples, and the total and core number
+    of exchanged metabolites of each category for production and consumption (indexed by category, in the same order)"""
+    summary_results = pd.DataFrame(SUMMARY_ROWS, columns=['description'])
+    for cat in production.index:
+        wanted_info = [int(consumption.at[cat, "n_samples"])]
+        for counts in (production, consumption):
+            total_n_rxn, number_core_rxn = int(counts.at[cat, "total"]), int(counts.at[cat, "core"])
+            prop_core = round(number_core_rxn * 100 / total_n_rxn, 2) if total_n_rxn > 0 else 0
+            wanted_info += [total_n_rxn, number_core_rxn, prop_core]
+        summary_results[cat] = wanted_info
+    return summary_results
+
+
+def group_summary(exports_table, imports_table, groups, core_def):
+    """ Summary of core vs. accessory exchanged metabolites for each category of a grouping"""
+    production = group_core_counts(exports_table, groups, core_def)
+    consumption = group_core_counts(imports_table, groups, core_def)
+    categories = sorted(set(production.index) | set(consumption.index), key=str)
+    return summary_table(production.reindex(categories).fillna(0), consumption.reindex(categories).fillna(0))
+
+
+def print_summary(summary_results, core_def):
+    summary = summary_results.set_index("description")
+    for cat in summary.columns:
+        print ("\n\nProcessing %s" %(cat))
+        for label, total, core in (("production", "Total_production", "Core_production"), ("consumption", "Total_consumption", "Core_consumption")):
+            print ("\n%s:" %(label))
+            print("Total number of exchanged metabolites: %i" % (summary.at[total, cat]))
+            print("Number of metabolites being exchanged in %i%% of individuals: %i" % (core_def, summary.at[core, cat]))
+
+
+def group_sweep(exports_table, imports_table, groups, thresholds):
+    """ Tidy table with the number and proportion of core metabolites of each category of a grouping
+    at each threshold (production = exports, consumption = imports)"""
+    prevalences = {"export": group_prevalence(exports_table, groups), "import": group_prevalence(imports_table, groups)}
+    categories = sorted(set(prevalences["export"][0].index) | set(prevalences["import"][0].index), key=str)
+
+    all_sweeps = []
+    for cat in categories:
+        for direction, (listed, nonzero, n_samples) in prevalences.items():
+            if cat not in listed.index:
+                continue
+            exchanged = listed.loc[cat] > 0
+            all_sweeps.append(sweep_table(nonzero.loc[cat, exchanged], int(n_samples[cat]), int(exchanged.sum()), thresholds,
+                                          group=cat, direction=direction))
+    return pd.concat(all_sweeps, ignore_index=True)
+
+
+def core_exchanges_sweep(exports_table, imports_table, metad_all_samples, grouping_headers, thresholds):
+    """ Tidy table (grouping x group x direction x threshold) with the number and proportion of core metabolites,
+    from the samples x metabolites tables (see metabolite_table)"""
+    all_sweeps = []
+    for header in grouping_headers:
+        sweep = group_sweep(exports_table, imports_table, sample_groups(metad_all_samples, header), thresholds)
+        sweep.insert(0, "grouping", header)
+        all_sweeps.append(sweep)
+    return pd.concat(all_sweeps, ignore_index=True)
+
+
+def core_exchanges_summaries(exports_table, imports_table, metad_all_samples, grouping_headers, core_def, threads=1):
+    """ Returns a dict with the summary of core vs. accessory exchanged metabolites for each grouping header.
+    Metabolite sums per sample are calculated once (see metabolite_table), and each grouping is joined to the same tables
+    (groupings are processed in parallel if threads > 1)"""
+    tasks = [(exports_table, imports_table, sample_groups(metad_all_samples, header), core_def) for header in grouping_headers]
+
+    if threads > 1 and len(tasks) > 1:
+        with Pool(min(threads, len(tasks))) as pool:
+            summaries = pool.starmap(group_summary, tasks)
+    else:
+        summaries = [group_summary(*task) for task in tasks]
+
+    for header, summary_results in zip(grouping_headers, summaries):
+        print ("\n\n#### %s" %(header))
+        print_summary(summary_results, core_def)
+    return dict(zip(grouping_headers, summaries))
+
+
+def core_exchanges_summary(exports_df, imports_df, metad_all_samples, grouping_header, core_def):
+    """ Returns the summary of core vs. accessory exchanged metabolites for each category of grouping_header"""
+    return core_exchanges_summaries(metabolite_table(exports_df), metabolite_table(imports_df), metad_all_samples,
+                                    [grouping_header], core_def)[grouping_header]
+
+
+def core_exchanges_from_counters(counters, totals, core_def):
+    """ Same summary as core_exchanges_summary, from the prevalence counters (see MetModels_prevalence_counters.py)"""
+    counts = core_counts(counters, totals, "metabolite", core_def)
+    categories = sorted(counts["group"].unique())
+    production, consumption = [counts[counts["direction"] == direction].set_index("group").reindex(categories).fillna(0)
+                               for direction in ("export", "import")]
+    summary_results = summary_table(production, consumption)
+    print_summary(summary_results, core_def)
+    return summary_results
+
+
+##################################
+######## net production (MetModels_summarize_net_produc.py)
+
+def net_production(media_rows):
+    """ sample x metabolite table of the exchanges with the medium"""
+    return sample_metabolite_table(media_rows, "flux")
+
+
+##################################
+######## producers and consumers (MetModels_producers_consumers_per_rxn.py)
+
+def ordered_group_sums(values, group_codes, n_groups):
+    """ Sum of the values of each group, adding the rows one at a time in their order in the table
+    (as python's sum over each group), so sums do not depend on the summation algorithm of pandas"""
+    values = np.asarray(values, dtype="float64")
+    group_codes = np.asarray(group_codes, dtype="int64")
+    sums = np.zeros(n_groups)
+    if len(values) == 0:
+        return sums
+
+    # position of each row within its group
+    by_group = np.argsort(group_codes, kind="stable")
+    group_starts = np.searchsorted(group_codes[by_group], np.arange(n_groups))
+    position = np.empty(len(values), dtype="int64")
+    position[by_group] = np.arange(len(values)) - group_starts[group_codes[by_group]]
+
+    # add the first row of every group, then the second one, and so on
+    by_position = np.argsort(position, kind="stable")
+    position_starts = np.searchsorted(position[by_position], np.arange(position.max() + 2))
+    for start, end in zip(position_starts[:-1], position_starts[1:]):
+        rows = by_position[start:end]
+        sums[group_codes[rows]] += values[rows]
+    return sums
+
+
+def producers_consumers(exch_df):
+    """ Returns the number of producers and consumers of each metabolite in each sample, and the sum of their fluxes"""
+    ## separate consumption and production fluxes into two columns:
+    mask = exch_df['flux'] < 0
+    flux_production = exch_df['flux'].mask(mask).fillna(0).astype(float) # replace NaNs with zeros
+    flux_consumption = exch_df['flux'].mask(~mask).fillna(0).astype(float)
+    sign_split = pd.DataFrame({"sample_id": exch_df['sample_id'], "metabolite": exch_df['metabolite'],
+                               "is_producer": flux_production != 0, "flux_production": flux_production,
+                               "is_consumer": flux_consumption != 0, "flux_consumption": flux_consumption})
+
+    # calculate number of producers/consumers per metabolite, and the sum of their fluxes (single pass):
+    grouped = sign_split.groupby(["sample_id", "metabolite"], observed=True)
+    prod_con_summary = grouped.agg(n_producers=("is_producer", "sum"), n_consumers=("is_consumer", "sum"))
+    group_codes = grouped.ngroup().values
+    prod_con_summary.insert(1, "flux_producers", ordered_group_sums(flux_production, group_codes, grouped.ngroups))
+    prod_con_summary["flux_consumers"] = ordered_group_sums(flux_consumption, group_codes, grouped.ngroups)
+    prod_con_summary = prod_con_summary.sort_index()
+
+    # remove metabolites that are not consumed by anyone:
+    prod_con_summary = prod_con_summary[prod_con_summary['n_consumers'] > 0]
+    return prod_con_summary
+
+
+def shard_producers_consumers(in_path, samples):
+    """ producers_consumers of a shard of samples (read from in_path, removing media)"""
+    return producers_consumers(load_exchanges(in_path, samples=samples, medium=False, cache=False))
+
+
+def parallel_producers_consumers(in_path, threads, shard_size=None):
+    """ producers_consumers of all samples, processing shards of samples in parallel
+    (samples are independent, so the results of each shard are just concatenated)"""
+    in_path = resolve_store(in_path)
+    all_samples = list_samples(in_path, cache=False)
+    if shard_size is None:
+        shard_size = max(1, -(-len(all_samples) // (threads * 4))) # a few shards per process
+    shards = [all_samples[i:i + shard_size] for i in range(0, len(all_samples), shard_size)]
+
+    with Pool(threads) as pool:
+        results = pool.starmap(shard_producers_consumers, [(in_path, shard) for shard in shards])
+    results = [r for r in results if len(r) > 0]
+    return pd.concat(results)
+
+
+##################################
+######## total production and consumption (MetModels_summarize_total_produc_consump.py)
+
+def read_kma_abundances(kma_res_fp):
+    """ read KMA results (aggregated @ species level), returning the absolute abundance of each sample/taxon"""
+    kma_df = pd.read_csv(kma_res_fp,index_col = 0, encoding='latin1')
+    kma_columns = kma_df.stack().reset_index().rename(columns={'level_0':'rep_bin','level_1':'Sample', 0:'Abs_abundance'})
+    return kma_columns
+
+
+def weighted_flux_table(exch_df, kma_columns):
+    """ sample x metabolite table of fluxes corrected for absolute abundances"""
+    ## Add absolute abundance:
+    exch_w_abs_abund = pd.merge(exch_df, kma_columns,  how='left', left_on=['taxon','sample_id'], right_on = ['rep_bin','Sample'])
+
+    ## calculated product/consump corrected for absolute abundances:
+    exch_w_abs_abund['flux_weighted'] = exch_w_abs_abund['flux'] * exch_w_abs_abund['Abs_abundance']
+
+    # reshape table to have sample as rows and metab as columns:
+    table = exch_w_abs_abund.pivot_table(index = "sample_id", columns="metabolite", values="flux_weighted", aggfunc='sum', observed=True)
+    return table.fillna(0) # replace NaNs with zeros
+
+
+def total_production_consumption(exports_df, imports_df, kma_columns):
+    """ Returns the total production and the total consumption tables"""
+    return weighted_flux_table(exports_df, kma_columns), weighted_flux_table(imports_df, kma_columns)
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar store for the metabolic exchanges produced by MICOM_grow_wf.py,
+and the loader used by the MetModels_* scripts to read them.
+
+The store is a parquet dataset partitioned by sample (one zstd-compressed file per sample):
+    2_exchanges_store/sample_id=<sample>/exchanges.parquet
+
+Columns are typed: taxon, metabolite, reaction and sample_id are categorical,
+flux, abundance and tolerance are float64 (as read from the csv files, so results do not change
+with the input format), and direction is a categorical with the two possible values (import / export).
+Stores can be written with float32 fluxes to halve their size (-fp 32), at the cost of ~1e-7 relative
+precision; these are read back as float64.
+
+load_exchanges() reads either a store or a folder containing the exchanges_grow_*.csv files,
+and returns the same typed table in both cases.
+
+Filters (samples, metabolites, taxa, direction and medium vs. non-medium rows) are applied while reading:
+only the wanted sample partitions are opened, and the other filters are pushed down to the parquet reader
+(or applied to each chunk of the csv files), so memory is proportional to the matching rows.
+e.g. load_exchanges("2_exchanges", metabolites=["h2s_e"], medium=False)
+
+Identifiers are kept as integer codes (the categorical columns) all the way through the analyses:
+exchange_vocabulary() returns the identifiers behind the codes, edge_codes() encodes taxon x metabolite
+edges (the 'bin_met' of the core edge analyses) as integer pairs, and decode_edges() converts them back
+to names when writing the outputs. Sample ids can be normalised (without "_cat") while loading.
+
+iter_exchanges() takes the same arguments as load_exchanges(), but yields one sample at a time,
+for analyses where memory should not grow with the number of samples.
+
+When reading a folder of csv files, a cache store is kept in <folder>/.exchange_cache, together with the
+size, modification time and hash of each csv file (fingerprints.csv). Only new or changed files are parsed again,
+and samples whose files were removed are evicted from the cache. Note that the cache is written inside the
+exchange folder: it is skipped when the folder is not writable, and can be removed at any time (or not used,
+by converting the folder to a store, see below). Caches written by an older version of this script are rebuilt.
+sample_fingerprints() returns the size and modification time of the exchanges of each sample, so that
+results computed per sample (e.g. the prevalence counters in MetModels_prevalence_counters.py) can be updated incrementally.
+
+To convert a folder of exchanges_grow_*.csv files into a store:
+python3 MetModels_exchange_store.py -f 2_exchanges -o 2_exchanges_store
+
+Requires pyarrow for the store (reading csv files works without it).
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, glob, shutil, hashlib
+from urllib.parse import quote, unquote
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+
+
+DIRECTION = pd.CategoricalDtype(["import", "export"])
+
+# dtypes of the exchange tables, in the order produced by MICOM's grow workflow:
+EXCHANGE_DTYPES = {"taxon": "category",
+                   "sample_id": "category",
+                   "tolerance": "float64",
+                   "reaction": "category",
+                   "flux": "float64",
+                   "abundance": "float64",
+                   "metabolite": "category",
+                   "direction": DIRECTION}
+FLOAT_COLUMNS = [col for col, dtype in EXCHANGE_DTYPES.items() if dtype == "float64"]
+# ids read as strings, so ids that look like numbers (e.g. sample 0012) are kept as they are
+STRING_COLUMNS = ["sample_id", "taxon", "reaction", "metabolite"]
+
+STORE_FILE = "exchanges.parquet"
+CACHE_FOLDER = ".exchange_cache"
+FINGERPRINTS_FILE = "fingerprints.csv"
+CACHE_VERSION_FILE = "version.txt"
+CACHE_VERSION = "3" # 2: float64 columns, 3: ids read as strings
+ITER_BATCH_SIZE = 50 # store partitions read at once by iter_exchanges
+
+
+def format_exchanges(exch_df):
+    """ Returns the exchange table with typed columns (in the grow workflow order), dropping the csv index column"""
+    if 'Unnamed: 0' in exch_df.columns:
+        exch_df = exch_df.drop(columns=['Unnamed: 0'])
+    wanted_columns = [col for col in EXCHANGE_DTYPES if col in exch_df.columns]
+    wanted_columns += [col for col in exch_df.columns if col not in EXCHANGE_DTYPES]
+    if list(exch_df.columns) != wanted_columns:
+        exch_df = exch_df[wanted_columns]
+
+    # only convert the columns that are not typed yet (e.g. store partitions are mostly typed already)
+    wanted_dtypes = {col: dtype for col, dtype in EXCHANGE_DTYPES.items() if col in exch_df.columns and exch_df[col].dtype != dtype}
+    if len(wanted_dtypes) > 0:
+        exch_df = exch_df.astype(wanted_dtypes)
+
+    # sorted categories, so the integer codes do not depend on the order in which files were read
+    for col in exch_df.select_dtypes("category").columns:
+        if col != "direction" and not exch_df[col].cat.categories.is_monotonic_increasing:
+            exch_df[col] = exch_df[col].cat.reorder_categories(sorted(exch_df[col].cat.categories))
+    return exch_df
+
+
+def trim_categories(exch_df):
+    """ Removes the categories that are no longer used after filtering the exchange table
+    (so samples, taxa or metabolites that were filtered out do not reappear in groupbys and pivots)"""
+    exch_df = exch_df.copy()
+    for col in exch_df.select_dtypes("category").columns:
+        if col != "direction":
+            exch_df[col] = exch_df[col].cat.remove_unused_categories()
+    return exch_df
+
+
+def is_store(in_path):
+    """ True if in_path is an exchange store (i.e. contains sample_id=xxx partitions)"""
+    return len(glob.glob(os.path.join(in_path, "sample_id=*"))) > 0
+
+
+def partition_path(store_fp, sample):
+    return os.path.join(store_fp, "sample_id=" + quote(str(sample), safe=''))
+
+
+def write_exchanges(exch_df, store_fp, float_dtype="float64"):
+    """ Appends the exchanges to the store, one partition per sample.
+    Samples already in the store are overwritten, so re-running a sample is safe.
+    float_dtype="float32" stores smaller (but less precise) fluxes, abundances and tolerances."""
+    exch_df = format_exchanges(exch_df)
+    if float_dtype != "float64":
+        exch_df = exch_df.astype({col: float_dtype for col in FLOAT_COLUMNS if col in exch_df.columns})
+    for sample, sample_df in exch_df.groupby("sample_id", observed=True):
+        sample_dir = partition_path(store_fp, sample)
+        os.makedirs(sample_dir, exist_ok=True)
+
+        # the sample_id is stored in the folder name (hive partitioning), not in the file:
+        sample_df = trim_categories(sample_df.drop(columns=["sample_id"]).reset_index(drop=True))
+
+        # write to a temporary file first, so readers never see a half-written partition
+        out_fp = os.path.join(sample_dir, STORE_FILE)
+        tmp_fp = "%s.%i.tmp" %(out_fp, os.getpid())
+        sample_df.to_parquet(tmp_fp, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp_fp, out_fp)
+
+
+def store_samples(store_fp):
+    """ Returns the list of samples stored in the exchange store"""
+    return [partition_sample(fp) for fp in store_files(store_fp)]
+
+
+def store_files(store_fp):
+    return sorted(glob.glob(os.path.join(store_fp, "sample_id=*", STORE_FILE)))
+
+
+def partition_sample(partition_fp):
+    sample_dir = os.path.basename(os.path.dirname(partition_fp))
+    return unquote(sample_dir.split("sample_id=", 1)[1])
+
+
+def exchange_files(in_path):
+    """ Returns the exchanges_grow_*.csv files in a folder"""
+    return sorted(glob.glob(os.path.join(in_path, "exchanges_grow_*.csv")))
+
+
+def read_exchange_csv(csv_fp, columns=None, chunksize=None):
+    """ Reads one exchanges_grow_*.csv file (or an iterator of chunks, if chunksize is given)"""
+    dtypes = {col: "float64" for col in FLOAT_COLUMNS}
+    dtypes.update({col: str for col in STRING_COLUMNS})
+    if columns is not None:
+        exch_df = pd.read_csv(csv_fp, sep=',', dtype=dtypes, usecols=lambda c: c in columns, chunksize=chunksize)
+    else:
+        exch_df = pd.read_csv(csv_fp, sep=',', dtype=dtypes, chunksize=chunksize)
+    return exch_df
+
+
+def cache_available(in_path):
+    """ The cache needs pyarrow and a writable exchange folder"""
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return os.access(in_path, os.W_OK)
+
+
+def file_hash(fp):
+    """ sha1 of the file content"""
+    sha1 = hashlib.sha1()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_fingerprints(cache_fp):
+    fingerprints_fp = os.path.join(cache_fp, FINGERPRINTS_FILE)
+    if not os.path.exists(fingerprints_fp):
+        return {}
+    fingerprints = pd.read_csv(fingerprints_fp, dtype={"samples": str}, keep_default_na=False)
+    return {row.file: row._asdict() for row in fingerprints.itertuples(index=False)}
+
+
+def write_fingerprints(fingerprints, cache_fp):
+    fingerprints_fp = os.path.join(cache_fp, FINGERPRINTS_FILE)
+    fingerprints_df = pd.DataFrame(list(fingerprints.values()), columns=["file", "size", "mtime_ns", "sha1", "samples"])
+    tmp_fp = "%s.%i.tmp" %(fingerprints_fp, os.getpid())
+    fingerprints_df.to_csv(tmp_fp, index=False)
+    os.replace(tmp_fp, fingerprints_fp)
+
+
+def check_cache_version(cache_fp):
+    """ Removes caches written by older versions (e.g. with float32 fluxes), so they are rebuilt"""
+    version_fp = os.path.join(cache_fp, CACHE_VERSION_FILE)
+    if os.path.exists(version_fp):
+        with open(version_fp) as f:
+            if f.read().strip() == CACHE_VERSION:
+                return
+    if os.path.exists(cache_fp):
+        shutil.rmtree(cache_fp, ignore_errors=True)
+    os.makedirs(cache_fp, exist_ok=True)
+    tmp_fp = "%s.%i.tmp" %(version_fp, os.getpid())
+    with open(tmp_fp, "w") as f:
+        f.write(CACHE_VERSION + "\n")
+    os.replace(tmp_fp, version_fp)
+
+
+def evict_samples(samples, cache_fp):
+    for sample in samples.split(";"):
+        if sample != "":
+            shutil.rmtree(partition_path(cache_fp, sample), ignore_errors=True)
+
+
+def refresh_cache(in_path, cache_fp=None):
+    """ Updates the cache store of a folder of exchanges_grow_*.csv files,
+    parsing only new or changed files and evicting the samples of removed files.
+    Returns the path to the cache store."""
+    if cache_fp is None:
+        cache_fp = os.path.join(in_path, CACHE_FOLDER)
+    check_cache_version(cache_fp)
+
+    fingerprints = read_fingerprints(cache_fp)
+    all_files = {os.path.basename(f): f for f in exchange_files(in_path)}
+
+    # evict removed files
+    removed_files = [f for f in fingerprints if f not in all_files]
+    for f in removed_files:
+        evict_samples(fingerprints.pop(f)["samples"], cache_fp)
+
+    n_parsed = 0
+    for f, fp in all_files.items():
+        stat = os.stat(fp)
+        old = fingerprints.get(f)
+        # size and mtime unchanged - no need to hash the file:
+        if old is not None and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+            continue
+
+        sha1 = file_hash(fp)
+        if old is not None and old["sha1"] == sha1: # touched but not changed
+            fingerprints[f] = dict(old, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            continue
+
+        # new or changed file:
+        if old is not None:
+            evict_samples(old["samples"], cache_fp)
+        exch_df = read_exchange_csv(fp)
+        write_exchanges(exch_df, cache_fp)
+        samples = ";".join(sorted(exch_df["sample_id"].astype(str).unique()))
+        fingerprints[f] = {"file": f, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1, "samples": samples}
+        n_parsed += 1
+
+    write_fingerprints(fingerprints, cache_fp)
+    if n_parsed > 0 or len(removed_files) > 0:
+        print ("Exchange cache: %i files parsed, %i removed, %i unchanged" %(n_parsed, len(removed_files), len(all_files) - n_parsed))
+
+    return cache_fp
+
+
+######## filters
+
+def filter_exchanges(exch_df, metabolites=None, taxa=None, direction=None, medium=None):
+    """ Returns the rows of exch_df matching all the given filters
+    metabolites / taxa: list of wanted metabolites / taxa
+    direction: "import" or "export"
+    medium: True keeps only the medium rows, False removes them"""
+    keep = pd.Series(True, index=exch_df.index)
+    if metabolites is not None:
+        keep &= exch_df['metabolite'].isin(metabolites)
+    if taxa is not None:
+        keep &= exch_df['taxon'].isin(taxa)
+    if direction is not None:
+        keep &= exch_df['direction'] == direction
+    if medium is not None:
+        keep &= (exch_df['taxon'] == "medium") == medium
+    return exch_df[keep]
+
+
+def store_filter(metabolites=None, taxa=None, direction=None, medium=None):
+    """ Same as filter_exchanges, as a pyarrow expression pushed down to the parquet reader"""
+    import pyarrow.dataset as ds
+
+    expressions = []
+    if metabolites is not None:
+        expressions.append(ds.field("metabolite").isin(list(metabolites)))
+    if taxa is not None:
+        expressions.append(ds.field("taxon").isin(list(taxa)))
+    if direction is not None:
+        expressions.append(ds.field("direction") == direction)
+    if medium is not None:
+        expressions.append((ds.field("taxon") == "medium") if medium else (ds.field("taxon") != "medium"))
+
+    if len(expressions) == 0:
+        return None
+    expression = expressions[0]
+    for e in expressions[1:]:
+        expression = expression & e
+    return expression
+
+
+def match_sample_prefixes(all_samples, prefixes):
+    """ Returns the first sample starting with each prefix, and the list of prefixes not found"""
+    wanted_samples = []
+    not_found = []
+    for prefix in prefixes:
+        matching_samples = [sample for sample in sorted(all_samples) if sample.startswith(prefix)]
+        if len(matching_samples) > 0:
+            wanted_samples.append(matching_samples[0])
+        else:
+            not_found.append(prefix)
+    return wanted_samples, not_found
+
+
+def csv_sample(csv_fp):
+    return os.path.basename(csv_fp)[len("exchanges_grow_"):-len(".csv")]
+
+
+def list_samples(in_path, cache=True):
+    """ Returns the samples available in a store or in a folder of exchanges_grow_*.csv files"""
+    if is_store(in_path):
+        return store_samples(in_path)
+    if cache and cache_available(in_path):
+        return store_samples(refresh_cache(in_path))
+    return [csv_sample(f) for f in exchange_files(in_path)]
+
+
+def resolve_store(in_path, cache=True):
+    """ Returns the path to read the exchanges from: the store itself, or the (refreshed) cache store of a folder
+    of csv files. Readers that load samples separately (e.g. in parallel) should refresh the cache only once."""
+    if not is_store(in_path) and cache and cache_available(in_path) and len(exchange_files(in_path)) > 0:
+        return refresh_cache(in_path)
+    return in_path
+
+
+def sample_fingerprints(in_path, cache=True):
+    """ Returns a dict with the size and modification time of the exchanges of each sample,
+    which change whenever the sample is re-run (store partitions, or csv files when there is no cache)"""
+    in_path = resolve_store(in_path, cache)
+    if is_store(in_path):
+        sample_files = {partition_sample(fp): fp for fp in store_files(in_path)}
+    else:
+        sample_files = {csv_sample(fp): fp for fp in exchange_files(in_path)}
+
+    fingerprints = {}
+    for sample, fp in sample_files.items():
+        stat = os.stat(fp)
+        fingerprints[sample] = "%i-%i" % (stat.st_size, stat.st_mtime_ns)
+    return fingerprints
+
+
+######## vocabulary - integer codes for taxa, metabolites and samples
+
+def exchange_vocabulary(exch_df):
+    """ Returns a dict with the identifiers behind the integer codes of each categorical column
+    (e.g. vocabulary['taxon'][code] is the binID)"""
+    return {col: exch_df[col].cat.categories for col in exch_df.select_dtypes("category").columns}
+
+
+def normalise_sample_ids(exch_df):
+    """ Removes the "_cat" from sample ids, renaming the categories instead of every row"""
+    exch_df = exch_df.copy()
+    samples = exch_df['sample_id'].cat.categories
+    new_samples = samples.astype(str).str.replace("_cat", "", regex=False)
+    if new_samples.is_unique:
+        exch_df['sample_id'] = exch_df['sample_id'].cat.rename_categories(new_samples)
+    else:
+        exch_df['sample_id'] = exch_df['sample_id'].astype(str).str.replace("_cat", "", regex=False).astype("category")
+    return exch_df
+
+
+def edge_codes(exch_df):
+    """ Returns the taxon x metabolite edge of each row as an integer pair (taxon code, metabolite code),
+    packed into a single int64 (taxon_code * n_metabolites + metabolite_code)"""
+    n_metabolites = len(exch_df['metabolite'].cat.categories)
+    return exch_df['taxon'].cat.codes.astype("int64") * n_metabolites + exch_df['metabolite'].cat.codes.astype("int64")
+
+
+def decode_edges(edge_keys, vocabulary, sep="_"):
+    """ Returns the names (taxon + sep + metabolite) of packed edge codes"""
+    taxa = vocabulary['taxon']
+    metabolites = vocabulary['metabolite']
+    edge_keys = np.asarray(edge_keys, dtype="int64")
+    taxon_names = taxa[edge_keys // len(metabolites)].astype(str)
+    metabolite_names = metabolites[edge_keys % len(metabolites)].astype(str)
+    return taxon_names + sep + metabolite_names
+
+
+######## loaders
+
+def load_store(store_fp, columns=None, samples=None, partition_files=None, **filters):
+    import pyarrow.dataset as ds
+    import pyarrow as pa
+
+    # list the partition files explicitly, so temporary files and the cache fingerprints are not read,
+    # and only the partitions of the wanted samples are opened
+    if partition_files is None:
+        partition_files = store_files(store_fp)
+    if samples is not None:
+        samples = set(samples)
+        partition_files = [fp for fp in partition_files if partition_sample(fp) in samples]
+    if len(partition_files) == 0:
+        return pd.DataFrame(columns=columns if columns is not None else list(EXCHANGE_DTYPES))
+
+    partitioning = ds.partitioning(pa.schema([("sample_id", pa.string())]), flavor="hive")
+    dataset = ds.dataset(partition_files, format="parquet", partitioning=partitioning, partition_base_dir=store_fp)
+    exch_df = dataset.to_table(columns=columns, filter=store_filter(**filters)).to_pandas()
+    return exch_df
+
+
+def load_csv_files(all_files, columns=None, samples=None, chunksize=500000, **filters):
+    if samples is not None:
+        samples = set(samples)
+        all_files = [f for f in all_files if csv_sample(f) in samples]
+
+    # the filter columns are needed while reading, even if not wanted in the output
+    read_columns = None
+    if columns is not None:
+        read_columns = set(columns) | {"taxon", "metabolite", "direction"}
+
+    filtered_chunks = []
+    for f in all_files:
+        if len(filters) == 0 or all(v is None for v in filters.values()):
+            filtered_chunks.append(read_exchange_csv(f, read_columns))
+            continue
+        for chunk in read_exchange_csv(f, read_columns, chunksize=chunksize):
+            filtered_chunks.append(filter_exchanges(chunk, **filters))
+
+    if len(filtered_chunks) == 0:
+        return pd.DataFrame(columns=columns if columns is not None else list(EXCHANGE_DTYPES))
+    return pd.concat(filtered_chunks, ignore_index=True)
+
+
+def load_exchanges(in_path, columns=None, samples=None, metabolites=None, taxa=None, direction=None, medium=None,
+                   normalise_samples=False, cache=True):
+    """ Returns a single typed dataframe with the exchanges of all (or the wanted) samples.
+    in_path can be an exchange store or a folder containing exchanges_grow_*.csv files.
+    columns (optional) restricts the table to the wanted columns.
+    samples, metabolites, taxa, direction and medium are filters applied while reading (see filter_exchanges)
+    normalise_samples: remove the "_cat" from sample ids (filters still use the original sample ids)
+    cache: read csv folders through the incremental cache store (<in_path>/.exchange_cache)"""
+    filters = {"metabolites": metabolites, "taxa": taxa, "direction": direction, "medium": medium}
+    if is_store(in_path):
+        exch_df = load_store(in_path, columns, samples, **filters)
+    else:
+        all_files = exchange_files(in_path)
+        if len(all_files) == 0:
+            raise FileNotFoundError("No exchange store or exchanges_grow_*.csv files found in %s" % (in_path))
+        if cache and cache_available(in_path):
+            exch_df = load_store(refresh_cache(in_path), columns, samples, **filters)
+        else:
+            exch_df = load_csv_files(all_files, columns, samples, **filters)
+    return typed_exchanges(exch_df, columns, normalise_samples)
+
+
+def typed_exchanges(exch_df, columns=None, normalise_samples=False):
+    """ Typed columns (see format_exchanges), without unused categories, and only the wanted columns"""
+    exch_df = trim_categories(format_exchanges(exch_df))
+    if normalise_samples and 'sample_id' in exch_df.columns:
+        exch_df = normalise_sample_ids(exch_df)
+    if columns is not None:
+        exch_df = exch_df[[col for col in columns if col in exch_df.columns]]
+    return exch_df
+
+
+def iter_exchanges(in_path, columns=None, samples=None, metabolites=None, taxa=None, direction=None, medium=None,
+                   normalise_samples=False, cache=True):
+    """ Yields the exchanges one sample at a time (same arguments as load_exchanges)"""
+    filters = {"metabolites": metabolites, "taxa": taxa, "direction": direction, "medium": medium}
+
+    # refresh the cache only once, and list the files of the samples only once
+    in_path = resolve_store(in_path, cache)
+    store = is_store(in_path)
+    if store:
+        sample_files = [(partition_sample(fp), fp) for fp in store_files(in_path)]
+    else:
+        sample_files = [(csv_sample(fp), fp) for fp in exchange_files(in_path)]
+    if samples is not None:
+        samples = set(samples)
+        sample_files = [(sample, fp) for sample, fp in sample_files if sample in samples]
+
+    if not store:
+        for sample, fp in sample_files:
+            yield typed_exchanges(load_csv_files([fp], columns, **filters), columns, normalise_samples)
+        return
+
+    # store partitions are read in batches (one dataset per batch, as opening a dataset costs more than
+    # reading a small partition), and the batch is split by sample
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ["sample_id"]))
+    for i in range(0, len(sample_files), ITER_BATCH_SIZE):
+        batch = sample_files[i:i + ITER_BATCH_SIZE]
+        batch_df = format_exchanges(load_store(in_path, read_columns, partition_files=[fp for sample, fp in batch], **filters))
+        sample_rows = batch_df.groupby("sample_id", observed=True, sort=False).indices
+        for sample, fp in batch:
+            yield typed_exchanges(batch_df.iloc[sample_rows.get(sample, [])], columns, normalise_samples)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM""", required=True)
+    parser.add_argument('-o', '--output_store', help="""Path to the exchange store. Default = 2_exchanges_store""", required=False, default="2_exchanges_store")
+    parser.add_argument('-fp', '--float_precision', help="""precision of the stored fluxes: 64 (default, same values as the csv files) or 32 (smaller store)""",
+                        required=False, default="64", choices=["64", "32"])
+
+    args = parser.parse_args()
+    in_path = args.folder_w_exchange_files
+    store_fp = args.output_store
+
+    all_files = exchange_files(in_path)
+    print ("\nAdding %i exchange files to %s\n" % (len(all_files), store_fp))
+    for f in all_files:
+        write_exchanges(read_exchange_csv(f), store_fp, "float" + args.float_precision)
+
+    print ("Done!")
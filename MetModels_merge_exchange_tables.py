@@ -32,8 +32,8 @@ df_merged = df_merged[['compartment'] + [ col for col in df_merged.columns if co
 # fill NaNs with zeors
 df_merged = df_merged.fillna(0)
 
-# remove ".pickle" from sample names:
-df_merged["sample"] = df_merged["sample"].str.replace(".pickle", "")
+# remove ".pickle" and ".snap" from sample names:
+df_merged["sample"] = df_merged["sample"].str.replace(".pickle", "").str.replace(".snap", "")
 
 df_merged.to_csv(out_file, index=False)
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Node tables for the network files (nodes and edges for network analysis in R).
+
+Nodes are classified (metabolites are the nodes containing "_e", MAGs are the other nodes),
+and the taxonomy, metabolite names and producer/consumer statistics are added with merges
+on the whole table, instead of filling the table one node at a time.
+
+Used by MetModels_create_network_files_v2.py, MetModels_create_global_network_from_list.py
+and MetModels_cc_create_network_from_list.py
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import csv
+import pandas as pd
+
+
+STATS_COLUMNS = ['rel_abundance_mean', 'flux_mean', 'occurrences', 'flux_weighted_sum']
+
+
+######## read taxonomy and metabolite names
+
+def read_lineages(sp_class):
+    """ Returns a dict with the lineage of each binID (with '.' replaced by '_'),
+    from a tab-separated file with the binID in one column and the spp classification in the other"""
+    bins2lineage = {}
+    with open(sp_class) as f:
+        for line in f:
+            (binID, lineage) = line.split('\t')
+            bins2lineage[binID.replace('.', "_")] = lineage
+    return bins2lineage
+
+
+def read_phyla(binID2spp):
+    """ Returns a dict with the phylum of each binID (with '.' replaced by '_')"""
+    binID2taxa = {}
+    with open(binID2spp, mode='r') as inp:
+        reader = csv.reader(inp, delimiter="\t")
+        for row in reader:
+            binID = row[0].replace(".", "_")
+            phylum = row[1].split(";")[1].replace("p__", "")
+            binID2taxa[binID] = phylum
+    return binID2taxa
+
+
+def read_bigg_names(in_bigg):
+    """ Returns a dict with the name of each metabolite, from the bigg models table"""
+    metID2name = {}
+    with open(in_bigg, mode='r') as bg:
+        reader = csv.reader(bg, delimiter="\t")
+        for row in reader:
+            metID2name[row[0]] = row[1]
+    return metID2name
+
+
+######## nodes
+
+def unique_nodes(edges):
+    """ Returns a table with the unique MAGs and metabolites of the edges (in order of appearance), and their type"""
+    column_values = edges[["source", "target"]].astype(str).values.ravel()
+    nodes = pd.DataFrame(pd.unique(column_values), columns=["node"])
+
+    is_metab = nodes['node'].str.contains("_e", regex=False)
+    nodes['type'] = "mag"
+    nodes.loc[is_metab, 'type'] = "metab"
+    nodes['type_numb'] = is_metab.astype(float) # 1 for metabolites, 0 for MAGs
+    return nodes
+
+
+def map_names(keys, names, file_name):
+    """ Returns the name of each key in the names dict, warning about keys that are not found"""
+    key_names = keys.map(names)
+    not_found = keys[key_names.isna()]
+    if len(not_found) > 0:
+        print ("\n WARNING: %i nodes not found in %s (e.g. %s)\n" %(len(not_found), file_name, not_found.iloc[0]))
+    return key_names
+
+
+def named_nodes(edges, metID2name, binID2taxa):
+    """ Nodes named with the metabolite names (metabolites) and phylum (MAGs), sorted by type and name"""
+    nodes = unique_nodes(edges)
+    is_metab = nodes['type'] == "metab"
+    nodes.loc[~is_metab, 'name'] = map_names(nodes.loc[~is_metab, 'node'], binID2taxa, "the spp classification")
+    nodes.loc[is_metab, 'name'] = map_names(nodes.loc[is_metab, 'node'], metID2name, "the bigg models")
+    return nodes.sort_values(["type_numb", "name"])
+
+
+def stats_by_node(producers, consumers):
+    """ Producer/consumer statistics of each node (if a node has several edges, the stats of its last edge are kept)"""
+    producers = producers.rename(columns={"source": "node"})
+    consumers = consumers.rename(columns={"target": "node"})
+    node_stats = pd.concat([producers[["node"] + STATS_COLUMNS], consumers[["node"] + STATS_COLUMNS]])
+    node_stats['node'] = node_stats['node'].astype(str)
+    return node_stats.drop_duplicates("node", keep="last").set_index("node").astype(float)
+
+
+def network_nodes(edges, producers, consumers, bins2lineage):
+    """ Nodes with their lineage, species, producer ('p') or consumer ('c') status, and the statistics
+    of producers and consumers. MAG nodes are binIDs ending in '_p' (producers) or '_c' (consumers)"""
+    nodes = unique_nodes(edges)
+    is_metab = nodes['type'] == "metab"
+    prod_cons = nodes['node'].str[-2:].map({"_p": "p", "_c": "c"})
+
+    # lineage and species of MAGs (without the _p / _c suffix)
+    lineage = map_names(nodes.loc[~is_metab, 'node'].str[:-2], bins2lineage, "the spp classification")
+    nodes['lineage'] = 'metab'
+    nodes.loc[~is_metab, 'lineage'] = lineage.str.strip()
+    nodes['species'] = 'metab'
+    nodes.loc[~is_metab, 'species'] = lineage.str.split(';s__').str[1].str.strip()
+
+    nodes['prod_cons'] = 'metab'
+    nodes.loc[~is_metab, 'prod_cons'] = prod_cons[~is_metab]
+    if prod_cons[~is_metab].isna().any():
+        print ("\n\nCan't tell if this is a consumer or producer, check!\n\n")
+
+    # statistics of producers and consumers:
+    node_stats = stats_by_node(producers, consumers)
+    nodes = nodes.join(node_stats, on="node")
+    nodes.loc[is_metab, STATS_COLUMNS] = 10 # random number!! - make it the largest ball!
+    return nodes
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent prevalence counters of the metabolic exchanges, updated incrementally as the cohort grows.
+
+For each edge (taxon_metabolite) and each metabolite (fluxes summed across taxa), split by direction
+(import / export) and by metadata group, the counters keep:
+    n_listed: number of samples where the edge/metabolite is in the exchange table
+    n_nonzero: number of samples where its flux is not zero (used to define core exchanges)
+
+Counters are kept in a folder (e.g. 2_exchanges_prevalence):
+    samples.csv                 fingerprint of the exchanges of each counted sample, and its number of export/import edges
+    presence/sample_id=<sample>/presence.parquet   contribution of each sample to the counters
+    counters_<grouping>.csv     counters per group ('all' for the whole cohort, or a header of the metadata file)
+    groups_<grouping>.csv       group in which each sample was counted
+
+Only new or changed samples are read from the exchanges (see sample_fingerprints in MetModels_exchange_store.py):
+their previous contribution is subtracted from the counters and the new one added,
+and samples that were removed (or moved to another group in the metadata) are subtracted.
+
+Updates are crash-safe: all the files of an update are written to staged files (<file>.<pid>.new) and
+moved in place together at the end, after writing the list of moves to commit_<pid>.csv. An update that
+is interrupted before its commit changes nothing (its staged files can be deleted), and one interrupted
+during its commit is completed by the next update.
+Core exchanges at any threshold come straight from the counters (core_counts, core_items and counters_sweep).
+
+Used by MetModels_calc_core_edges.py and MetModels_calc_core_exchanges.py (-pc option).
+To update the counters of a folder of exchanges (e.g. after adding new samples):
+python3 MetModels_prevalence_counters.py -f 2_exchanges -pc 2_exchanges_prevalence -m metadata_rewiring_microbiome.csv -g HD
+
+Requires pyarrow.
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, glob, shutil
+from argparse import ArgumentParser
+import pandas as pd
+
+from MetModels_exchange_store import load_exchanges, sample_fingerprints, partition_path, partition_sample
+from MetModels_core_prevalence import sweep_table
+
+
+COUNTER_KEYS = ["group", "level", "direction", "item"]
+SAMPLES_FILE = "samples.csv"
+PRESENCE_FILE = "presence.parquet"
+COMMIT_FILE = "commit_%i.csv"
+
+
+######## contribution of each sample
+
+def sample_presence(exch_df):
+    """ Returns the edges and metabolites of each sample (medium rows already removed), with:
+    sample_id, level (edge / metabolite), direction, item (binID_metabolite or metabolite) and nonzero (flux != 0)"""
+    edges = exch_df.groupby(["sample_id", "direction", "taxon", "metabolite"], observed=True)["flux"].sum().reset_index()
+    edges["item"] = edges["taxon"].astype(str) + "_" + edges["metabolite"].astype(str)
+    edges["level"] = "edge"
+
+    metabolites = exch_df.groupby(["sample_id", "direction", "metabolite"], observed=True)["flux"].sum().reset_index()
+    metabolites["item"] = metabolites["metabolite"].astype(str)
+    metabolites["level"] = "metabolite"
+
+    presence = pd.concat([edges, metabolites], ignore_index=True)
+    presence["nonzero"] = presence["flux"] != 0
+    for col in ["sample_id", "direction"]:
+        presence[col] = presence[col].astype(str)
+    return presence[["sample_id", "level", "direction", "item", "nonzero"]]
+
+
+def group_counts(presence, sample_groups):
+    """ Sums the presence of the samples into counters per group.
+    sample_groups: dataframe with the sample_id and group of the samples to count"""
+    presence = presence.merge(sample_groups[["sample_id", "group"]], on="sample_id")
+    counts = presence.groupby(COUNTER_KEYS).agg(n_listed=("nonzero", "size"), n_nonzero=("nonzero", "sum"))
+    return counts.astype("int64")
+
+
+def update_counts(counters, presence, sample_groups, sign):
+    """ Adds (sign = 1) or subtracts (sign = -1) the contribution of the samples to the counters"""
+    if len(presence) == 0 or len(sample_groups) == 0:
+        return counters
+    counters = counters.add(group_counts(presence, sample_groups) * sign, fill_value=0).astype("int64")
+    return counters[counters["n_listed"] > 0]
+
+
+######## files
+
+def write_csv(df, out_fp, **kwargs):
+    tmp_fp = "%s.%i.tmp" %(out_fp, os.getpid())
+    df.to_csv(tmp_fp, **kwargs)
+    os.replace(tmp_fp, out_fp)
+
+
+def staged_path(out_fp):
+    return "%s.%i.new" %(out_fp, os.getpid())
+
+
+def stage_csv(df, out_fp, staged, **kwargs):
+    """ Writes a table to a staged file, moved to out_fp when the update is committed (see commit)"""
+    df.to_csv(staged_path(out_fp), **kwargs)
+    staged.append(out_fp)
+
+
+def commit(counters_fp, staged):
+    """ Moves the staged files in place. The moves are written to a commit file first,
+    so if the commit is interrupted, the next update completes it (see finish_commit)"""
+    moves = pd.DataFrame({"staged": [os.path.relpath(staged_path(fp), counters_fp) for fp in staged],
+                          "final": [os.path.relpath(fp, counters_fp) for fp in staged]})
+    commit_fp = os.path.join(counters_fp, COMMIT_FILE %(os.getpid()))
+    write_csv(moves, commit_fp, index=False)
+    finish_commit(counters_fp, commit_fp)
+
+
+def finish_commit(counters_fp, commit_fp):
+    moves = pd.read_csv(commit_fp, dtype=str, keep_default_na=False)
+    for staged_fp, final_fp in zip(moves["staged"], moves["final"]):
+        staged_fp = os.path.join(counters_fp, staged_fp)
+        if os.path.exists(staged_fp): # files already moved before the interruption are not staged anymore
+            os.replace(staged_fp, os.path.join(counters_fp, final_fp))
+    os.remove(commit_fp)
+
+
+def finish_interrupted_commits(counters_fp):
+    for commit_fp in glob.glob(os.path.join(counters_fp, COMMIT_FILE.replace("%i", "*"))):
+        print ("Prevalence counters: completing an interrupted update (%s)" %(os.path.basename(commit_fp)))
+        finish_commit(counters_fp, commit_fp)
+
+
+def read_samples(counters_fp):
+    samples_fp = os.path.join(counters_fp, SAMPLES_FILE)
+    if not os.path.exists(samples_fp):
+        return pd.DataFrame(columns=["fingerprint", "export", "import"], index=pd.Index([], name="sample_id"))
+    return pd.read_csv(samples_fp, index_col="sample_id", dtype={"sample_id": str, "fingerprint": str}, keep_default_na=False)
+
+
+def presence_fp(counters_fp, sample):
+    return os.path.join(partition_path(os.path.join(counters_fp, "presence"), sample), PRESENCE_FILE)
+
+
+def stage_presence(presence, counters_fp, staged):
+    """ Writes the contribution of each sample to staged files, moved in place when the update is committed"""
+    for sample, sample_df in presence.groupby("sample_id"):
+        out_fp = presence_fp(counters_fp, sample)
+        os.makedirs(os.path.dirname(out_fp), exist_ok=True)
+        sample_df.to_parquet(staged_path(out_fp), engine="pyarrow", index=False)
+        staged.append(out_fp)
+
+
+def read_presence(counters_fp, samples):
+    """ Returns the stored contribution of the samples"""
+    all_presence = [pd.read_parquet(presence_fp(counters_fp, s)) for s in samples if os.path.exists(presence_fp(counters_fp, s))]
+    if len(all_presence) == 0:
+        return pd.DataFrame(columns=["sample_id", "level", "direction", "item", "nonzero"])
+    return pd.concat(all_presence, ignore_index=True)
+
+
+def groupings(counters_fp):
+    """ Returns the groupings already counted (e.g. 'all', 'HD')"""
+    counters_files = glob.glob(os.path.join(counters_fp, "counters_*.csv"))
+    return sorted(os.path.basename(f)[len("counters_"):-len(".csv")] for f in counters_files)
+
+
+def read_grouping(counters_fp, grouping):
+    """ Returns the counters and the group of each counted sample"""
+    counters_file = os.path.join(counters_fp, "counters_%s.csv" % (grouping))
+    groups_file = os.path.join(counters_fp, "groups_%s.csv" % (grouping))
+    if not os.path.exists(counters_file):
+        counters = pd.DataFrame(columns=["n_listed", "n_nonzero"], index=pd.MultiIndex.from_tuples([], names=COUNTER_KEYS), dtype="int64")
+        return counters, pd.DataFrame(columns=["sample_id", "group"])
+    counters = pd.read_csv(counters_file, dtype={"group": str, "item": str}, keep_default_na=False).set_index(COUNTER_KEYS)
+    sample_groups = pd.read_csv(groups_file, dtype=str, keep_default_na=False)
+    return counters, sample_groups
+
+
+def stage_grouping(counters, sample_groups, counters_fp, grouping, staged):
+    stage_csv(counters.sort_index(), os.path.join(counters_fp, "counters_%s.csv" % (grouping)), staged)
+    stage_csv(sample_groups.sort_values("sample_id"), os.path.join(counters_fp, "groups_%s.csv" % (grouping)), staged, index=False)
+
+
+######## update
+
+def metadata_groups(samples, metad_all_samples, grouping_header):
+    """ Returns the group of each sample in the metadata (sample ids without "_cat")"""
+    sample_groups = pd.DataFrame({"sample_id": list(samples)})
+    sample_groups["Sample"] = sample_groups["sample_id"].str.replace("_cat", "", regex=False)
+    metad = metad_all_samples[["Sample", grouping_header]].drop_duplicates("Sample")
+    sample_groups = sample_groups.merge(metad, on="Sample").rename(columns={grouping_header: "group"})
+    sample_groups["group"] = sample_groups["group"].astype(str)
+    return sample_groups[["sample_id", "group"]]
+
+
+def update_counters(in_path, counters_fp, metad_all_samples=None, grouping_header=None):
+    """ Updates the counters with the new, changed and removed samples, and returns the counters and the
+    number of samples of each group and direction for the grouping (grouping_header, or 'all' if None)"""
+    os.makedirs(counters_fp, exist_ok=True)
+    finish_interrupted_commits(counters_fp)
+    fingerprints = sample_fingerprints(in_path)
+    samples_df = read_samples(counters_fp)
+
+    changed = [s for s, f in fingerprints.items() if s not in samples_df.index or samples_df.at[s, "fingerprint"] != f]
+    removed = [s for s in samples_df.index if s not in fingerprints]
+
+    ## contribution of the samples before and after the update
+    old_presence = read_presence(counters_fp, [s for s in changed + removed if s in samples_df.index])
+    new_presence = read_presence(counters_fp, [])
+    if len(changed) > 0:
+        new_presence = sample_presence(load_exchanges(in_path, samples=changed, medium=False))
+
+    # files of the update, moved in place together at the end
+    staged = []
+    stage_presence(new_presence, counters_fp, staged)
+
+    n_edges = new_presence[new_presence["level"] == "edge"].groupby(["sample_id", "direction"]).size().unstack()
+    n_edges = n_edges.reindex(index=changed, columns=["export", "import"]).fillna(0).astype("int64")
+    n_edges["fingerprint"] = [fingerprints[s] for s in changed]
+    samples_df = pd.concat([samples_df.drop(index=changed + removed, errors="ignore"), n_edges])
+    samples_df.index.name = "sample_id"
+
+    ## groupings already counted: samples stay in the group where they were counted
+    updated_groupings = {}
+    for grouping in groupings(counters_fp):
+        counters, sample_groups = read_grouping(counters_fp, grouping)
+        counted = sample_groups[sample_groups["sample_id"].isin(changed + removed)]
+        counters = update_counts(counters, old_presence, counted, -1)
+        counters = update_counts(counters, new_presence, counted[counted["sample_id"].isin(changed)], 1)
+        updated_groupings[grouping] = (counters, sample_groups[~sample_groups["sample_id"].isin(removed)])
+
+    ## wanted grouping: (re)count samples that are new to it, or that moved to another group
+    if grouping_header is None:
+        grouping = "all"
+        wanted_groups = pd.DataFrame({"sample_id": list(fingerprints), "group": "all"})
+    else:
+        grouping = grouping_header
+        wanted_groups = metadata_groups(fingerprints, metad_all_samples, grouping_header)
+
+    if grouping in updated_groupings:
+        counters, sample_groups = updated_groupings[grouping]
+    else:
+        counters, sample_groups = read_grouping(counters_fp, grouping)
+    compared = sample_groups.merge(wanted_groups, on="sample_id", how="outer", suffixes=("_old", ""))
+    moved = compared[compared["group_old"].fillna("") != compared["group"].fillna("")]
+    if len(moved) > 0:
+        # contribution after the update (the stored one is replaced only when the update is committed)
+        moved_presence = pd.concat([read_presence(counters_fp, [s for s in moved["sample_id"] if s not in changed]),
+                                    new_presence[new_presence["sample_id"].isin(moved["sample_id"])]], ignore_index=True)
+        counters = update_counts(counters, moved_presence, moved.dropna(subset=["group_old"]).drop(columns="group").rename(columns={"group_old": "group"}), -1)
+        counters = update_counts(counters, moved_presence, moved.dropna(subset=["group"]), 1)
+    updated_groupings[grouping] = (counters, wanted_groups)
+
+    for updated, (updated_counters, updated_groups) in updated_groupings.items():
+        stage_grouping(updated_counters, updated_groups, counters_fp, updated, staged)
+    stage_csv(samples_df[["fingerprint", "export", "import"]].sort_index(), os.path.join(counters_fp, SAMPLES_FILE), staged)
+    commit(counters_fp, staged)
+
+    # contributions of the samples that are not counted anymore (removed now, or in an interrupted update)
+    for s in set(partition_sample(fp) for fp in glob.glob(os.path.join(counters_fp, "presence", "sample_id=*", PRESENCE_FILE))) - set(samples_df.index):
+        shutil.rmtree(os.path.dirname(presence_fp(counters_fp, s)), ignore_errors=True)
+
+    print ("Prevalence counters: %i samples added or updated, %i removed, %i unchanged" %(len(changed), len(removed), len(fingerprints) - len(changed)))
+    return counters.reset_index(), group_totals(samples_df, wanted_groups)
+
+
+def group_totals(samples_df, sample_groups):
+    """ Number of samples of each group with exchanges in each direction"""
+    totals = sample_groups.merge(samples_df[["export", "import"]], left_on="sample_id", right_index=True)
+    totals = totals.melt(id_vars=["sample_id", "group"], var_name="direction", value_name="n_edges")
+    totals = totals[totals["n_edges"] > 0].groupby(["group", "direction"]).size()
+    return totals.rename("n_samples").reset_index()
+
+
+######## core exchanges from the counters
+
+def level_counters(counters, totals, level):
+    """ Counters of one level (edge or metabolite), with the number of samples of each group and direction"""
+    counters = counters[counters["level"] == level]
+    return counters.merge(totals, on=["group", "direction"])
+
+
+def core_items(counters, totals, level, core_def):
+    """ Returns the edges or metabolites with non-zero fluxes in more than core_def % of the samples of their group"""
+    counters = level_counters(counters, totals, level)
+    is_core = counters["n_nonzero"] > core_def * counters["n_samples"] / 100
+    core = counters.loc[is_core, ["group", "direction", "item", "n_nonzero", "n_samples"]]
+    core["prevalence"] = round(core["n_nonzero"] * 100 / core["n_samples"], 2)
+    return core.sort_values(["group", "direction", "item"]).reset_index(drop=True)
+
+
+def core_counts(counters, totals, level, core_def):
+    """ Returns the number of samples, and the total, core and strict core (100%) number of edges or metabolites,
+    for each group and direction"""
+    counters = level_counters(counters, totals, level)
+    counters["core"] = counters["n_nonzero"] > core_def * counters["n_samples"] / 100
+    counters["strict_core"] = counters["n_nonzero"] == counters["n_samples"]
+    counts = counters.groupby(["group", "direction", "n_samples"]).agg(total=("item", "size"), core=("core", "sum"), strict_core=("strict_core", "sum"))
+    return counts.reset_index()
+
+
+def counters_sweep(counters, totals, level, thresholds):
+    """ Tidy table with the number and proportion of core edges or metabolites at each threshold,
+    for each group and direction"""
+    counters = level_counters(counters, totals, level)
+    all_sweeps = [sweep_table(group_df["n_nonzero"], n_samples, len(group_df), thresholds, group=group, direction=direction)
+                  for (group, direction, n_samples), group_df in counters.groupby(["group", "direction", "n_samples"])]
+    return pd.concat(all_sweeps, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
+    parser.add_argument('-pc', '--prevalence_counters', help="""Folder to keep the prevalence counters. Default = 2_exchanges_prevalence""", required=False, default="2_exchanges_prevalence")
+    parser.add_argument('-m', '--metadata', help="""Path to the metadata file (optional, to count samples per group)""", required=False, default=None)
+    parser.add_argument('-g', '--grouping_header', help="""header of the metadata file used to group samples (e.g. Diagnosis or HD)""", required=False, default=None)
+
+    args = parser.parse_args()
+    metad_all_samples = None
+    if args.metadata is not None:
+        metad_all_samples = pd.read_csv(args.metadata)
+
+    counters, totals = update_counters(args.folder_w_exchange_files, args.prevalence_counters, metad_all_samples, args.grouping_header)
+    print (totals.to_string(index=False))
+    print ("\nDone!")
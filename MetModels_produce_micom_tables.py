@@ -2,6 +2,12 @@
 # -*- coding: utf-8 -*-
 """
 Script to create the input tables for micom - one table per sample
+
+With -l, a single long-format table (id, species, sample_id, file, abundance) covering all samples
+is written instead, from one melt of the KMA table (zero abundances dropped).
+Saved as parquet if the file name ends with .parquet, and as csv otherwise.
+MICOM_build_comm_models.py accepts this table in -f.
+
 Created on 13/05/21
 Updated on 18/09/21
 @author: V.R.Marcelino
@@ -17,6 +23,8 @@ parser.add_argument('-GEMs', '--GEMs', help="""Path to the folder containing the
 
 parser.add_argument('-of', '--output_folder', default = '5_MICOM/0_MAGs_tables',
                     help='Path to the output folder where tables will be stored. Default = 5_MICOM/0_MAGs_tables', required=False)
+parser.add_argument('-l', '--long_table', default = None,
+                    help='Path to a single long-format table with all samples (e.g. 5_MICOM/0_MAGs_tables.csv or .parquet), written instead of one table per sample. Optional', required=False)
 
 args = parser.parse_args()
 #input
@@ -24,14 +32,12 @@ kma_res_fp = args.kma
 GEMs_fp = args.GEMs
 #output
 community_types_fp = args.output_folder
+long_table_fp = args.long_table
 
 #kma_res_fp = "../2_Abundance_Calc/1_merged_kma_res.csv"
 #GEMs_fp = "1_GEMs"
 #community_types_fp = "5_MICOM/0_MAGs_tables"
 
-if not os.path.exists(community_types_fp):
-    os.makedirs(community_types_fp)
-
 
 
 ###### read and parse KMA results - adding the HQ bins to the table.
@@ -39,25 +45,45 @@ df = pd.read_csv(kma_res_fp, index_col = 0, encoding='latin1')
 columns = df.columns.tolist()[:-1] # sample names
 df.index.rename("binID", inplace=True)
 
-### create one table per sample:
-# to stop warning:
-pd.set_option('mode.chained_assignment', None)
-
-
-for i in columns:
-    new_df = pd.DataFrame(index=df.index)
-    new_df.index.rename("id", inplace=True)
-    new_df['species'] = df[['Taxonomy']]
-    new_df['sample_id'] = i
-    new_df['file'] = GEMs_fp + "/" + new_df.index + ".xml"
-    new_df['abundance'] = df[[i]]
-
-    # remove rows with zero counts:
-    new_df = new_df.drop(new_df[new_df.abundance == 0].index)
-
-    #save
-    file_name =  community_types_fp + "/" + i + ".csv"
-    new_df.to_csv(file_name, index=True)
+### create a single table with all samples:
+if long_table_fp is not None:
+    long_df = df.reset_index().melt(id_vars=["binID", "Taxonomy"], value_vars=columns, var_name="sample_id", value_name="abundance")
+    long_df = long_df[long_df['abundance'] != 0] # remove rows with zero counts
+    long_df = long_df.rename(columns={"binID": "id", "Taxonomy": "species"})
+    long_df['file'] = GEMs_fp + "/" + long_df['id'] + ".xml"
+    long_df = long_df[["id", "species", "sample_id", "file", "abundance"]]
+
+    out_dir = os.path.dirname(long_table_fp)
+    if out_dir != "" and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if long_table_fp.endswith(".parquet"):
+        long_df.to_parquet(long_table_fp, index=False)
+    else:
+        long_df.to_csv(long_table_fp, index=False)
+    print ("Table with %i samples saved to %s" %(long_df['sample_id'].nunique(), long_table_fp))
+
+else:
+    ### create one table per sample:
+    if not os.path.exists(community_types_fp):
+        os.makedirs(community_types_fp)
+
+    # to stop warning:
+    pd.set_option('mode.chained_assignment', None)
+
+    for i in columns:
+        new_df = pd.DataFrame(index=df.index)
+        new_df.index.rename("id", inplace=True)
+        new_df['species'] = df[['Taxonomy']]
+        new_df['sample_id'] = i
+        new_df['file'] = GEMs_fp + "/" + new_df.index + ".xml"
+        new_df['abundance'] = df[[i]]
+
+        # remove rows with zero counts:
+        new_df = new_df.drop(new_df[new_df.abundance == 0].index)
+
+        #save
+        file_name =  community_types_fp + "/" + i + ".csv"
+        new_df.to_csv(file_name, index=True)
 
 
 print ("Done. Happy simulations.")
\ No newline at end of file
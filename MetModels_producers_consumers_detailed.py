@@ -4,16 +4,22 @@
 Script to identify the producers and consumers of each metabolite
 -- focus on the healthy population only!
 
+Producer and consumer MAGs are kept as integer-coded sets (metabolites x MAGs boolean matrices),
+and flexible / exclusive MAGs are found with set operations on these matrices.
+
 Created on 6/10/21
 @author: V.R.Marcelino
 """
 
 from argparse import ArgumentParser
-import os, glob, csv
+import csv
+import numpy as np
 import pandas as pd
+from MetModels_exchange_store import load_exchanges, trim_categories
+from MetModels_exchange_analyses import ordered_group_sums
 
 parser = ArgumentParser()
-parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM""", required=True)
+parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
 parser.add_argument('-m', '--metadata', help="""Path to the metadata file""",required=True)
 parser.add_argument('-s', '--spp_classification', help="""Path to the wanted_spp_classification.tsv file""",required=True)
 parser.add_argument('-o', '--output', help="""name of output file. Default = producers_consumers_detailed.csv""", required=False, default="producers_consumers.csv")
@@ -42,49 +48,37 @@ with open(binID2spp, mode='r') as inp:
 
 
 
-## merge exchange files
-all_files = glob.glob(os.path.join(in_path, "exchanges_grow_*.csv"))
-df_from_each_file = (pd.read_csv(f, sep=',') for f in all_files)
-df_merged = pd.concat(df_from_each_file, ignore_index=True)
-
-
-## remove media:
-exch_df = df_merged.loc[df_merged['taxon'] != "medium"]
+## merge exchange files, removing media (and the "_cat" from sample names):
+exch_df = load_exchanges(in_path, medium=False, normalise_samples=True)
 
-## remove the "cat" from sample names:
 pd.options.mode.chained_assignment = None  # disables the warning, default='warn'
-exch_df["sample_id"] = exch_df["sample_id"].str.replace("_cat", "")
 
 ## add 'HD' info and keep only healthy individuals:
 exch_df_metad = pd.merge(exch_df, metad_all_samples[["sample_id","HD"]], on="sample_id", how="left")
 exch_df_healthy = exch_df_metad[exch_df_metad.HD == "healthy"]
 
 
+## keep taxa and metabolites as integer codes (categories of the healthy samples only)
+exch_df_healthy = trim_categories(exch_df_healthy)
+taxa = exch_df_healthy['taxon'].cat.categories
+metabolites = exch_df_healthy['metabolite'].cat.categories
+
 ## separate consumption and production fluxes into two columns:
 mask = exch_df_healthy['flux'] < 0
 exch_df_healthy['flux_production'] = exch_df_healthy['flux'].mask(mask)
 exch_df_healthy['flux_consumption'] = exch_df_healthy['flux'].mask(~mask)
-exch_df_healthy = exch_df_healthy.fillna(0) # replace NaNs with zeros
-
-## also separate consumers and producer MAGs into two columns:
-exch_df_healthy['taxon_production'] = exch_df_healthy['taxon'].mask(mask)
-exch_df_healthy['taxon_consumption'] = exch_df_healthy['taxon'].mask(~mask)
-
+exch_df_healthy[['flux_production', 'flux_consumption']] = exch_df_healthy[['flux_production', 'flux_consumption']].fillna(0).astype(float) # replace NaNs with zeros, sum in double precision
+exch_df_healthy['is_producer'] = exch_df_healthy['flux_production'] != 0
+exch_df_healthy['is_consumer'] = exch_df_healthy['flux_consumption'] != 0
 
-# calculate number of producers/consumers per metabolite, and the sum of their fluxes:
-count_producers = exch_df_healthy.groupby(["sample_id", "metabolite"]).apply(lambda df: df.flux_production.astype(bool).sum(axis=0))
-sum_product_flux = exch_df_healthy.groupby(["sample_id", "metabolite"]).apply(lambda df: sum(df.flux_production))
-producer_MAGs = exch_df_healthy.groupby(["sample_id", "metabolite"])['taxon_production'].agg(['unique']).squeeze() #the .squeeze converts dataframe to series
 
-
-count_consumers = exch_df_healthy.groupby(["sample_id", "metabolite"]).apply(lambda df: df.flux_consumption.astype(bool).sum(axis=0))
-sum_consump_flux = exch_df_healthy.groupby(["sample_id", "metabolite"]).apply(lambda df: sum(df.flux_consumption))
-consumer_MAGs = exch_df_healthy.groupby(["sample_id", "metabolite"])['taxon_consumption'].agg(['unique']).squeeze() #the .squeeze converts dataframe to series
-
-
-## merge the dataframes:
-prod_con_summary = pd.concat([count_producers, sum_product_flux,count_consumers, sum_consump_flux,producer_MAGs, consumer_MAGs], axis=1)
-prod_con_summary.columns = ["n_producers", "flux_producers","n_consumers","flux_consumers","producer_MAGs", "consumer_MAGs"]
+# calculate number of producers/consumers per metabolite, and the sum of their fluxes (single pass,
+# adding the fluxes in row order, as a python sum over each group):
+grouped = exch_df_healthy.groupby(["sample_id", "metabolite"], observed=True)
+prod_con_summary = grouped.agg(n_producers=('is_producer', 'sum'), n_consumers=('is_consumer', 'sum'))
+group_codes = grouped.ngroup().values
+prod_con_summary.insert(1, 'flux_producers', ordered_group_sums(exch_df_healthy['flux_production'], group_codes, grouped.ngroups))
+prod_con_summary['flux_consumers'] = ordered_group_sums(exch_df_healthy['flux_consumption'], group_codes, grouped.ngroups)
 
 
 ## calculate importance score:
@@ -93,99 +87,75 @@ prod_con_summary['importance_score'] = 2 * ((prod_con_summary['n_producers'] * p
 
 ######## group by metabolite, keeping track of the producer and consumer bins:
 
-# prepare dataframe:
-prod_con_summary.reset_index(inplace=True) # convert multi-index to columns
-
-prod_con_summary['producer_MAGs_str'] = ["".join(item) for item in prod_con_summary['producer_MAGs'].astype(str)] # convert to string
-prod_con_summary['consumer_MAGs_str'] = ["".join(item) for item in prod_con_summary['consumer_MAGs'].astype(str)]
-
-
 # aggregate dataset by metabolite
 fun4agg = {'importance_score':['mean', 'std'], 'flux_producers':['mean', 'std'], 'flux_consumers':['mean', 'std'],
-           'n_producers': ['sum', 'mean', 'std'], 'n_consumers':['sum', 'mean', 'std'],
-           'producer_MAGs_str':['sum'], 'consumer_MAGs_str': ['sum']}
+           'n_producers': ['sum', 'mean', 'std'], 'n_consumers':['sum', 'mean', 'std']}
 
-prod_con_samples_agg = prod_con_summary.groupby('metabolite').agg(fun4agg)
+prod_con_samples_agg = prod_con_summary.groupby('metabolite', observed=True).agg(fun4agg)
+prod_con_samples_agg = prod_con_samples_agg.reindex(pd.Index(metabolites, name="metabolite")) # same order as the metabolite codes
 
 # merge multilevel column names
 prod_con_samples_agg.columns = ['_'.join(col) for col in prod_con_samples_agg.columns]
 
-####### clean and convert consumer_MAG column to a meaningful list:
-# first replace all patterns with a space (otherwise we may concatenate bin names), then replace 2+ spaces with a single space
-pattern2replace = '|'.join(["'", "\[", "\]", "nan"])
-
-### producers:
-prod_con_samples_agg['producer_MAGs_str_sum'] = prod_con_samples_agg['producer_MAGs_str_sum'].str.replace(pattern2replace, ' ')
-prod_con_samples_agg['producer_MAGs_str_sum'] = prod_con_samples_agg.producer_MAGs_str_sum.str.replace('\s{2,}', ' ') # replaces any number of spaces by just one
-
-# convert to list:
-prod_con_samples_agg['producer_MAGs_str_sum'] = prod_con_samples_agg.producer_MAGs_str_sum.apply(lambda x: x[1:-1].split(' '))
-
-# replace empty lists with None (otherwise they are counted late ron)
-prod_con_samples_agg['producer_MAGs_str_sum'] = prod_con_samples_agg.producer_MAGs_str_sum.apply(lambda x: list(filter(None, x)))
-
-# remove duplicates
-prod_con_samples_agg['producer_MAGs_unique'] = prod_con_samples_agg['producer_MAGs_str_sum'].apply(lambda x: list(set(x)))
-
 
-### consumers:
-prod_con_samples_agg['consumer_MAGs_str_sum'] = prod_con_samples_agg['consumer_MAGs_str_sum'].str.replace(pattern2replace, ' ')
-prod_con_samples_agg['consumer_MAGs_str_sum'] = prod_con_samples_agg.consumer_MAGs_str_sum.str.replace('\s{2,}', ' ') # replaces any number of spaces by just one
+####### producer and consumer MAGs of each metabolite, as integer-coded sets:
+# producers are the MAGs with non-negative fluxes, consumers the ones with negative fluxes
+MAG_rows = pd.DataFrame({'sample_id': pd.factorize(exch_df_healthy['sample_id'])[0],
+                         'metabolite': exch_df_healthy['metabolite'].cat.codes.values,
+                         'taxon': exch_df_healthy['taxon'].cat.codes.values,
+                         'consumer': mask.values})
+MAG_rows = MAG_rows.drop_duplicates().sort_values(['metabolite', 'sample_id', 'taxon'])
+producer_rows = MAG_rows[~MAG_rows['consumer']]
+consumer_rows = MAG_rows[MAG_rows['consumer']]
 
-# convert to list:
-prod_con_samples_agg['consumer_MAGs_str_sum'] = prod_con_samples_agg.consumer_MAGs_str_sum.apply(lambda x: x[1:-1].split(' '))
+def MAG_bitmap(rows):
+    """metabolites x MAGs boolean matrix (True if the MAG is in the set of the metabolite)"""
+    bitmap = np.zeros((len(metabolites), len(taxa)), dtype=bool)
+    bitmap[rows['metabolite'].values, rows['taxon'].values] = True
+    return (bitmap)
 
-# replace empty lists with None (otherwise they are counted late ron)
-prod_con_samples_agg['consumer_MAGs_str_sum'] = prod_con_samples_agg.consumer_MAGs_str_sum.apply(lambda x: list(filter(None, x)))
+def code_lists(row_codes, codes, names):
+    """list of names (decoded from the codes) for each metabolite, keeping the order of the codes"""
+    n_per_metabolite = np.bincount(row_codes, minlength=len(metabolites))
+    return ([list(l) for l in np.split(np.asarray(names, dtype=object)[codes], np.cumsum(n_per_metabolite)[:-1])])
 
-# remove duplicates
-prod_con_samples_agg['consumer_MAGs_unique'] = prod_con_samples_agg['consumer_MAGs_str_sum'].apply(lambda x: list(set(x)))
+def bitmap_lists(bitmap, names):
+    met_codes, taxon_codes = np.nonzero(bitmap)
+    return (code_lists(met_codes, taxon_codes, names))
 
+producers_bitmap = MAG_bitmap(producer_rows)
+consumers_bitmap = MAG_bitmap(consumer_rows)
 
-### identify flexible MAGs (those that can be producers & consumers)
+### set algebra - identify flexible MAGs (those that can be producers & consumers), and exclusive producers/consumers:
+flexible_bitmap = producers_bitmap & consumers_bitmap
+exclusive_producers_bitmap = producers_bitmap & ~consumers_bitmap
+exclusive_consumers_bitmap = consumers_bitmap & ~producers_bitmap
 
-# helper functions:
-def find_duplicates(l1, l2):
-    """returns MAGs that can be producers and consumers"""
-    dups = list(set(l1).intersection(l2))
-    return(dups)
+# MAGs of each sample (in all samples, may contain duplicates), and unique MAGs:
+taxa_names = taxa.astype(str)
+prod_con_samples_agg['producer_MAGs_str_sum'] = code_lists(producer_rows['metabolite'].values, producer_rows['taxon'].values, taxa_names)
+prod_con_samples_agg['consumer_MAGs_str_sum'] = code_lists(consumer_rows['metabolite'].values, consumer_rows['taxon'].values, taxa_names)
+prod_con_samples_agg['producer_MAGs_unique'] = bitmap_lists(producers_bitmap, taxa_names)
+prod_con_samples_agg['consumer_MAGs_unique'] = bitmap_lists(consumers_bitmap, taxa_names)
 
-def find_exclusives(lx, l_dups):
-    """returns MAGs that are only present in lx, not in the duplicate MAG list"""
-    exclusive_in_lx = list(set(lx).symmetric_difference(set(l_dups)))
-    return(exclusive_in_lx)
-
-# calc:
-prod_con_samples_agg['flexible_MAGs'] = prod_con_samples_agg.apply(lambda x: find_duplicates(x.producer_MAGs_unique, x.consumer_MAGs_unique), axis=1)
-prod_con_samples_agg['exclusive_producers'] = prod_con_samples_agg.apply(lambda x: find_exclusives(x.producer_MAGs_unique, x.flexible_MAGs), axis=1)
-prod_con_samples_agg['exclusive_consumers'] = prod_con_samples_agg.apply(lambda x: find_exclusives(x.consumer_MAGs_unique, x.flexible_MAGs), axis=1)
+prod_con_samples_agg['flexible_MAGs'] = bitmap_lists(flexible_bitmap, taxa_names)
+prod_con_samples_agg['exclusive_producers'] = bitmap_lists(exclusive_producers_bitmap, taxa_names)
+prod_con_samples_agg['exclusive_consumers'] = bitmap_lists(exclusive_consumers_bitmap, taxa_names)
 
 
 ### calculate % of each category (makes it easier to plot in R):
-def calc_total(l1,l2,l3):
-    total = len(l1) + len(l2) + len(l3)
-    return (total)
-
-def calc_proportion(lx, n_total):
-    prop = len(lx) * 100 / n_total
-    return (prop)
-
-
-
-prod_con_samples_agg['total_n_unique_MAGs'] = prod_con_samples_agg.apply(lambda x: calc_total(x.flexible_MAGs, x.exclusive_producers, x.exclusive_consumers), axis=1)
-prod_con_samples_agg['perc_flexible'] = prod_con_samples_agg.apply(lambda x: calc_proportion(x.flexible_MAGs, x.total_n_unique_MAGs), axis=1)
-prod_con_samples_agg['perc_producers'] = prod_con_samples_agg.apply(lambda x: calc_proportion(x.exclusive_producers, x.total_n_unique_MAGs), axis=1)
-prod_con_samples_agg['perc_consumers'] = prod_con_samples_agg.apply(lambda x: calc_proportion(x.exclusive_consumers, x.total_n_unique_MAGs), axis=1)
+prod_con_samples_agg['total_n_unique_MAGs'] = (producers_bitmap | consumers_bitmap).sum(axis=1)
+prod_con_samples_agg['perc_flexible'] = flexible_bitmap.sum(axis=1) * 100 / prod_con_samples_agg['total_n_unique_MAGs']
+prod_con_samples_agg['perc_producers'] = exclusive_producers_bitmap.sum(axis=1) * 100 / prod_con_samples_agg['total_n_unique_MAGs']
+prod_con_samples_agg['perc_consumers'] = exclusive_consumers_bitmap.sum(axis=1) * 100 / prod_con_samples_agg['total_n_unique_MAGs']
 
 
 ### add species classification:
-def translate_bin2spp(l1, dict):
-    spp_list = [dict[x] for x in l1]
-    return (spp_list)
+taxa_classification = [binID2taxa[x] for x in taxa_names]
 
-prod_con_samples_agg['flexible_MAGs_taxa'] = prod_con_samples_agg.apply(lambda x: translate_bin2spp(x.flexible_MAGs,binID2taxa), axis=1)
-prod_con_samples_agg['exclusive_producers_taxa'] = prod_con_samples_agg.apply(lambda x: translate_bin2spp(x.exclusive_producers,binID2taxa), axis=1)
-prod_con_samples_agg['exclusive_consumers_taxa'] = prod_con_samples_agg.apply(lambda x: translate_bin2spp(x.exclusive_consumers,binID2taxa), axis=1)
+prod_con_samples_agg['flexible_MAGs_taxa'] = bitmap_lists(flexible_bitmap, taxa_classification)
+prod_con_samples_agg['exclusive_producers_taxa'] = bitmap_lists(exclusive_producers_bitmap, taxa_classification)
+prod_con_samples_agg['exclusive_consumers_taxa'] = bitmap_lists(exclusive_consumers_bitmap, taxa_classification)
 
 ## save large file:
 prod_con_samples_agg.to_csv(out_file)
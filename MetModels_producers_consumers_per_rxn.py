@@ -5,54 +5,38 @@ Script to calculate the number of producers and consumers of each metabolite,
 in order to estimate the metabolite's importance in the community and infer
 community stability.
 
+Counts and flux sums are calculated in a single grouped reduction. With -t > 1, shards of samples
+are read and summarised in parallel.
+
 Created on 1/9/21
 @author: V.R.Marcelino
 """
 
 from argparse import ArgumentParser
-import os, glob
-import pandas as pd
+from MetModels_exchange_store import load_exchanges
+from MetModels_exchange_analyses import producers_consumers, parallel_producers_consumers
 
 parser = ArgumentParser()
-parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM""", required=True)
+parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
 parser.add_argument('-o', '--output', help="""name of output file. Default = producers_consumers.csv""", required=False, default="producers_consumers.csv")
+parser.add_argument('-t', '--threads', help="""number of processes, each summarising a shard of samples. Default = 1""", required=False, default=1)
 
 args = parser.parse_args()
 in_path = args.folder_w_exchange_files
 out_file = args.output
+threads = int(args.threads)
 
 #in_path = "2_exchanges"
 #out_file = "producers_consumers.csv"
 
-## merge exchange files
-all_files = glob.glob(os.path.join(in_path, "exchanges_grow_*.csv"))
-df_from_each_file = (pd.read_csv(f, sep=',') for f in all_files)
-df_merged = pd.concat(df_from_each_file, ignore_index=True)
-
-## remove media:
-exch_df = df_merged.loc[df_merged['taxon'] != "medium"]
-
-## separate consumption and production fluxes into two columns:
-pd.options.mode.chained_assignment = None  # disables the warning, default='warn'
-mask = exch_df['flux'] < 0
-exch_df['flux_production'] = exch_df['flux'].mask(mask)
-exch_df['flux_consumption'] = exch_df['flux'].mask(~mask)
-exch_df = exch_df.fillna(0) # replace NaNs with zeros
-
-
-# calculate number of producers/consumers per metabolite, and the sum of their fluxes:
-count_producers = exch_df.groupby(["sample_id", "metabolite"]).apply(lambda df: df.flux_production.astype(bool).sum(axis=0))
-sum_product_flux = exch_df.groupby(["sample_id", "metabolite"]).apply(lambda df: sum(df.flux_production))
-
-count_consumers = exch_df.groupby(["sample_id", "metabolite"]).apply(lambda df: df.flux_consumption.astype(bool).sum(axis=0))
-sum_consump_flux = exch_df.groupby(["sample_id", "metabolite"]).apply(lambda df: sum(df.flux_consumption))
-
-# merge the dataframes:
-prod_con_summary = pd.concat([count_producers, sum_product_flux,count_consumers, sum_consump_flux], axis=1)
-prod_con_summary.columns = ["n_producers", "flux_producers","n_consumers","flux_consumers"]
-
-# remove metabolites that are not consumed by anyone:
-prod_con_summary = prod_con_summary[prod_con_summary['n_consumers'] > 0]
+## number of producers/consumers per metabolite and the sum of their fluxes
+## (removing metabolites that are not consumed by anyone)
+if threads > 1:
+    prod_con_summary = parallel_producers_consumers(in_path, threads)
+else:
+    ## merge exchange files, removing media:
+    exch_df = load_exchanges(in_path, medium=False)
+    prod_con_summary = producers_consumers(exch_df)
 
 ## save it:
 prod_con_summary.to_csv(out_file)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script to run several analyses of the MICOM exchanges in a single pass:
+exchanges are loaded and split (medium / non-medium, export / import) only once,
+and each selected analysis writes the same output file as its individual script.
+
+Analyses (-a, comma-separated, default = all analyses whose inputs were given):
+    core_edges            -> MetModels_calc_core_edges.py
+    core_exchanges        -> MetModels_calc_core_exchanges.py (requires -m and -g)
+    net_produc            -> MetModels_summarize_net_produc.py
+    producers_consumers   -> MetModels_producers_consumers_per_rxn.py
+    total_produc_consump  -> MetModels_summarize_total_produc_consump.py (requires -kma)
+
+### Example:
+python3 MetModels_run_exchange_analyses.py -f 2_exchanges -m metadata_rewiring_microbiome.csv -g HD -kma 1.1_merged_kma_simplified4summarize_production_consumption.csv -o 3_parsed_exchanges
+###
+
+Created on 18/10/26
+@author: V.R.Marcelino
+"""
+
+import os, sys
+import pandas as pd
+from argparse import ArgumentParser
+from MetModels_exchange_store import load_exchanges
+from MetModels_exchange_analyses import (split_medium, split_directions, core_edges, metabolite_table, core_exchanges_summaries,
+                                         net_production, producers_consumers, read_kma_abundances, total_production_consumption)
+
+
+all_analyses = ["core_edges", "core_exchanges", "net_produc", "producers_consumers", "total_produc_consump"]
+
+parser = ArgumentParser()
+parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
+parser.add_argument('-a', '--analyses', help="""comma-separated list of analyses to run (%s).
+                    Default = all analyses whose inputs were given""" % (",".join(all_analyses)), required=False, default=None)
+parser.add_argument('-o', '--out_folder', help="""output folder. Default = current folder""", required=False, default=".")
+
+parser.add_argument('-ce', '--core_edges', help="""core definition for core_edges (min percentage of samples). Default = 90""", required=False, default=90)
+parser.add_argument('-cx', '--core_exchanges', help="""core definition for core_exchanges (min percentage of samples). Default = 95""", required=False, default=95)
+parser.add_argument('-m', '--metadata', help="""Path to the metadata file (for core_exchanges)""", required=False, default=None)
+parser.add_argument('-g', '--grouping_header', help="""category to analyse core exchanges, must be a header in the metadata file (Diagnosis or HD).
+                    Several headers can be given, separated by commas""", required=False, default=None)
+parser.add_argument('-kma', '--kma', help="""Path to the merged kma results at species level, replacing '.' by '_' (for total_produc_consump)""", required=False, default=None)
+
+args = parser.parse_args()
+in_path = args.folder_w_exchange_files
+out_dir = args.out_folder
+core_def_edges = int(args.core_edges)
+core_def_exchanges = int(args.core_exchanges)
+metad_fp = args.metadata
+grouping_header = args.grouping_header
+kma_res_fp = args.kma
+
+#in_path = "2_exchanges"
+#out_dir = "3_parsed_exchanges"
+#metad_fp = "metadata_rewiring_microbiome.csv"
+#grouping_header = "HD"
+#kma_res_fp = "1.1_merged_kma_simplified4summarize_production_consumption.csv"
+
+# check which analyses can be run:
+if args.analyses is None:
+    analyses = ["core_edges", "net_produc", "producers_consumers"]
+    if metad_fp is not None and grouping_header is not None:
+        analyses.append("core_exchanges")
+    if kma_res_fp is not None:
+        analyses.append("total_produc_consump")
+else:
+    analyses = args.analyses.split(",")
+
+unknown = [a for a in analyses if a not in all_analyses]
+if len(unknown) > 0:
+    print ("Error: unknown analyses %s. Choose from %s" % (", ".join(unknown), ", ".join(all_analyses)))
+    sys.exit(1)
+if "core_exchanges" in analyses and (metad_fp is None or grouping_header is None):
+    print ("Error: core_exchanges requires --metadata and --grouping_header")
+    sys.exit(1)
+if "total_produc_consump" in analyses and kma_res_fp is None:
+    print ("Error: total_produc_consump requires --kma")
+    sys.exit(1)
+
+if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
+
+def out_fp(file_name):
+    return os.path.join(out_dir, file_name)
+
+
+## load exchanges once, and split them once
+print ("\nRunning %s\n" % (", ".join(analyses)))
+need_medium = "net_produc" in analyses
+exch_all = load_exchanges(in_path, medium=None if need_medium else False)
+
+exch_df, media_rows = split_medium(exch_all)
+del exch_all
+exports_df, imports_df = split_directions(exch_df)
+
+
+if "core_edges" in analyses:
+    print ("\n#### core edges")
+    core_edges(exports_df, imports_df, core_def_edges, out_fp("met_exchanges_all_exports_spp.csv"),
+               out_fp("met_exchanges_all_imports_spp.csv"), out_fp("met_exchanges_core_spp"))
+
+if "core_exchanges" in analyses:
+    print ("\n#### core exchanges")
+    metad_all_samples = pd.read_csv(metad_fp)
+    grouping_headers = grouping_header.split(",")
+    all_summaries = core_exchanges_summaries(metabolite_table(exports_df), metabolite_table(imports_df), metad_all_samples,
+                                             grouping_headers, core_def_exchanges)
+    for header, summary_results in all_summaries.items():
+        if len(grouping_headers) > 1:
+            summary_results.to_csv(out_fp("summary_met_exchanges_core_%s.csv" %(header)), index=False)
+        else:
+            summary_results.to_csv(out_fp("summary_met_exchanges_core.csv"), index=False)
+
+if "net_produc" in analyses:
+    print ("\n#### net production / consumption")
+    net_production(media_rows).to_csv(out_fp("net_produc_consump_merged.csv"), index=True)
+
+if "producers_consumers" in analyses:
+    print ("\n#### producers and consumers")
+    producers_consumers(exch_df).to_csv(out_fp("producers_consumers.csv"))
+
+if "total_produc_consump" in analyses:
+    print ("\n#### total production and consumption")
+    production_df, consumption_df = total_production_consumption(exports_df, imports_df, read_kma_abundances(kma_res_fp))
+    production_df.to_csv(out_fp("total_production.csv"), index=True)
+    consumption_df.to_csv(out_fp("total_consumption.csv"), index=True)
+
+print ("\nDone! Outputs saved in %s\n" % (out_dir))
@@ -13,11 +13,11 @@ Created on 26/8/21
 """
 
 from argparse import ArgumentParser
-import os, glob
-import pandas as pd
+from MetModels_exchange_store import load_exchanges
+from MetModels_exchange_analyses import net_production
 
 parser = ArgumentParser()
-parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM""", required=True)
+parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
 parser.add_argument('-o', '--output', help="""name of output file. Default = net_produc_consump_merged.csv""", required=False, default="net_produc_consump_merged.csv")
 
 args = parser.parse_args()
@@ -27,17 +27,11 @@ out_file = args.output
 #in_path = "2_exchanges"
 #out_file = "net_produc_consump_merged.csv"
 
-## merge files
-all_files = glob.glob(os.path.join(in_path, "exchanges_grow_*.csv"))
-df_from_each_file = (pd.read_csv(f, sep=',') for f in all_files)
-df_merged = pd.concat(df_from_each_file, ignore_index=True)
-
-## keep only media:
-media_rows = df_merged.loc[df_merged['taxon'] == "medium"]
+## merge files, keeping only media:
+media_rows = load_exchanges(in_path, medium=True)
 
 # reshape table to have sample as rows and metab as columns:
-net_df = media_rows.pivot(index = "sample_id", columns="metabolite", values="flux")
-net_df = net_df.fillna(0) # replace NaNs with zeros
+net_df = net_production(media_rows)
 
 ## save it
 net_df.to_csv(out_file, index=True)
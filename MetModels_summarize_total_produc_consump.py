@@ -6,25 +6,31 @@ tables with Total production Total consumption of metabolites by the microbiome
 
 --> corrected for species Absolute abundances
 
+With --streaming, exchanges are read one sample at a time and summed as they are read,
+so memory is bounded by the size of the output tables rather than by the whole cohort.
+
 Created on 26/8/21
 @author: V.R.Marcelino
 """
 
 from argparse import ArgumentParser
-import os, glob
 import pandas as pd
+from MetModels_exchange_store import load_exchanges, iter_exchanges
+from MetModels_exchange_analyses import read_kma_abundances, split_directions, total_production_consumption
 
 parser = ArgumentParser()
-parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM""", required=True)
+parser.add_argument('-f', '--folder_w_exchange_files', help="""Path to the folder containing exchange files produced by MICOM (or to an exchange store)""", required=True)
 parser.add_argument('-kma', '--kma', help="""Path to the merged kma results at species level, replacing '.' by '_'. """, required=True)
 parser.add_argument('-op', '--output_production', help="""name of file to save total production. Default = total_production.csv""", required=False, default="total_production.csv")
 parser.add_argument('-oc', '--output_consumption', help="""name of file to save consumption. Default = total_consumption.csv""", required=False, default="total_consumption.csv")
+parser.add_argument('-st', '--streaming', help="""read and summarize one sample at a time (for large cohorts)""", required=False, action='store_true')
 
 args = parser.parse_args()
 in_path = args.folder_w_exchange_files
 kma_res_fp = args.kma
 out_file_prod = args.output_production
 out_file_cons = args.output_consumption
+streaming = args.streaming
 
 #in_path = "2_exchanges"
 #out_file_prod = "total_production.csv"
@@ -32,44 +38,44 @@ out_file_cons = args.output_consumption
 
 
 ###### read and parse KMA results (aggregated @ species level) - adding the representative bins to the table.
-kma_df = pd.read_csv(kma_res_fp,index_col = 0, encoding='latin1')
-
 # For each sample/taxon - get their absolute abundance
-kma_columns = kma_df.stack().reset_index().rename(columns={'level_0':'rep_bin','level_1':'Sample', 0:'Abs_abundance'})
-
+kma_columns = read_kma_abundances(kma_res_fp)
 
-## merge exchange files
-all_files = glob.glob(os.path.join(in_path, "exchanges_grow_*.csv"))
-df_from_each_file = (pd.read_csv(f, sep=',') for f in all_files)
-df_merged = pd.concat(df_from_each_file, ignore_index=True)
 
-## remove media:
-non_media_rows = df_merged.loc[df_merged['taxon'] != "medium"]
+def stream_weighted_sums(in_path, kma_columns):
+    """ Reads the exchanges one sample at a time, and returns the sum of abundance-weighted fluxes
+    per sample, metabolite and direction. Abundances are looked up in an index of (taxon, sample)."""
+    abundance_index = kma_columns.set_index(['rep_bin', 'Sample'])['Abs_abundance']
 
-## Add absolute abundance:
-exch_w_abs_abund = pd.merge(non_media_rows, kma_columns,  how='left', left_on=['taxon','sample_id'], right_on = ['rep_bin','Sample'])
+    sample_sums = []
+    for sample_df in iter_exchanges(in_path, medium=False):
+        keys = pd.MultiIndex.from_arrays([sample_df['taxon'].astype(str), sample_df['sample_id'].astype(str)])
+        sample_df['flux_weighted'] = sample_df['flux'].values * abundance_index.reindex(keys).values
+        sums = sample_df.groupby(["direction", "sample_id", "metabolite"], observed=True)['flux_weighted'].sum()
+        sample_sums.append(sums.rename(index=str))
 
-## calculated product/consump corrected for absolute abundances:
-exch_w_abs_abund['flux_weighted'] = exch_w_abs_abund['flux'] * exch_w_abs_abund['Abs_abundance']
+    return pd.concat(sample_sums)
 
-#### Summarize production:
-exports = exch_w_abs_abund.loc[exch_w_abs_abund['direction'] == "export"]
 
-# reshape table to have sample as rows and metab as columns:
-production_df = exports.pivot_table(index = "sample_id", columns="metabolite", values="flux_weighted", aggfunc='sum')
-production_df = production_df.fillna(0) # replace NaNs with zeros
+def sums_as_table(weighted_sums, direction):
+    """ reshape sums to have sample as rows and metab as columns"""
+    table = weighted_sums.xs(direction, level="direction").unstack("metabolite")
+    table = table.sort_index().sort_index(axis=1)
+    return table.fillna(0) # replace NaNs with zeros
 
-# save it
-production_df.to_csv(out_file_prod, index=True)
 
-#### Summarize consumption:
-imports = exch_w_abs_abund.loc[exch_w_abs_abund['direction'] == "import"]
+if streaming:
+    weighted_sums = stream_weighted_sums(in_path, kma_columns)
+    production_df = sums_as_table(weighted_sums, "export")
+    consumption_df = sums_as_table(weighted_sums, "import")
 
-# reshape table to have sample as rows and metab as columns:
-consumption_df = imports.pivot_table(index = "sample_id", columns="metabolite", values="flux_weighted", aggfunc='sum')
-consumption_df = consumption_df.fillna(0) # replace NaNs with zeros
+else:
+    ## merge exchange files, removing media, and summarize production (exports) and consumption (imports)
+    exports_df, imports_df = split_directions(load_exchanges(in_path, medium=False))
+    production_df, consumption_df = total_production_consumption(exports_df, imports_df, kma_columns)
 
 # save it
+production_df.to_csv(out_file_prod, index=True)
 consumption_df.to_csv(out_file_cons, index=True)
 
 print ("Done!")
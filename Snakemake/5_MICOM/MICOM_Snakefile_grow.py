@@ -1,5 +1,8 @@
 # build community models and obtain metabolic exchanges
 
+import math
+import zlib
+
 configfile: "MICOM_config_grow.yaml"
 samples_fp = "0_MAGs_tables/all_samples.txt"
 
@@ -9,55 +12,75 @@ samples_fp = "0_MAGs_tables/all_samples.txt"
 with open(samples_fp) as f:
     samples = f.read().splitlines()
 
+# samples are built and grown in batches (one job per batch, see MICOM_build_comm_models.py and MICOM_grow_wf.py -s).
+# Each sample goes to the batch given by a hash of its name, so adding or removing samples only changes their own
+# batches (which are run again, as their tables are newer than the batch flags), not the other ones.
+n_batches = config["n_batches"]["grow"]
+batches = {}
+for sample in samples:
+    batches.setdefault(str(zlib.crc32(sample.encode()) % n_batches), []).append(sample)
+
+# time limit of a batch job: the time limit of one sample, for each round of samples run in parallel by the cores of the job,
+# capped at the time limit of the partition (time_min: max)
+def batch_time(batch, cores):
+    return min(config["time_min"]["per_sample"] * math.ceil(len(batches[batch]) / cores), config["time_min"]["max"])
+
+largest_batch = max(len(batch) for batch in batches.values())
+for step in ["build_comm", "exchanges"]:
+    if config["time_min"]["per_sample"] * math.ceil(largest_batch / config["cores"][step]) > config["time_min"]["max"]:
+        print ("WARNING: batches of up to %i samples may not finish the %s step in time_min: max (%i min) with %i core(s). Increase n_batches: grow or cores: %s in the config file."
+               %(largest_batch, step, config["time_min"]["max"], config["cores"][step], step))
 
 rule all:
     input:
-        expand(config["path"]["root"]+"/"+config["folder"]["exchanges"]+"/exchanges_grow_{sample}.csv", sample = samples)
+        expand(config["path"]["root"]+"/"+config["folder"]["exchanges"]+"/batches/batch_{batch}.done", batch = batches.keys())
 
 
 rule build_community:
     input:
-        sample_file = config["path"]["root"]+"/"+config["folder"]["tables_fp"]+"/{sample}.csv"
+        lambda wildcards: expand(config["path"]["root"]+"/"+config["folder"]["tables_fp"]+"/{sample}.csv", sample = batches[wildcards.batch])
     params:
-        smpl = "{sample}"
+        smpls = lambda wildcards: ",".join(batches[wildcards.batch])
     output:
-        config["path"]["root"]+"/"+config["folder"]["pickles"]+"/{sample}.pickle"
+        touch(config["path"]["root"]+"/"+config["folder"]["pickles"]+"/batches/batch_{batch}.done")
     resources:
-        time_min=120, mem_mb=8000, cpus=config["cores"]["build_comm"]
+        time_min=lambda wildcards: batch_time(wildcards.batch, config["cores"]["build_comm"]), mem_mb=8000 * config["cores"]["build_comm"], cpus=config["cores"]["build_comm"]
     log:
-        std_out = config["path"]["root"]+"/"+config["folder"]["logs"]+"/micom_build_comm/{sample}.log"
+        std_out = config["path"]["root"]+"/"+config["folder"]["logs"]+"/micom_build_comm/batch_{batch}.log"
     benchmark:
-        config["path"]["root"]+"/benchmarks/build_comm/"+'{sample}.benchmark.txt'
+        config["path"]["root"]+"/benchmarks/build_comm/"+'batch_{batch}.benchmark.txt'
     shell:
         """     
         echo "Begin building commuities with MICOM ... "
-        python3 MICOM_build_comm_models.py -s {params.smpl}
+        python3 MICOM_build_comm_models.py -s {params.smpls} -th {resources.cpus}
         
         echo "Done"
         """
 
 rule grow_wf:
     input:
-        config["path"]["root"]+"/"+config["folder"]["pickles"]+"/{sample}.pickle"
+        config["path"]["root"]+"/"+config["folder"]["pickles"]+"/batches/batch_{batch}.done"
     params:
-        smpl = "{sample}",
+        smpls = lambda wildcards: ",".join(batches[wildcards.batch]),
         out_folder = config["path"]["root"]+"/"+config["folder"]["exchanges"],
+        store = config["path"]["root"]+"/"+config["folder"]["exchange_store"],
+        result_cache = config["path"]["root"]+"/"+config["folder"]["result_cache"],
         pickles_fp = config["path"]["root"]+"/"+config["folder"]["pickles"]
     output:
-        config["path"]["root"]+"/"+config["folder"]["exchanges"]+"/exchanges_grow_{sample}.csv"
+        touch(config["path"]["root"]+"/"+config["folder"]["exchanges"]+"/batches/batch_{batch}.done")
     resources:
-        time_min=120, mem_mb=12000, cpus=config["cores"]["exchanges"]
+        time_min=lambda wildcards: batch_time(wildcards.batch, config["cores"]["exchanges"]), mem_mb=12000, cpus=config["cores"]["exchanges"]
     log:
-        std_out = config["path"]["root"]+"/"+config["folder"]["logs"]+"/micom_grow/{sample}.log"
+        std_out = config["path"]["root"]+"/"+config["folder"]["logs"]+"/micom_grow/batch_{batch}.log"
     benchmark:
-        config["path"]["root"]+"/benchmarks/exchanges/"+'{sample}.benchmark.txt'
+        config["path"]["root"]+"/benchmarks/exchanges/"+'batch_{batch}.benchmark.txt'
     shell:
         """
        
         echo "Begin grow workflow to calculate metabolic exchanges with MICOM... "
         echo "using parsimonious FBA"
 
-        python3 MICOM_grow_wf.py -c {params.pickles_fp} -s {params.smpl} -th {resources.cpus} -o {params.out_folder}
+        python3 MICOM_grow_wf.py -c {params.pickles_fp} -s {params.smpls} -th {resources.cpus} -o {params.out_folder} -st {params.store} -rc {params.result_cache}
         
         echo "Done!"
         """
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the exchange store and cache (MetModels_exchange_store.py) with sample ids that look like numbers.
+Run from the repository root with: python -m pytest tests
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MetModels_exchange_store import load_exchanges, iter_exchanges, write_exchanges, store_samples
+
+EXCHANGES = """,taxon,sample_id,tolerance,reaction,flux,abundance,metabolite,direction
+0,bin_1,{sample},1e-06,EX_h2s_e,0.5,0.4,h2s_e,export
+1,bin_2,{sample},1e-06,EX_h2s_e,-0.25,0.6,h2s_e,import
+2,medium,{sample},1e-06,EX_h2s_m,0.25,,h2s_m,export
+"""
+
+
+@pytest.fixture
+def exchange_folder(tmp_path):
+    """ Exchange files of a sample with a zero-padded numeric id (0012) and of a sample with a text id (S01)"""
+    for sample in ("0012", "S01"):
+        (tmp_path / ("exchanges_grow_%s.csv" %(sample))).write_text(EXCHANGES.format(sample=sample))
+    return str(tmp_path)
+
+
+def test_numeric_sample_ids_without_cache(exchange_folder):
+    exch_df = load_exchanges(exchange_folder, cache=False)
+    assert sorted(exch_df["sample_id"].cat.categories) == ["0012", "S01"]
+
+
+def test_numeric_sample_ids_in_cache(exchange_folder):
+    pytest.importorskip("pyarrow")
+    exch_df = load_exchanges(exchange_folder, samples=["0012"])
+    assert exch_df["sample_id"].unique().tolist() == ["0012"]
+    assert len(exch_df) == 3
+    assert os.path.isdir(os.path.join(exchange_folder, ".exchange_cache", "sample_id=0012"))
+
+
+def test_numeric_sample_ids_in_store(exchange_folder, tmp_path_factory):
+    pytest.importorskip("pyarrow")
+    store_fp = str(tmp_path_factory.mktemp("store"))
+    write_exchanges(load_exchanges(exchange_folder, cache=False), store_fp)
+    assert sorted(store_samples(store_fp)) == ["0012", "S01"]
+    assert load_exchanges(store_fp, samples=["0012"])["sample_id"].unique().tolist() == ["0012"]
+    assert [len(sample_df) for sample_df in iter_exchanges(store_fp, samples=["0012"])] == [3]